@@ -0,0 +1,389 @@
+import hail as hl
+import numpy as np
+import argparse
+import logging
+import time
+import tracemalloc
+import phasing_np
+from typing import Callable, Dict, List, Tuple
+from phasing import (
+    get_phased_gnomad_ht, get_em_expr, get_lr_expr, get_single_het_expr, chet_likelihood_expr, same_hap_likelihood_expr,
+    EM_PLUS_ONE_GT_COUNTS, CHET_THRESHOLD, SAME_HAP_THRESHOLD
+)
+
+logger = logging.getLogger("benchmark_phasing")
+logger.setLevel(logging.INFO)
+
+POPS = ['afr', 'amr', 'asj', 'eas', 'fin', 'nfe', 'oth', 'sas', 'all']
+SCENARIOS = ['singleton', 'rare', 'ld']
+MODELS = ['em', 'em_plus_one', 'lr', 'shr']
+BACKENDS = ['numpy', 'hail']
+SINGLE_HET_RATIO_THRESHOLD = 0.5  # single het ratios above this are called chet in the agreement report
+
+
+def get_random_vp_count_ht(n_rows: int, n_partitions: int = 1) -> hl.Table:
+    """
+    Creates a table with random GT counts in the same format as the VP count table (see `create_vp_matrix.create_vp_summary`).
+
+    :param int n_rows: Number of rows
+    :param int n_partitions: Number of partitions
+    :return: Table with a `gt_counts` dict of pop -> struct(raw, adj)
+    :rtype: Table
+    """
+    ht = hl.utils.range_table(n_rows, n_partitions)
+
+    def random_gt_counts_expr():
+        return hl.array([hl.int64(hl.rand_unif(1000, 10000))] + [hl.int64(hl.rand_unif(0, 3)) for _ in range(8)])
+
+    return ht.select(
+        gt_counts=hl.dict({
+            pop: hl.struct(raw=random_gt_counts_expr(), adj=random_gt_counts_expr())
+            for pop in POPS
+        })
+    )
+
+
+def benchmark_expr(ht: hl.Table, fused: bool) -> dict:
+    """
+    Measures the size of the phasing expression and the time needed to compile and run it on `ht`.
+    `ht` should be small so that the timing is dominated by compilation.
+
+    :param Table ht: VP count table
+    :param bool fused: Whether to use the fused phasing expression
+    :return: Dict with the IR size (characters and nodes) and the compile + run time
+    :rtype: dict
+    """
+    phased_ht = get_phased_gnomad_ht(ht, fused=fused)
+    ir = str(phased_ht._tir)
+
+    start = time.time()
+    phased_ht.collect()
+
+    return dict(
+        mode='fused' if fused else 'unfused',
+        ir_chars=len(ir),
+        ir_nodes=ir.count('('),
+        compile_and_run_s=time.time() - start
+    )
+
+
+def get_random_gt_counts(n_rows: int, seed: int = 42) -> np.ndarray:
+    """
+    Creates random GT counts, including a few edge cases (all-ref, singletons, no het/het, empty).
+
+    :param int n_rows: Number of random rows
+    :param int seed: Random seed
+    :return: (n_rows + number of edge cases, 9) array of GT counts
+    :rtype: ndarray
+    """
+    rng = np.random.default_rng(seed)
+    gt_counts = rng.poisson(rng.choice([0.1, 1, 10], size=(n_rows, 1)), size=(n_rows, 9))
+    gt_counts[:, 0] = rng.integers(0, 10000, size=n_rows)
+    edge_cases = np.array([
+        [0, 0, 0, 0, 0, 0, 0, 0, 0],
+        [100, 0, 0, 0, 0, 0, 0, 0, 0],
+        [100, 0, 0, 0, 1, 0, 0, 0, 0],
+        [100, 1, 0, 1, 0, 0, 0, 0, 0],
+        [100, 1, 0, 0, 0, 0, 0, 0, 0],
+        [0, 0, 0, 0, 0, 0, 0, 0, 3]
+    ])
+    return np.concatenate([edge_cases, gt_counts])
+
+
+def check_parity(gt_counts: np.ndarray, distance: np.ndarray, atol: float = 1e-12, rtol: float = 1e-9) -> dict:
+    """
+    Compares the NumPy implementation of the EM and likelihood-ratio models (phasing_np) to their Hail counterparts.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :param ndarray distance: N distances between variants, used for the likelihood-ratio models
+    :param float atol: Absolute tolerance
+    :param float rtol: Relative tolerance
+    :return: Dict with the number of rows that differ between Hail and NumPy for each output
+    :rtype: dict
+    """
+    ht = hl.Table.parallelize(
+        [hl.Struct(idx=i, gt_counts=[int(x) for x in g], distance=int(d)) for i, (g, d) in enumerate(zip(gt_counts, distance))],
+        hl.tstruct(idx=hl.tint32, gt_counts=hl.tarray(hl.tint32), distance=hl.tint32),
+        key='idx'
+    )
+    ht = ht.annotate(
+        em=get_em_expr(ht.gt_counts),
+        chet_like=chet_likelihood_expr(ht.gt_counts),
+        same_hap_like=same_hap_likelihood_expr(ht.gt_counts),
+        chet_like_distance=chet_likelihood_expr(ht.gt_counts, distance=ht.distance),
+        same_hap_like_distance=same_hap_likelihood_expr(ht.gt_counts, distance=ht.distance)
+    )
+    hail_res = ht.collect()
+
+    def to_array(values):
+        return np.array([np.nan if x is None else x for x in values], dtype=np.float64)
+
+    hap_counts, p_chet = phasing_np.get_em(gt_counts)
+    numpy_res = dict(
+        em_hap_counts=hap_counts,
+        em_p_chet=p_chet,
+        chet_like=phasing_np.chet_likelihood(gt_counts),
+        same_hap_like=phasing_np.same_hap_likelihood(gt_counts),
+        chet_like_distance=phasing_np.chet_likelihood(gt_counts, distance=distance),
+        same_hap_like_distance=phasing_np.same_hap_likelihood(gt_counts, distance=distance)
+    )
+    hail_res = dict(
+        em_hap_counts=np.array([to_array(r.em.hap_counts) if r.em.hap_counts is not None else [np.nan] * 4 for r in hail_res]),
+        em_p_chet=to_array([r.em.p_chet for r in hail_res]),
+        **{k: to_array([r[k] for r in hail_res]) for k in ['chet_like', 'same_hap_like', 'chet_like_distance', 'same_hap_like_distance']}
+    )
+
+    mismatches = {}
+    for k, v in numpy_res.items():
+        close = np.isclose(v, hail_res[k], rtol=rtol, atol=atol, equal_nan=True)
+        if close.ndim > 1:
+            close = close.all(axis=1)
+        mismatches[k] = int((~close).sum())
+        if mismatches[k]:
+            logger.warning(f"{mismatches[k]} rows differ for {k}, e.g. GT counts {gt_counts[~close][0].tolist()}")
+
+    return mismatches
+
+
+def get_gt_probs(hap_freqs: np.ndarray) -> np.ndarray:
+    """
+    Computes the expected GT counts frequencies under Hardy-Weinberg equilibrium given haplotype frequencies.
+
+    :param ndarray hap_freqs: (N, 4) array of haplotype frequencies [AB, aB, Ab, ab]
+    :return: (N, 9) array of GT frequencies, in the GT counts order
+    :rtype: ndarray
+    """
+    # Number of alt alleles for variant 1 and variant 2 on each haplotype
+    n_alt1 = [0, 1, 0, 1]
+    n_alt2 = [0, 0, 1, 1]
+    gt_probs = np.zeros((hap_freqs.shape[0], 9))
+    for i in range(4):
+        for j in range(4):
+            gt_probs[:, 3 * (n_alt1[i] + n_alt1[j]) + n_alt2[i] + n_alt2[j]] += hap_freqs[:, i] * hap_freqs[:, j]
+    return gt_probs
+
+
+def simulate_gt_counts(scenario: str, n_rows: int, n_samples: int = 10000, seed: int = 42) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Simulates GT counts for variant-pairs with a known phase.
+    Half of the variant-pairs are chet (the alt alleles are never on the same haplotype)
+    and half of them are on the same haplotype.
+
+    The following scenarios are available:
+    * singleton: both variants are singletons, carried by the same individual
+    * rare: both variants have an AF between 1e-4 and 1e-2. When on the same haplotype, the rarer variant is always found with the other one.
+    * ld: both variants have an AF between 0.01 and 0.05. When on the same haplotype, between 50% and 100% of the rarer variant haplotypes carry the other variant.
+
+    :param str scenario: One of SCENARIOS
+    :param int n_rows: Number of variant-pairs to simulate
+    :param int n_samples: Number of samples
+    :param int seed: Random seed
+    :return: (n_rows, 9) array of GT counts and whether each variant-pair is chet
+    :rtype: (ndarray, ndarray)
+    """
+    rng = np.random.default_rng(seed)
+    chet = rng.random(n_rows) < 0.5
+
+    if scenario == 'singleton':
+        gt_counts = np.zeros((n_rows, 9), dtype=np.int64)
+        gt_counts[:, 0] = n_samples - 1
+        gt_counts[:, 4] = 1
+        return gt_counts, chet
+
+    if scenario == 'rare':
+        af = 10 ** rng.uniform(-4, -2, size=(n_rows, 2))
+        ld = np.ones(n_rows)
+    elif scenario == 'ld':
+        af = rng.uniform(0.01, 0.05, size=(n_rows, 2))
+        ld = rng.uniform(0.5, 1, size=n_rows)
+    else:
+        raise ValueError(f"Unknown scenario {scenario}. Available scenarios: {SCENARIOS}")
+
+    ab = np.where(chet, 0, ld * af.min(axis=1))
+    hap_freqs = np.stack([1 - af[:, 0] - af[:, 1] + ab, af[:, 0] - ab, af[:, 1] - ab, ab], axis=1)
+    return rng.multinomial(n_samples, get_gt_probs(hap_freqs)), chet
+
+
+def get_numpy_model_fun(model: str) -> Callable[[np.ndarray], np.ndarray]:
+    """
+    Returns a function computing the chet-calling statistic of the given model on an (N, 9) array of GT counts with phasing_np.
+
+    :param str model: One of MODELS
+    :return: Function returning EM p_chet, lr_chet or single het ratio
+    """
+    return {
+        'em': lambda x: phasing_np.get_em(x)[1],
+        'em_plus_one': lambda x: phasing_np.get_em(x + EM_PLUS_ONE_GT_COUNTS)[1],
+        'lr': lambda x: phasing_np.get_lr(x)[2],
+        'shr': phasing_np.get_single_het_ratio
+    }[model]
+
+
+def get_hail_model_expr(model: str, gt_counts: hl.expr.ArrayExpression) -> hl.expr.Float64Expression:
+    """
+    Returns the chet-calling statistic of the given model on `gt_counts` as computed in phasing.py.
+
+    :param str model: One of MODELS
+    :param ArrayExpression gt_counts: GT counts
+    :return: EM p_chet, lr_chet or single het ratio
+    """
+    if model == 'em':
+        return get_em_expr(gt_counts).p_chet
+    if model == 'em_plus_one':
+        return get_em_expr(gt_counts + EM_PLUS_ONE_GT_COUNTS).p_chet
+    if model == 'lr':
+        return get_lr_expr(gt_counts).lr_chet
+    return get_single_het_expr(gt_counts)
+
+
+def _get_jvm_heap_pools() -> list:
+    jvm = hl.spark_context()._jvm
+    return [pool for pool in jvm.java.lang.management.ManagementFactory.getMemoryPoolMXBeans() if pool.getType().toString() == 'Heap memory']
+
+
+def time_model(backend: str, model: str, gt_counts: np.ndarray) -> Tuple[np.ndarray, float, float]:
+    """
+    Computes the given model on `gt_counts` with the given backend.
+
+    :param str backend: One of BACKENDS
+    :param str model: One of MODELS
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :return: Computed values, time in seconds and peak memory in bytes (Python heap for numpy, JVM heap for hail)
+    :rtype: (ndarray, float, float)
+    """
+    if backend == 'numpy':
+        model_fun = get_numpy_model_fun(model)
+        tracemalloc.start()
+        start = time.time()
+        res = model_fun(gt_counts)
+        elapsed = time.time() - start
+        peak_mem = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return res, elapsed, peak_mem
+
+    ht = hl.Table.parallelize(
+        [hl.Struct(idx=i, gt_counts=[int(x) for x in g]) for i, g in enumerate(gt_counts)],
+        hl.tstruct(idx=hl.tint32, gt_counts=hl.tarray(hl.tint32)),
+        key='idx'
+    ).cache()
+    ht.count()
+
+    pools = _get_jvm_heap_pools()
+    for pool in pools:
+        pool.resetPeakUsage()
+    start = time.time()
+    res = ht.select(x=get_hail_model_expr(model, ht.gt_counts)).x.collect()
+    elapsed = time.time() - start
+    peak_mem = sum(pool.getPeakUsage().getUsed() for pool in pools)
+    ht.unpersist()
+
+    return np.array([np.nan if x is None else x for x in res], dtype=np.float64), elapsed, peak_mem
+
+
+def get_agreement(model: str, values: np.ndarray, chet: np.ndarray) -> Tuple[float, float]:
+    """
+    Computes the fraction of variant-pairs for which the model makes a call and how many of these calls agree with the true phase.
+    EM models are called using CHET_THRESHOLD / SAME_HAP_THRESHOLD, the LR model using lr_chet > 0
+    and the single het ratio model using SINGLE_HET_RATIO_THRESHOLD.
+
+    :param str model: One of MODELS
+    :param ndarray values: Model values
+    :param ndarray chet: True phase
+    :return: Call rate and agreement with the true phase among calls
+    :rtype: (float, float)
+    """
+    with np.errstate(invalid='ignore'):
+        if model in ['em', 'em_plus_one']:
+            called_chet = values > CHET_THRESHOLD
+            called = called_chet | (values < SAME_HAP_THRESHOLD)
+        elif model == 'lr':
+            called_chet = values > 0
+            called = ~np.isnan(values)
+        else:
+            called_chet = values > SINGLE_HET_RATIO_THRESHOLD
+            called = ~np.isnan(values)
+
+    n_called = called.sum()
+    return n_called / len(values), (called_chet[called] == chet[called]).sum() / max(n_called, 1)
+
+
+def run_benchmark(scenarios: List[str], backends: List[str], batch_sizes: List[int], n_samples: int) -> List[Dict]:
+    """
+    Times all models on simulated GT counts for all combinations of scenario, backend and batch size
+    and computes their agreement with the true phase.
+
+    :param list of str scenarios: Scenarios to simulate (see `simulate_gt_counts`)
+    :param list of str backends: Backends to benchmark
+    :param list of int batch_sizes: Number of variant-pairs to phase at once
+    :param int n_samples: Number of samples used in the simulation
+    :return: One dict per scenario / backend / batch size / model
+    :rtype: list of dict
+    """
+    results = []
+    for scenario in scenarios:
+        for batch_size in batch_sizes:
+            gt_counts, chet = simulate_gt_counts(scenario, batch_size, n_samples)
+            for backend in backends:
+                for model in MODELS:
+                    values, elapsed, peak_mem = time_model(backend, model, gt_counts)
+                    call_rate, agreement = get_agreement(model, values, chet)
+                    results.append(dict(
+                        scenario=scenario,
+                        backend=backend,
+                        model=model,
+                        batch_size=batch_size,
+                        rows_per_s=batch_size / elapsed if elapsed > 0 else float('inf'),
+                        peak_mem_mb=peak_mem / 2 ** 20,
+                        call_rate=call_rate,
+                        agreement=agreement
+                    ))
+                    logger.info(f"{scenario} / {backend} / {model} / {batch_size}: {results[-1]['rows_per_s']:.0f} rows/s")
+    return results
+
+
+def main(args):
+    if args.expr_benchmark or args.parity or 'hail' in args.backends:
+        hl.init(log="/tmp/benchmark_phasing.hail.log", quiet=True)
+
+    if args.expr_benchmark:
+        ht = get_random_vp_count_ht(args.n_rows, 1).cache()
+        ht.count()
+
+        results = [benchmark_expr(ht, fused) for fused in [False, True]]
+        logger.info("Phasing expression size and compile time:")
+        print("mode\tir_chars\tir_nodes\tcompile_and_run_s")
+        for r in results:
+            print(f"{r['mode']}\t{r['ir_chars']}\t{r['ir_nodes']}\t{r['compile_and_run_s']:.2f}")
+
+    if args.parity:
+        gt_counts = get_random_gt_counts(args.n_parity_rows)
+        distance = np.random.default_rng(42).integers(1, 100000, size=gt_counts.shape[0])
+        mismatches = check_parity(gt_counts, distance)
+        print(f"Parity of NumPy vs Hail phasing models on {gt_counts.shape[0]} GT counts (number of differing rows):")
+        for k, v in mismatches.items():
+            print(f"{k}\t{v}")
+        if any(mismatches.values()):
+            raise Exception("NumPy and Hail phasing models differ.")
+
+    if args.throughput:
+        results = run_benchmark(args.scenarios, args.backends, args.batch_sizes, args.n_samples)
+        columns = ['scenario', 'backend', 'model', 'batch_size', 'rows_per_s', 'peak_mem_mb', 'call_rate', 'agreement']
+        print("\t".join(columns))
+        for r in results:
+            print("\t".join(f'{r[c]:.3f}' if isinstance(r[c], float) else str(r[c]) for c in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--expr_benchmark', help='Compares the phasing expression size and compile time with and without the fused phasing mode.', action='store_true')
+    parser.add_argument('--parity', help='Checks that the NumPy EM and likelihood-ratio models (phasing_np) match the Hail ones.', action='store_true')
+    parser.add_argument('--n_parity_rows', help='Number of random GT counts used for the parity check (default: 10000)', default=10000, type=int)
+    parser.add_argument('--n_rows', help='Number of rows used for the expression benchmark (default: 1)', default=1, type=int)
+    parser.add_argument('--throughput', help='Times all phasing models on simulated GT counts and reports rows/sec, peak memory and agreement with the simulated phase.', action='store_true')
+    parser.add_argument('--scenarios', help='Scenarios to simulate for the throughput benchmark (default: all)', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--backends', help='Backends to benchmark (default: numpy)', nargs='+', choices=BACKENDS, default=['numpy'])
+    parser.add_argument('--batch_sizes', help='Number of variant-pairs phased at once (default: 1000 10000 100000)', nargs='+', type=int, default=[1000, 10000, 100000])
+    parser.add_argument('--n_samples', help='Number of samples used in the simulation (default: 10000)', default=10000, type=int)
+
+    args = parser.parse_args()
+    main(args)
@@ -1,7 +1,9 @@
 import hail as hl
 from gnomad.utils.vep import CSQ_ORDER
 from gnomad_qc.v2.resources import get_gnomad_meta, fam_path
-from logging import getLogger
+from functools import reduce
+from logging import getLogger, Logger, INFO
+from typing import List, Optional
 
 logger = getLogger('chet_utils')
 BAD_THAI_TRIOS_PROJECT_ID = 'C978'
@@ -21,6 +23,134 @@ def vep_genes_expr(vep_expr: hl.expr.StructExpression, least_consequence: str) -
             )
 
 
+def vep_gene_csq_ranks_expr(vep_expr: hl.expr.StructExpression) -> hl.expr.DictExpression:
+    """
+    Returns the most severe consequence rank (index in CSQ_ORDER) of each protein-coding gene of a variant.
+    Unlike `vep_genes_expr`, this doesn't depend on the least consequence, see `vep_genes_from_csq_ranks_expr`.
+
+    :param StructExpression vep_expr: VEP annotation
+    :return: Dict of gene ID -> most severe consequence rank
+    :rtype: DictExpression
+    """
+    csq_ranks = hl.literal({csq: i for i, csq in enumerate(CSQ_ORDER)})
+    gene_ranks = vep_expr.transcript_consequences.filter(
+        lambda tc: tc.biotype == 'protein_coding'
+    ).map(
+        lambda tc: hl.struct(
+            gene_id=tc.gene_id,
+            rank=hl.min(tc.consequence_terms.filter(lambda c: csq_ranks.contains(c)).map(lambda c: csq_ranks[c]))
+        )
+    ).filter(
+        lambda x: hl.is_defined(x.rank)
+    )
+    return hl.group_by(lambda x: x.gene_id, gene_ranks).map_values(lambda x: hl.min(x.map(lambda y: y.rank)))
+
+
+def vep_genes_from_csq_ranks_expr(gene_csq_ranks: hl.expr.DictExpression, least_consequence: str) -> hl.expr.SetExpression:
+    """
+    Returns the same genes as `vep_genes_expr` from the output of `vep_gene_csq_ranks_expr`.
+
+    :param DictExpression gene_csq_ranks: Dict of gene ID -> most severe consequence rank
+    :param str least_consequence: Least consequence
+    :return: Set of gene IDs
+    :rtype: SetExpression
+    """
+    return gene_csq_ranks.key_set().filter(lambda g: gene_csq_ranks[g] <= CSQ_ORDER.index(least_consequence))
+
+
+def annotate_vp_with_variant_ann(vp_ht: hl.Table, variant_ann_ht: hl.Table, fields: List[str] = None) -> hl.Table:
+    """
+    Annotates variant-pairs with per-variant annotations (e.g. output of `create_vp_matrix.create_variant_ann_ht`).
+    Each annotation field is added twice, suffixed with 1 and 2 for the first and second variant of the pair.
+
+    If `vp_ht` is keyed by variant IDs (id1, id2) and `variant_ann_ht` has a `vid` field, the pairs are joined by ID
+    and locus and alleles are added as any other field (locus1, alleles1, locus2, alleles2).
+    Variants 1 and 2 are then in variant ID order, which can differ from the (locus1, alleles1, locus2, alleles2) key
+    order for variants at the same position (see `create_vp_matrix.create_vp_ann`).
+    Otherwise, the pairs are joined by locus1, alleles1 and locus2, alleles2.
+
+    :param Table vp_ht: Variant-pair table
+    :param Table variant_ann_ht: Per-variant annotation table, keyed by locus and alleles
+    :param list of str fields: Annotation fields to add. All fields by default.
+    :return: Annotated variant-pair table
+    :rtype: Table
+    """
+    by_id = 'id1' in vp_ht.row.dtype.fields and 'vid' in variant_ann_ht.row.dtype.fields
+    if by_id:
+        variant_ann_ht = variant_ann_ht.key_by('vid')  # IDs are in genomic order, so this doesn't shuffle
+
+    if fields is None:
+        fields = [f for f in variant_ann_ht.row_value.dtype.fields if f != 'vid']
+    variant_ann_ht = variant_ann_ht.select(*fields)
+
+    # Variant 2 is joined first, so that variant 1 is joined on a prefix of the key
+    v2_ann = variant_ann_ht[vp_ht.id2] if by_id else variant_ann_ht[vp_ht.locus2, vp_ht.alleles2]
+    vp_ht = vp_ht.annotate(**{f'{f}2': v2_ann[f] for f in fields})
+    v1_ann = variant_ann_ht[vp_ht.id1] if by_id else variant_ann_ht[vp_ht.locus1, vp_ht.alleles1]
+    return vp_ht.annotate(**{f'{f}1': v1_ann[f] for f in fields})
+
+
+class FilterFunnel:
+    """
+    Sequence of row filters recorded lazily as boolean fields, so that the number of rows remaining after each filter
+    is computed in a single aggregation (instead of one `count()` per filter), and only if it is logged.
+    All filters are then applied at once. Missing filter values fail the filter, as with `Table.filter`.
+    """
+
+    def __init__(self):
+        self.filters = []
+
+    def add(self, ht: hl.Table, description: str, expr: hl.expr.BooleanExpression) -> hl.Table:
+        """
+        Adds a filter, keeping rows for which `expr` is True.
+
+        :param Table ht: Table to filter
+        :param str description: Description of the filter, used when logging the funnel
+        :param BooleanExpression expr: Filter expression (rows to keep)
+        :return: Table annotated with the filter flag
+        :rtype: Table
+        """
+        field = f'_funnel_{len(self.filters)}'
+        self.filters.append((description, field))
+        return ht.annotate(**{field: hl.or_else(expr, False)})
+
+    def get_counts(self, ht: hl.Table) -> List[int]:
+        """
+        Returns the number of input rows and of rows remaining after each filter, in a single aggregation.
+
+        :param Table ht: Table annotated with all filters
+        :return: Number of input rows followed by the number of rows remaining after each filter
+        :rtype: list of int
+        """
+        flags = [ht[field] for _, field in self.filters]
+        return ht.aggregate(
+            [hl.agg.count()] +
+            [hl.agg.count_where(reduce(lambda a, b: a & b, flags[:i + 1])) for i in range(len(flags))]
+        )
+
+    def apply(self, ht: hl.Table, funnel_logger: Optional[Logger] = logger, level: int = INFO) -> hl.Table:
+        """
+        Applies all filters. If `funnel_logger` is set and enabled for `level`, the funnel is computed and logged first.
+
+        :param Table ht: Table annotated with all filters
+        :param Logger funnel_logger: Logger to log the funnel to. If None, the funnel isn't computed.
+        :param int level: Logging level of the funnel. The funnel isn't computed if the logger isn't enabled for it.
+        :return: Filtered table
+        :rtype: Table
+        """
+        if not self.filters:
+            return ht
+
+        if funnel_logger is not None and funnel_logger.isEnabledFor(level):
+            counts = self.get_counts(ht)
+            funnel_logger.log(level, f'Rows before filtering: {counts[0]}')
+            for (description, _), n_before, n_after in zip(self.filters, counts, counts[1:]):
+                funnel_logger.log(level, f'Rows remaining after {description}: {n_after} ({n_before - n_after} removed)')
+
+        flags = [ht[field] for _, field in self.filters]
+        return ht.filter(reduce(lambda a, b: a & b, flags)).drop(*[field for _, field in self.filters])
+
+
 def get_pbt_trio_ht(data_type: str):
 
     # Keep a single proband from each family with > 1  proband.
@@ -1,51 +1,19 @@
-import hail as hl
-from gnomad.utils.liftover import get_liftover_genome
 import argparse
-from compute_phase import compute_phase, flatten_phased_ht, liftover_expr
-
-
-def load_cmg(cmg_csv: str) -> hl.Table:
-    cmg_ht = hl.import_table(cmg_csv, impute=True, delimiter=",", quote='"')
-
-    cmg_ht = cmg_ht.transmute(
-        locus1_b38=hl.locus("chr" + hl.str(cmg_ht.chrom_1), cmg_ht.pos_1, reference_genome='GRCh38'),
-        alleles1_b38=[cmg_ht.ref_1, cmg_ht.alt_1],
-        locus2_b38=hl.locus("chr" + hl.str(cmg_ht.chrom_2), cmg_ht.pos_2, reference_genome='GRCh38'),
-        alleles2_b38=[cmg_ht.ref_2, cmg_ht.alt_2]
-    )
-
-    liftover_references = get_liftover_genome(cmg_ht.rename({'locus1_b38': 'locus'}))
-    lifted_over_variants = hl.sorted(
-        hl.array([
-            liftover_expr(cmg_ht.locus1_b38, cmg_ht.alleles1_b38, liftover_references[1]),
-            liftover_expr(cmg_ht.locus2_b38, cmg_ht.alleles2_b38, liftover_references[1])
-        ]),
-        lambda x: x.locus
-    )
-
-    cmg_ht = cmg_ht.key_by(
-        locus1=lifted_over_variants[0].locus,
-        alleles1=lifted_over_variants[0].alleles,
-        locus2=lifted_over_variants[1].locus,
-        alleles2=lifted_over_variants[1].alleles
-    )
-
-    return cmg_ht.annotate(
-        bad_liftover=(
-                hl.is_missing(cmg_ht.locus1) |
-                hl.is_missing(cmg_ht.locus2) |
-                (cmg_ht.locus1.sequence_context() != cmg_ht.alleles1[0][0]) |
-                (cmg_ht.locus2.sequence_context() != cmg_ht.alleles2[0][0])
-        )
-    )
+from compute_phase import compute_phase, compute_phase_cached, flatten_phased_ht, grch38_phase_tables_exist
+from phase_result_cache import DEFAULT_PHASE_RESULT_CACHE_PATH, DEFAULT_MAX_PAIRS, DEFAULT_MAX_QUERY_PAIRS
+from pair_input import load_cmg
+from resources import liftover_cache_ht_path
 
 
 def main(args):
-    # Load CMG data
-    cmg_ht = load_cmg(args.cmg)
+    # Load CMG data. CMG variants are GRCh38, and are only lifted over if the GRCh38 phase tables weren't built
+    cmg_ht = load_cmg(args.cmg, args.liftover_cache, liftover=not grch38_phase_tables_exist())
 
     # Add phase information
-    phased_ht = compute_phase(cmg_ht)
+    if args.result_cache:
+        phased_ht = compute_phase_cached(cmg_ht, args.result_cache_path, args.max_cached_pairs, args.max_result_cache_query_pairs)
+    else:
+        phased_ht = compute_phase(cmg_ht)
     phased_ht = phased_ht.annotate(
         **cmg_ht[phased_ht.key]
     )
@@ -58,6 +26,11 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--cmg', help='CMG file containing variants to phase.',
                           default='gs://gnomad/projects/compound_hets/Feb_2020_CMG_Compound_het_list.csv')
+    parser.add_argument('--liftover_cache', help=f'Liftover cache path (default: {liftover_cache_ht_path()})', default=liftover_cache_ht_path())
+    parser.add_argument('--result_cache', help='Uses the local cache of phase results shared with compute_phase.py (see compute_phase.py --result_cache).', action='store_true')
+    parser.add_argument('--result_cache_path', help=f'Path of the local cache of phase results (default: {DEFAULT_PHASE_RESULT_CACHE_PATH})', default=DEFAULT_PHASE_RESULT_CACHE_PATH)
+    parser.add_argument('--max_cached_pairs', help=f'Maximum number of pairs kept in the result cache (default: {DEFAULT_MAX_PAIRS})', default=DEFAULT_MAX_PAIRS, type=int)
+    parser.add_argument('--max_result_cache_query_pairs', help=f'CMG lists with more pairs are computed without the result cache (default: {DEFAULT_MAX_QUERY_PAIRS})', default=DEFAULT_MAX_QUERY_PAIRS, type=int)
     parser.add_argument('--out', help='Output TSV file',
                           default='gs://gnomad/projects/compound_hets/Feb_2020_CMG_Compound_het_list_phased.tsv')
 
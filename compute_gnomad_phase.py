@@ -1,7 +1,7 @@
 from resources import *
 from phasing import *
 import argparse
-from phasing import get_phased_gnomad_ht
+from phasing import get_phased_gnomad_ht, update_phased_gnomad_ht
 
 def main(args):
     hl.init(log="/tmp/phasing.hail.log")
@@ -10,11 +10,33 @@ def main(args):
     path_args = [data_type, args.pbt, args.least_consequence, args.max_freq, args.chrom]
 
     ht = hl.read_table(vp_count_ht_path(*path_args))
+
+    if args.update:
+        ht = update_phased_gnomad_ht(
+            ht,
+            hl.read_table(phased_vp_count_ht_path(*path_args)),
+            not args.no_em,
+            not args.no_lr,
+            not args.no_shr,
+            args.em_backend,
+            args.phase_cache,
+            args.phase_cache_path,
+            args.fused
+        )
+        # The phased table is overwritten, so the output is checkpointed first
+        ht = ht.checkpoint('gs://gnomad-tmp/compound_hets/updated_phased_vp_counts.ht', overwrite=True)
+        ht.write(phased_vp_count_ht_path(*path_args), overwrite=True)
+        return
+
     ht =  get_phased_gnomad_ht(
         ht,
         not args.no_em,
         not args.no_lr,
-        not args.no_shr
+        not args.no_shr,
+        args.em_backend,
+        args.phase_cache,
+        args.phase_cache_path,
+        args.fused
     )
 
     ht.write(phased_vp_count_ht_path(*path_args), overwrite=args.overwrite)
@@ -34,6 +56,12 @@ if __name__ == '__main__':
     parser.add_argument('--no_em', help=f'Do not compute EM phase', action='store_true')
     parser.add_argument('--no_lr', help=f'Do not compute likelihood-ratio phase', action='store_true')
     parser.add_argument('--no_shr', help=f'Do not compute single het ratio phase', action='store_true')
+    parser.add_argument('--em_backend', help=f'Backend used to compute the EM phase. With numpy, the EM is computed on the driver once for each distinct GT counts. (default: hail)',
+                        choices=EM_BACKENDS, default='hail')
+    parser.add_argument('--fused', help=f'Computes all phase models from a single expression per GT counts, sharing intermediate statistics and warm-starting em_plus_one from the EM solution.', action='store_true')
+    parser.add_argument('--phase_cache', help=f'Phase each distinct GT counts only once, using and updating the persistent phase cache at --phase_cache_path', action='store_true')
+    parser.add_argument('--phase_cache_path', help=f'Path of the persistent phase cache. (default: {phase_cache_ht_path()})', default=phase_cache_ht_path())
+    parser.add_argument('--update', help='Updates the existing phased table after the VP counts were updated (see create_vp_matrix.py --update_vp_summary), re-phasing only the populations whose GT counts changed.', action='store_true')
     parser.add_argument('--max_freq', help=f'Maximum global adj AF for the input (just to get the path right). (default: {MAX_FREQ:.3f})', default=MAX_FREQ, type=float)
     parser.add_argument('--chrom', help='Only run on given chromosome')
     parser.add_argument('--slack_channel', help='Slack channel to post results and notifications to.')
@@ -1,66 +1,41 @@
 import hail as hl
-from resources import phased_vp_count_ht_path
+from resources import phased_vp_count_ht_path, vp_bloom_path, single_variant_ht_path, liftover_cache_ht_path
 from gnomad.utils.liftover import get_liftover_genome
 import gnomad.resources.grch37.gnomad as gnomad
 from phasing import get_em_expr, flatten_gt_counts
 import argparse
 from math import ceil
 import logging
-from chet_utils import vep_genes_expr
+import os
+import hashlib
+import numpy as np
+from typing import List, Tuple
+from chet_utils import vep_gene_csq_ranks_expr, vep_genes_from_csq_ranks_expr, FilterFunnel
 from resources import LEAST_CONSEQUENCE, MAX_FREQ
+from phase_index import PhaseIndex, DEFAULT_PHASE_INDEX_PATH, get_table_source
+from vp_bloom import VPBloomFilter, filter_with_vp_bloom
+from pair_input import pairs_ht_from_file
+from liftover_cache import liftover_expr, liftover_pairs_ht
+from phase_result_cache import PhaseResultCache, DEFAULT_PHASE_RESULT_CACHE_PATH, DEFAULT_MAX_PAIRS, DEFAULT_MAX_QUERY_PAIRS
 
 logger = logging.getLogger("compute_phase")
 logger.setLevel(logging.INFO)
 
+SMALL_QUERY_MAX_PAIRS = 1000
 
-def liftover_expr(
-        locus: hl.expr.LocusExpression,
-        alleles: hl.expr.ArrayExpression,
-        destination_ref: hl.ReferenceGenome
-) -> hl.expr.StructExpression:
-    lifted_over_locus = hl.liftover(locus, destination_ref, include_strand=True)
-    lifted_over_alleles = alleles.map(
-        lambda a: hl.if_else(lifted_over_locus.is_negative_strand, hl.reverse_complement(a), a)
-    )
-    return hl.struct(
-        locus=lifted_over_locus.result,
-        alleles=lifted_over_alleles
-    )
 
+def grch38_phase_tables_exist(data_type: str = 'exomes') -> bool:
+    """
+    Returns whether the GRCh38 phased VP and single-variant tables were built (see `liftover_phase_tables.py`),
+    in which case GRCh38 queries are looked up natively instead of being lifted over.
 
-def load_cmg(cmg_csv: str) -> hl.Table:
-    cmg_ht = hl.import_table(cmg_csv, impute=True, delimiter=",", quote='"')
-
-    cmg_ht = cmg_ht.transmute(
-        locus1_b38=hl.locus("chr" + hl.str(cmg_ht.chrom_1), cmg_ht.pos_1, reference_genome='GRCh38'),
-        alleles1_b38=[cmg_ht.ref_1, cmg_ht.alt_1],
-        locus2_b38=hl.locus("chr" + hl.str(cmg_ht.chrom_2), cmg_ht.pos_2, reference_genome='GRCh38'),
-        alleles2_b38=[cmg_ht.ref_2, cmg_ht.alt_2]
-    )
-
-    liftover_references = get_liftover_genome(cmg_ht.rename({'locus1_b38': 'locus'}))
-    lifted_over_variants = hl.sorted(
-        hl.array([
-            liftover_expr(cmg_ht.locus1_b38, cmg_ht.alleles1_b38, liftover_references[1]),
-            liftover_expr(cmg_ht.locus2_b38, cmg_ht.alleles2_b38, liftover_references[1])
-        ]),
-        lambda x: x.locus
-    )
-
-    cmg_ht = cmg_ht.key_by(
-        locus1=lifted_over_variants[0].locus,
-        alleles1=lifted_over_variants[0].alleles,
-        locus2=lifted_over_variants[1].locus,
-        alleles2=lifted_over_variants[1].alleles
-    )
-
-    return cmg_ht.annotate(
-        bad_liftover=(
-                hl.is_missing(cmg_ht.locus1) |
-                hl.is_missing(cmg_ht.locus2) |
-                (cmg_ht.locus1.sequence_context() != cmg_ht.alleles1[0][0]) |
-                (cmg_ht.locus2.sequence_context() != cmg_ht.alleles2[0][0])
-        )
+    :param str data_type: One of 'exomes' or 'genomes'
+    :return: Whether both GRCh38 tables exist
+    :rtype: bool
+    """
+    return (
+            hl.hadoop_exists(f"{phased_vp_count_ht_path(data_type, reference_genome='GRCh38')}/_SUCCESS") &
+            hl.hadoop_exists(f"{single_variant_ht_path(data_type, reference_genome='GRCh38')}/_SUCCESS")
     )
 
 
@@ -68,9 +43,10 @@ def get_sorted_variants_expr(
         locus1: hl.expr.LocusExpression,
         alleles1: hl.expr.ArrayExpression,
         locus2: hl.expr.LocusExpression,
-        alleles2: hl.expr.ArrayExpression
+        alleles2: hl.expr.ArrayExpression,
+        liftover: bool = True
 ) -> hl.expr.StructExpression:
-    if locus1.dtype.reference_genome.name == 'GRCh37':
+    if locus1.dtype.reference_genome.name == 'GRCh37' or not liftover:
         variants = [
             hl.struct(
                 locus=locus1,
@@ -106,7 +82,7 @@ def get_sorted_variants_expr(
     )
 
 
-def read_variants_ht(path: str) -> hl.Table:
+def read_variants_ht(path: str, liftover_cache_path: str = liftover_cache_ht_path(), liftover: bool = True) -> hl.Table:
     variants_ht = hl.read_table(path)
 
     # Make sure that types match
@@ -117,19 +93,25 @@ def read_variants_ht(path: str) -> hl.Table:
             (variants_ht.key[3].dtype == hl.tarray(hl.tstr))
     )
 
+    if liftover and variants_ht.key[0].dtype.reference_genome.name != 'GRCh37':
+        # Each distinct variant is only lifted over once, and only if it isn't in the liftover cache yet
+        logger.warning("Variants are not on GRCh37; they will be lifted over.")
+        return liftover_pairs_ht(variants_ht, liftover_cache_path).persist()
+
     variants_ht = variants_ht.key_by(
         **get_sorted_variants_expr(
             variants_ht.key[0],
             variants_ht.key[1],
             variants_ht.key[2],
-            variants_ht.key[3]
+            variants_ht.key[3],
+            liftover
         )
     ).persist()
 
     return variants_ht
 
 
-def variants_ht_from_text(variants: str) -> hl.Table:
+def variants_ht_from_text(variants: str, liftover: bool = True) -> hl.Table:
     v1, v2 = variants.split(",")
     chr1, pos1, ref1, alt1 = v1.strip().split(":")
     chr2, pos2, ref2, alt2 = v2.strip().split(":")
@@ -142,7 +124,8 @@ def variants_ht_from_text(variants: str) -> hl.Table:
                 hl.locus(chr1, int(pos1), reference_genome=ref),
                 hl.array([ref1, alt1]),
                 hl.locus(chr2, int(pos2), reference_genome=ref),
-                hl.array([ref2, alt2])
+                hl.array([ref2, alt2]),
+                liftover
             )
         ],
         key=['locus1', 'alleles1', 'locus2', 'alleles2']
@@ -154,12 +137,32 @@ def variants_ht_from_text(variants: str) -> hl.Table:
     return variants_ht
 
 
+def create_single_variant_ht(data_type: str = 'exomes') -> hl.Table:
+    """
+    Creates a slim per-variant table from the gnomAD public release, with only the adj / raw freq and the most severe
+    consequence rank of each protein-coding gene. This is all that's needed to estimate the phase of pairs absent from
+    the phased VP table (see `annotate_unphased_pairs`).
+
+    :param str data_type: One of 'exomes' or 'genomes'
+    :return: Single-variant table
+    :rtype: Table
+    """
+    release_ht = gnomad.public_release(data_type).ht()
+    return release_ht.select(
+        adj_freq=release_ht.freq[0],
+        raw_freq=release_ht.freq[1],
+        gene_csq_ranks=vep_gene_csq_ranks_expr(release_ht.vep)
+    ).select_globals()
+
+
 # TODO: How to handle one variant absent from gnomAD?
 def annotate_unphased_pairs(
         unphased_ht: hl.Table,
         n_variant_pairs: int,
         least_consequence: str,
-        max_af: float
+        max_af: float,
+        single_variant_path: str = single_variant_ht_path(),
+        small_query: bool = False
 ):
     # unphased_ht = vp_ht.filter(hl.is_missing(vp_ht.all_phase))
     # unphased_ht = unphased_ht.key_by()
@@ -178,11 +181,28 @@ def annotate_unphased_pairs(
     ).persist()  # .checkpoint('gs://gnomad-tmp/vp_ht_unphased.ht')
 
     # Annotate single variants with gnomAD freq
-    gnomad_ht = gnomad.public_release('exomes').ht()
-    gnomad_ht = gnomad_ht.semi_join(unphased_ht).repartition(
-        ceil(n_variant_pairs / 10000),
-        shuffle=True
-    ).persist()
+    if single_variant_path is not None and hl.hadoop_exists(f'{single_variant_path}/_SUCCESS'):
+        # Only the partitions of the slim single-variant table overlapping the queried variants are read
+        gnomad_ht = hl.read_table(single_variant_path)
+        gnomad_ht = hl.filter_intervals(
+            gnomad_ht,
+            [
+                hl.Interval(locus, locus, includes_end=True)
+                # Variants with a missing locus (failed liftover) can't be found
+                for locus in unphased_ht.aggregate(hl.agg.filter(hl.is_defined(unphased_ht.locus), hl.agg.collect_as_set(unphased_ht.locus)))
+            ]
+        )
+        gnomad_ht = gnomad_ht.semi_join(unphased_ht).persist()
+    elif unphased_ht.locus.dtype.reference_genome.name != 'GRCh37':
+        raise ValueError(f"Single-variant table {single_variant_path} not found. It is required for {unphased_ht.locus.dtype.reference_genome.name} variants (see liftover_phase_tables.py).")
+    else:
+        gnomad_ht = create_single_variant_ht().semi_join(unphased_ht)
+        if not small_query:
+            gnomad_ht = gnomad_ht.repartition(
+                ceil(n_variant_pairs / 10000),
+                shuffle=True
+            )
+        gnomad_ht = gnomad_ht.persist()
 
     missing_freq = hl.struct(
         AC=0,
@@ -191,21 +211,25 @@ def annotate_unphased_pairs(
         homozygote_count=0
     )
 
-    logger.info(f"{gnomad_ht.count()}/{unphased_ht.count()} single variants from the unphased pairs found in gnomAD.")
+    if not small_query:
+        n_variants, n_found = unphased_ht.aggregate((
+            hl.agg.count(),
+            hl.agg.count_where(hl.is_defined(gnomad_ht[unphased_ht.key]))
+        ))
+        logger.info(f"{n_found}/{n_variants} single variants from the unphased pairs found in gnomAD.")
 
     gnomad_indexed = gnomad_ht[unphased_ht.key]
-    gnomad_freq = gnomad_indexed.freq
     unphased_ht = unphased_ht.annotate(
         adj_freq=hl.or_else(
-            gnomad_freq[0],
+            gnomad_indexed.adj_freq,
             missing_freq
         ),
         raw_freq=hl.or_else(
-            gnomad_freq[1],
+            gnomad_indexed.raw_freq,
             missing_freq
         ),
-        vep_genes=vep_genes_expr(gnomad_indexed.vep, least_consequence),
-        max_af_filter=gnomad_indexed.freq[0].AF <= max_af
+        vep_genes=vep_genes_from_csq_ranks_expr(gnomad_indexed.gene_csq_ranks, least_consequence),
+        max_af_filter=gnomad_indexed.adj_freq.AF <= max_af
         # pop_max_freq=hl.or_else(
         #     gnomad_exomes.popmax[0],
         #     missing_freq.annotate(
@@ -284,23 +308,12 @@ def annotate_unphased_pairs(
         (hl.len(unphased_ht.vep_genes[0].intersection(unphased_ht.vep_genes[1])) > 0)
     )
 
-    max_af_filtered, vep_filtered = unphased_ht.aggregate([
-        hl.agg.count_where(~unphased_ht.max_af_filter),
-        hl.agg.count_where(~unphased_ht.vep_filter)
-    ])
-    if max_af_filtered > 0:
-        logger.info(f"{max_af_filtered} variant-pairs excluded because the AF of at least one variant was > {max_af}")
-    if vep_filtered > 0:
-        logger.info(f"{vep_filtered} variant-pairs excluded because the variants were not found within the same gene with a csq of at least {least_consequence}")
-
-    unphased_ht = unphased_ht.filter(
-        unphased_ht.max_af_filter &
-        unphased_ht.vep_filter
-    )
+    funnel = FilterFunnel()
+    unphased_ht = funnel.add(unphased_ht, f'max AF filter (AF <= {max_af} for both variants)', unphased_ht.max_af_filter)
+    unphased_ht = funnel.add(unphased_ht, f'VEP filter (same gene with a csq of at least {least_consequence})', unphased_ht.vep_filter)
+    unphased_ht = unphased_ht.drop('max_af_filter', 'vep_filter')
 
-    return unphased_ht.drop(
-        'max_af_filter', 'vep_filter'
-    )
+    return funnel.apply(unphased_ht, None if small_query else logger)
 
 
 def flatten_phased_ht(phased_ht: hl.Table) -> hl.Table:
@@ -348,34 +361,250 @@ def explode_phase_info(ht: hl.Table, remove_all_ref: bool = True) -> hl.Table:
     return ht
 
 
+def get_phased_ht_from_phase_index(variants_ht: hl.Table, phase_index_path: str) -> Tuple[hl.Table, int]:
+    """
+    Looks up the phase of the variant pairs in a phase index file (see `phase_index.py`) rather than in the phased VP table.
+    The result has the same schema as the phased pairs in `compute_phase`.
+
+    :param Table variants_ht: Variant pairs, keyed by locus1, alleles1, locus2, alleles2
+    :param str phase_index_path: Path of the phase index file
+    :return: Phased pairs (one row per pair and pop) and the number of pairs found
+    :rtype: (Table, int)
+    """
+    index = PhaseIndex(phase_index_path)
+    em_type = hl.tstruct(hap_counts=hl.tarray(hl.tfloat64), p_chet=hl.tfloat64)
+    row_type = hl.tstruct(
+        **variants_ht.key.dtype,
+        pop=hl.tstr,
+        phase_info=hl.tstruct(
+            gt_counts=hl.tstruct(raw=hl.tarray(hl.tint32), adj=hl.tarray(hl.tint32)),
+            em=hl.tstruct(raw=em_type, adj=em_type)
+        )
+    )
+
+    def get_em(hap_counts, p_chet):
+        if np.isnan(hap_counts).all():
+            return None
+        return hl.Struct(hap_counts=[float(x) for x in hap_counts], p_chet=float(p_chet))
+
+    rows = []
+    n_phased = 0
+    for v in variants_ht.key.collect():
+        # Pairs with a missing locus (failed liftover) are never in the index
+        if v.locus1 is None or v.locus2 is None or v.locus1.contig != v.locus2.contig:
+            continue
+        records = index.get(
+            v.locus1.contig, v.locus1.position, v.alleles1[0], v.alleles1[1],
+            v.locus2.position, v.alleles2[0], v.alleles2[1]
+        )
+        n_phased += len(records) > 0
+        rows.extend(
+            hl.Struct(
+                **v,
+                pop=r['pop'],
+                phase_info=hl.Struct(
+                    gt_counts=hl.Struct(raw=r['raw'], adj=r['adj']),
+                    em=hl.Struct(
+                        raw=get_em(r['hap_counts_raw'], r['p_chet_raw']),
+                        adj=get_em(r['hap_counts_adj'], r['p_chet_adj'])
+                    )
+                )
+            )
+            for r in records
+        )
+    index.close()
+
+    phased_ht = hl.Table.parallelize(rows, schema=row_type, key=list(variants_ht.key.dtype))
+    return phased_ht, n_phased
+
+
+def _pair_key_tuple(pair: hl.Struct) -> Tuple:
+    return pair.locus1, tuple(pair.alleles1), pair.locus2, tuple(pair.alleles2)
+
+
+def get_phased_ht_small_query(
+        query_pairs: List[hl.Struct],
+        key_type: hl.tstruct,
+        bloom_path: str = None,
+        phased_vp_path: str = phased_vp_count_ht_path('exomes')
+) -> Tuple[hl.Table, hl.Table, int]:
+    """
+    Looks up the phase of a small number of variant pairs, reading only the partitions of the phased VP table
+    that contain their first variant and without any shuffle.
+
+    :param list of Struct query_pairs: Variant pairs (with locus1, alleles1, locus2, alleles2 fields)
+    :param tstruct key_type: Type of the variant pairs
+    :param str bloom_path: Optional Bloom filter of the phased VP table keys (see `vp_bloom.py`)
+    :param str phased_vp_path: Phased VP table path
+    :return: Phased pairs (one row per pair and pop), pairs not found in the phased VP table and the number of pairs found
+    :rtype: (Table, Table, int)
+    """
+    key = list(key_type)
+    # Pairs with a missing locus (failed liftover) can't be phased and go straight to the unphased pairs
+    candidates = [p for p in query_pairs if p.locus1 is not None and p.locus2 is not None]
+    if bloom_path is not None and hl.hadoop_exists(bloom_path):
+        bloom = VPBloomFilter.read(bloom_path)
+        candidates = [p for p, hit in zip(candidates, bloom.contains_pairs(candidates)) if hit]
+        logger.info(f"{len(candidates)}/{len(query_pairs)} variant pair(s) might be phased according to the Bloom filter {bloom_path}.")
+
+    vp_ht = hl.read_table(phased_vp_path)
+    vp_ht = hl.filter_intervals(vp_ht, [hl.Interval(p.locus1, p.locus1, includes_end=True) for p in candidates])
+    vp_ht = vp_ht.semi_join(hl.Table.parallelize(candidates, schema=key_type, key=key))
+    phased_ht = explode_phase_info(vp_ht)
+    phased_ht = phased_ht.transmute(
+        phase_info=phased_ht.phase_info.select('gt_counts', 'em')
+    ).persist()
+
+    phased_keys = {_pair_key_tuple(p) for p in phased_ht.key.collect()}
+    unphased_ht = hl.Table.parallelize(
+        [p for p in query_pairs if _pair_key_tuple(p) not in phased_keys],
+        schema=key_type,
+        key=key
+    )
+    return phased_ht, unphased_ht, len(phased_keys)
+
+
+def get_phase_table_paths(
+        reference_genome: str,
+        phase_index_path: str,
+        bloom_path: str,
+        single_variant_path: str
+) -> Tuple[str, str, str, str]:
+    """
+    Returns the tables used to look up the phase of pairs on the given reference genome.
+    Non-GRCh37 queries are looked up in the lifted-over tables directly (see `liftover_phase_tables.py`). The phase index and Bloom filter are GRCh37 only.
+
+    :param str reference_genome: Reference genome of the query pairs
+    :param str phase_index_path: GRCh37 phase index path
+    :param str bloom_path: GRCh37 Bloom filter path
+    :param str single_variant_path: GRCh37 single-variant table path
+    :return: Phased VP table, phase index, Bloom filter and single-variant table paths
+    :rtype: (str, str, str, str)
+    """
+    if reference_genome == 'GRCh37':
+        return phased_vp_count_ht_path('exomes'), phase_index_path, bloom_path, single_variant_path
+    return (
+        phased_vp_count_ht_path('exomes', reference_genome=reference_genome),
+        None,
+        None,
+        single_variant_ht_path('exomes', reference_genome=reference_genome)
+    )
+
+
+def phase_index_is_current(phase_index_path: str, phased_vp_path: str) -> bool:
+    """
+    Returns whether the phase index exists and was exported from the current version of the phased VP table,
+    i.e. its footer records the same table path and `_SUCCESS` modification time. Logs a warning if the index is stale.
+
+    :param str phase_index_path: Phase index path
+    :param str phased_vp_path: Phased VP table path
+    :return: Whether the phase index can be used
+    :rtype: bool
+    """
+    if phase_index_path is None or not os.path.exists(phase_index_path):
+        return False
+
+    index = PhaseIndex(phase_index_path)
+    source = index.source
+    index.close()
+    if source != get_table_source(phased_vp_path):
+        logger.warning(f"Phase index {phase_index_path} wasn't exported from the current {phased_vp_path} (source: {source}). Using the phased VP table instead. Re-export it with phase_index.py --export.")
+        return False
+    return True
+
+
+def get_phase_tables_fingerprint(
+        reference_genome: str,
+        phase_index_path: str = DEFAULT_PHASE_INDEX_PATH,
+        single_variant_path: str = single_variant_ht_path()
+) -> str:
+    """
+    Returns a fingerprint of the tables `compute_phase` would use for pairs on the given reference genome,
+    based on their paths and modification times. It changes whenever one of the tables is rewritten.
+
+    :param str reference_genome: Reference genome of the query pairs
+    :param str phase_index_path: GRCh37 phase index path
+    :param str single_variant_path: GRCh37 single-variant table path
+    :return: Fingerprint
+    :rtype: str
+    """
+    phased_vp_path, phase_index_path, _, single_variant_path = get_phase_table_paths(reference_genome, phase_index_path, None, single_variant_path)
+    parts = [reference_genome]
+    if phase_index_is_current(phase_index_path, phased_vp_path):
+        parts.append(f'{phase_index_path}:{os.path.getmtime(phase_index_path)}')
+    else:
+        parts.append(f"{phased_vp_path}:{hl.hadoop_stat(f'{phased_vp_path}/_SUCCESS')['modification_time']}")
+    if single_variant_path is not None and hl.hadoop_exists(f'{single_variant_path}/_SUCCESS'):
+        parts.append(f"{single_variant_path}:{hl.hadoop_stat(f'{single_variant_path}/_SUCCESS')['modification_time']}")
+    else:
+        parts.append(gnomad.public_release('exomes').path)
+    return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+
 def compute_phase(
         variants_ht: hl.Table,
         least_consequence: str = LEAST_CONSEQUENCE,
-        max_freq: float = MAX_FREQ
+        max_freq: float = MAX_FREQ,
+        phase_index_path: str = DEFAULT_PHASE_INDEX_PATH,
+        bloom_path: str = vp_bloom_path('exomes'),
+        single_variant_path: str = single_variant_ht_path(),
+        small_query_max_pairs: int = SMALL_QUERY_MAX_PAIRS
 ) -> hl.Table:
-    n_variant_pairs = variants_ht.count()
-    logger.info(f"Looking up phase for {n_variant_pairs} variant pair(s).")
-
-    # Join with gnomad phased variants
-    vp_ht = hl.read_table(phased_vp_count_ht_path('exomes'))
-    phased_ht = vp_ht.semi_join(variants_ht)
-    n_phased = phased_ht.count()
-    phased_ht = explode_phase_info(phased_ht)  # explodes phase_info by pop
-    phased_ht = phased_ht.transmute(
-        phase_info=phased_ht.phase_info.select('gt_counts', 'em')
-    ).repartition(ceil(n_variant_pairs / 10000), shuffle=True)
-    phased_ht = phased_ht.persist()  # .checkpoint("gs://gnomad-tmp/vp_ht.ht")
+    # Queries with at most small_query_max_pairs pairs only read the relevant partitions of the phased VP table and skip shuffles and counts
+    query_pairs = variants_ht.key.take(small_query_max_pairs + 1) if small_query_max_pairs > 0 else []
+    small_query = 0 < len(query_pairs) <= small_query_max_pairs
+    n_variant_pairs = len(query_pairs) if small_query else variants_ht.count()
+    logger.info(f"Looking up phase for {n_variant_pairs} variant pair(s){' (small query)' if small_query else ''}.")
+
+    reference_genome = variants_ht.key[0].dtype.reference_genome.name
+    phased_vp_path, phase_index_path, bloom_path, single_variant_path = get_phase_table_paths(reference_genome, phase_index_path, bloom_path, single_variant_path)
+    if reference_genome != 'GRCh37':
+        logger.info(f"Using the {reference_genome} phased VP table {phased_vp_path}.")
+
+    unphased_ht = None
+    if phase_index_is_current(phase_index_path, phased_vp_path):
+        # Look up gnomad phased variants in the local phase index
+        logger.info(f"Using phase index {phase_index_path}.")
+        phased_ht, n_phased = get_phased_ht_from_phase_index(variants_ht, phase_index_path)
+        vp_ht = phased_ht = phased_ht.persist()
+    elif small_query:
+        phased_ht, unphased_ht, n_phased = get_phased_ht_small_query(query_pairs, variants_ht.key.dtype, bloom_path, phased_vp_path)
+    else:
+        # Join with gnomad phased variants
+        vp_ht = hl.read_table(phased_vp_path)
+        query_ht = variants_ht
+        if bloom_path is not None and hl.hadoop_exists(bloom_path):
+            # Only pairs that might be in the phased VP table are joined with it, and only its partitions overlapping them are read
+            query_ht = filter_with_vp_bloom(variants_ht, VPBloomFilter.read(bloom_path)).persist()
+            logger.info(f"{query_ht.count()}/{n_variant_pairs} variant pair(s) might be phased according to the Bloom filter {bloom_path}.")
+            vp_ht = hl.filter_intervals(
+                vp_ht,
+                [
+                    hl.Interval(locus, locus, includes_end=True)
+                    for locus in query_ht.aggregate(hl.agg.filter(hl.is_defined(query_ht.locus1), hl.agg.collect_as_set(query_ht.locus1)))
+                ]
+            )
+        phased_ht = vp_ht.semi_join(query_ht)
+        n_phased = phased_ht.count()
+        phased_ht = explode_phase_info(phased_ht)  # explodes phase_info by pop
+        phased_ht = phased_ht.transmute(
+            phase_info=phased_ht.phase_info.select('gt_counts', 'em')
+        ).repartition(ceil(n_variant_pairs / 10000), shuffle=True)
+        phased_ht = phased_ht.persist()  # .checkpoint("gs://gnomad-tmp/vp_ht.ht")
 
     # If not all pairs had at least one carrier of both, then compute phase estimate from single variants
     logger.info(f"{n_phased}/{n_variant_pairs} variant pair(s) found with carriers of both in gnomAD.")
 
     if n_phased < n_variant_pairs:
-        unphased_ht = variants_ht.anti_join(vp_ht)
+        if unphased_ht is None:
+            unphased_ht = variants_ht.anti_join(vp_ht)
         unphased_ht = annotate_unphased_pairs(
             unphased_ht,
             n_variant_pairs,
             least_consequence,
-            max_freq
+            max_freq,
+            single_variant_path,
+            small_query
         )
         phased_ht = phased_ht.union(
             unphased_ht,
@@ -385,12 +614,128 @@ def compute_phase(
     return phased_ht
 
 
+def _pair_key_str(pair: hl.Struct) -> str:
+    return f"{pair.locus1.contig}:{pair.locus1.position}:{':'.join(pair.alleles1)},{pair.locus2.contig}:{pair.locus2.position}:{':'.join(pair.alleles2)}"
+
+
+def compute_phase_cached(
+        variants_ht: hl.Table,
+        result_cache_path: str = DEFAULT_PHASE_RESULT_CACHE_PATH,
+        max_cached_pairs: int = DEFAULT_MAX_PAIRS,
+        max_query_pairs: int = DEFAULT_MAX_QUERY_PAIRS,
+        least_consequence: str = LEAST_CONSEQUENCE,
+        max_freq: float = MAX_FREQ,
+        phase_index_path: str = DEFAULT_PHASE_INDEX_PATH,
+        bloom_path: str = vp_bloom_path('exomes'),
+        single_variant_path: str = single_variant_ht_path(),
+        small_query_max_pairs: int = SMALL_QUERY_MAX_PAIRS
+) -> hl.Table:
+    """
+    Same as `compute_phase`, but pairs already computed with the same tables, least_consequence and max_freq
+    are served from the local result cache (see `phase_result_cache.py`), and only the other pairs are computed.
+    The results of these pairs are then added to the cache.
+
+    Since cached and computed rows go through the driver, the cache is only used for queries with at most
+    `max_query_pairs` pairs. Larger queries are computed with `compute_phase` directly.
+
+    :param Table variants_ht: Pairs to phase, keyed by locus1, alleles1, locus2, alleles2
+    :param str result_cache_path: Result cache path (local)
+    :param int max_cached_pairs: Maximum number of pairs kept in the result cache
+    :param int max_query_pairs: Maximum number of pairs in a query for the result cache to be used
+    :return: Same table as `compute_phase`
+    :rtype: Table
+    """
+    query_pairs = variants_ht.key.take(max_query_pairs + 1)
+    if len(query_pairs) > max_query_pairs:
+        logger.info(f"More than {max_query_pairs} variant pairs queried: not using the phase result cache.")
+        return compute_phase(variants_ht, least_consequence, max_freq, phase_index_path, bloom_path, single_variant_path, small_query_max_pairs)
+
+    reference_genome = variants_ht.key[0].dtype.reference_genome.name
+    fingerprint = get_phase_tables_fingerprint(reference_genome, phase_index_path, single_variant_path)
+    key_type = variants_ht.key.dtype
+    key = list(key_type)
+
+    with PhaseResultCache(result_cache_path, max_cached_pairs) as cache:
+        cache.set_fingerprint(reference_genome, fingerprint)
+
+        # Pairs with missing loci (e.g. failed liftover) are never cached
+        pairs = {}
+        uncacheable = []
+        for pair in query_pairs:
+            if pair.locus1 is None or pair.locus2 is None:
+                uncacheable.append(pair)
+            else:
+                pairs[_pair_key_str(pair)] = pair
+        results = cache.get(pairs, fingerprint, least_consequence, max_freq)
+        row_type = cache.get_row_type(reference_genome)
+        misses = [pair for k, pair in pairs.items() if k not in results] + uncacheable
+        logger.info(f"Phase result cache: {len(results)}/{len(pairs) + len(uncacheable)} variant pair(s) found.")
+
+        if misses or row_type is None:
+            phased_ht = compute_phase(
+                hl.Table.parallelize(misses, schema=key_type, key=key),
+                least_consequence,
+                max_freq,
+                phase_index_path,
+                bloom_path,
+                single_variant_path,
+                small_query_max_pairs
+            )
+            row_type = phased_ht.row.dtype
+            new_results = {k: [] for k, pair in pairs.items() if k not in results}
+            uncacheable_rows = []
+            for row in phased_ht.collect():
+                if row.locus1 is None or row.locus2 is None:
+                    uncacheable_rows.append(row_type._convert_to_json_na(row))
+                else:
+                    new_results.setdefault(_pair_key_str(row), []).append(row_type._convert_to_json_na(row))
+
+            cache.set_row_type(reference_genome, str(row_type))
+            cache.put(new_results, fingerprint, least_consequence, max_freq)
+            results.update(new_results)
+            results[None] = uncacheable_rows
+        else:
+            row_type = hl.dtype(row_type)
+
+    # Parallelizing with the key sorts the cached and new rows together
+    return hl.Table.parallelize(
+        [row_type._convert_from_json_na(row) for rows in results.values() for row in rows],
+        schema=row_type,
+        key=key
+    )
+
+
 def main(args):
+    if args.create_single_variant_ht:
+        create_single_variant_ht().write(single_variant_ht_path(), overwrite=args.overwrite)
+        return
+
     # Load data
-    variants_ht = read_variants_ht(args.ht) if args.ht else variants_ht_from_text(args.variants)
+    # GRCh38 variants are only lifted over if the GRCh38 phase tables weren't built
+    liftover = not grch38_phase_tables_exist()
+    if args.ht:
+        variants_ht = read_variants_ht(args.ht, args.liftover_cache, liftover)
+    elif args.pairs:
+        variants_ht = pairs_ht_from_file(args.pairs, args.reference_genome, liftover_cache_path=args.liftover_cache, liftover=liftover)
+    else:
+        variants_ht = variants_ht_from_text(args.variants, liftover)
 
     # Add phase
-    phased_ht = compute_phase(variants_ht, args.least_consequence, args.max_freq)
+    if args.result_cache:
+        phased_ht = compute_phase_cached(
+            variants_ht,
+            args.result_cache_path,
+            args.max_cached_pairs,
+            args.max_result_cache_query_pairs,
+            args.least_consequence,
+            args.max_freq,
+            args.phase_index,
+            args.bloom,
+            args.single_variant_ht,
+            args.small_query_max_pairs
+        )
+    else:
+        phased_ht = compute_phase(variants_ht, args.least_consequence, args.max_freq, args.phase_index, args.bloom, args.single_variant_ht, args.small_query_max_pairs)
 
     # Write results
     if args.out.endswith(".ht"):
@@ -405,9 +750,31 @@ if __name__ == '__main__':
     data_grp = parser.add_mutually_exclusive_group(required=True)
     data_grp.add_argument('--ht', help='HT containing variants. Needs to be keyed by locus1, alleles1, locus2, alleles2.')
     data_grp.add_argument('--variants', help='Variants to phase in format chr1:pos1:ref1:alt1,chr2:pos2:ref2:alt2. Note that chromosome needs to start with "chr" for GRCh38 variants')
+    data_grp.add_argument('--pairs', help='File with variant pairs to phase (TSV, CSV, VCF-like or one pair of variant strings per line, optionally gzipped). See pair_input.py for the supported formats. All pairs are held in driver memory before being parallelized.')
+    data_grp.add_argument('--create_single_variant_ht', help=f'Creates the slim single-variant table used to estimate the phase of pairs absent from the phased VP table at {single_variant_ht_path()}', action='store_true')
+    parser.add_argument('--reference_genome', help='Reference genome of the variants in --pairs. With auto, contigs starting with "chr" are GRCh38 and all others GRCh37. (default: auto)',
+                        choices=['auto', 'GRCh37', 'GRCh38'], default='auto')
+    parser.add_argument('--liftover_cache', help=f'Liftover cache used for GRCh38 variants in --ht or --pairs (see liftover_cache.py). (default: {liftover_cache_ht_path()})',
+                        default=liftover_cache_ht_path())
+    parser.add_argument('--single_variant_ht', help=f'Slim single-variant table (see --create_single_variant_ht). If it doesn\'t exist, the gnomAD release is used instead. Only used for GRCh37 queries. (default: {single_variant_ht_path()})',
+                        default=single_variant_ht_path())
     parser.add_argument('--least_consequence', help=f'Includes all variants for which the worst_consequence is at least as bad as the specified consequence. The order is taken from gnomad_hail.constants. (default: {LEAST_CONSEQUENCE})',
                         default=LEAST_CONSEQUENCE)
     parser.add_argument('--max_freq', help=f'If specified, maximum global adj AF for genotypes table to emit. (default: {MAX_FREQ:.3f})', default=MAX_FREQ, type=float)
+    parser.add_argument('--phase_index', help=f'Phase index file (see phase_index.py). If it exists and was exported from the current phased VP table, phase is looked up in it instead of the phased VP table. Only used for GRCh37 queries. (default: {DEFAULT_PHASE_INDEX_PATH})',
+                        default=DEFAULT_PHASE_INDEX_PATH)
+    parser.add_argument('--bloom', help=f'Bloom filter of the phased VP table keys (see vp_bloom.py). If it exists, only pairs that might be phased are joined with the phased VP table. Only used for GRCh37 queries. (default: {vp_bloom_path("exomes")})',
+                        default=vp_bloom_path('exomes'))
+    parser.add_argument('--small_query_max_pairs', help=f'Queries with at most this many pairs only read the partitions of the phased VP table containing them, and skip shuffles and counts. Set to 0 to disable. (default: {SMALL_QUERY_MAX_PAIRS})',
+                        default=SMALL_QUERY_MAX_PAIRS, type=int)
+    parser.add_argument('--result_cache', help='Uses the local cache of phase results: pairs already computed with the same tables, --least_consequence and --max_freq are served from it. Only used for queries with at most --max_result_cache_query_pairs pairs.',
+                        action='store_true')
+    parser.add_argument('--result_cache_path', help=f'Path of the local cache of phase results (default: {DEFAULT_PHASE_RESULT_CACHE_PATH})',
+                        default=DEFAULT_PHASE_RESULT_CACHE_PATH)
+    parser.add_argument('--max_cached_pairs', help=f'Maximum number of pairs kept in the result cache. The least recently used pairs are evicted first. (default: {DEFAULT_MAX_PAIRS})',
+                        default=DEFAULT_MAX_PAIRS, type=int)
+    parser.add_argument('--max_result_cache_query_pairs', help=f'Queries with more pairs are computed without the result cache, since cached and computed rows go through the driver. (default: {DEFAULT_MAX_QUERY_PAIRS})',
+                        default=DEFAULT_MAX_QUERY_PAIRS, type=int)
     parser.add_argument('--out', help="Output file path. Output file format depends on extension (.ht, .tsv or .tsv.gz)")
     parser.add_argument('--slack_channel', help='Slack channel to post results and notifications to.')
     parser.add_argument('--overwrite', help='Overwrite all data from this subset (default: False)', action='store_true')
@@ -3,9 +3,8 @@ import hail as hl
 from typing import List, Union
 import argparse
 from resources import *
-
-CHET_THRESHOLD = 0.505
-SAME_HAP_THRESHOLD = 0.0164
+from phasing import CHET_THRESHOLD, SAME_HAP_THRESHOLD
+from chet_utils import annotate_vp_with_variant_ann
 
 CSQ_CODES = [
     'lof',
@@ -60,15 +59,28 @@ def get_worst_gene_csq_code_expr(vep_expr: hl.expr.StructExpression) -> hl.expr.
     return worst_gene_csq_expr
 
 
-def compute_from_vp_mt(chr20: bool, overwrite: bool):
+def compute_from_vp_mt(chr20: bool, overwrite: bool, use_variant_ann: bool = False):
     meta = get_gnomad_meta('exomes')
     vp_mt = hl.read_matrix_table(full_mt_path('exomes'))
     vp_mt = vp_mt.filter_cols(meta[vp_mt.col_key].release)
-    ann_ht = hl.read_table(vp_ann_ht_path('exomes'))
     phase_ht = hl.read_table(phased_vp_count_ht_path('exomes'))
 
     if chr20:
-        vp_mt, ann_ht, phase_ht = filter_to_chr20([vp_mt, ann_ht, phase_ht])
+        vp_mt, phase_ht = filter_to_chr20([vp_mt, phase_ht])
+
+    if use_variant_ann:
+        variant_ann_ht = hl.read_table(variant_ann_ht_path('exomes'))
+        if chr20:
+            variant_ann_ht = filter_to_chr20([variant_ann_ht])[0]
+        ann_ht = annotate_vp_with_variant_ann(
+            vp_mt.rows().select(),
+            variant_ann_ht,
+            ['snv', 'freq', 'popmax', 'filters', 'vep']
+        )
+    else:
+        ann_ht = hl.read_table(vp_ann_ht_path('exomes'))
+        if chr20:
+            ann_ht = filter_to_chr20([ann_ht])[0]
 
     vep1_expr = get_worst_gene_csq_code_expr(ann_ht.vep1)
     vep2_expr = get_worst_gene_csq_code_expr(ann_ht.vep2)
@@ -364,7 +376,7 @@ def compute_from_full_mt(chr20: bool, overwrite: bool):
 def main(args):
     hl.init(log="/tmp/hail.log")
     if args.compute_from_vp_mt:
-        compute_from_vp_mt(args.chr20, args.overwrite)
+        compute_from_vp_mt(args.chr20, args.overwrite, args.use_variant_ann)
     if args.compute_from_full_mt:
         compute_from_full_mt(args.chr20, args.overwrite)
 
@@ -373,6 +385,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--compute_from_vp_mt', help='Overwrite all data from this subset (default: False)', action='store_true')
     parser.add_argument('--compute_from_full_mt', help='Overwrite all data from this subset (default: False)', action='store_true')
+    parser.add_argument('--use_variant_ann', help='If set, --compute_from_vp_mt annotates the pairs from the per-variant annotation HT rather than the VP annotation HT.', action='store_true')
     parser.add_argument('--chr20', help='Computes on chrom20 only', action='store_true')
     parser.add_argument('--overwrite', help='Overwrite all data from this subset (default: False)', action='store_true')
 
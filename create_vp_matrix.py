@@ -5,11 +5,25 @@ from gnomad_qc.v2.resources import annotations_ht_path, pbt_phased_trios_mt_path
 from gnomad.resources.grch37 import lcr_intervals, decoy_intervals, seg_dup_intervals
 import argparse
 import logging
-from typing import List
-from chet_utils import vep_genes_expr
+import random
+from typing import Callable, Dict, List
+from chet_utils import vep_genes_expr, annotate_vp_with_variant_ann
+from interval_index import get_gnomad_intervals_expr
 
 logger = logging.getLogger("create_vp_matrix")
 
+MAX_PAIRS_PER_BLOCK = 5000000
+
+# Partitioning used when no plan is available (see `--plan`)
+DEFAULT_N_PARTITIONS = hl.Struct(pre_vp_list=11000, full_vp=10000, vp_summary=1000)
+
+# Rough on-disk sizes used by the planner
+TARGET_PARTITION_BYTES = 128 * 1024 * 1024
+PRE_VP_LIST_ENTRY_BYTES = 4  # Non-ref entries of the filtered MT
+VP_LIST_ROW_BYTES = 40  # Locus and alleles of both variants
+FULL_VP_ENTRY_BYTES = 4  # GT, missing and adj of both variants, mostly missing
+VP_SUMMARY_ROW_BYTES = 1500  # raw and adj GT counts for each pop
+
 
 def _get_ordered_vp_struct(v1: hl.expr.StructExpression, v2: hl.expr.StructExpression):
     return hl.if_else(
@@ -29,7 +43,213 @@ def _get_ordered_vp_struct(v1: hl.expr.StructExpression, v2: hl.expr.StructExpre
     )
 
 
-def create_variant_pair_ht2(mt: hl.MatrixTable, row_groups: List[str]):
+def get_vp_skew_plan_ht(mt: hl.MatrixTable, row_groups: List[str], max_pairs_per_block: int = MAX_PAIRS_PER_BLOCK) -> hl.Table:
+    """
+    Estimates the number of variant-pairs in each row group as the sum over samples of C(k, 2),
+    where k is the number of non-ref variants carried by the sample in the row group.
+    Row groups with more than `max_pairs_per_block` estimated pairs are split into `n_blocks` blocks of variants,
+    so that each pair of blocks holds at most ~`max_pairs_per_block` pairs.
+
+    :param MatrixTable mt: Input MatrixTable, with entries filtered to non-ref genotypes
+    :param list of str row_groups: Row annotations for delimiting variant-pairs territory
+    :param int max_pairs_per_block: Maximum number of estimated pairs for a pair of blocks
+    :return: Table keyed by `row_groups` with the contig, number of variants, non-ref entries, estimated pairs and blocks for each row group
+    :rtype: Table
+    """
+    mt = mt.select_cols().select_rows(*row_groups)
+    mt = mt.select_entries(x=True)
+    gmt = mt.group_rows_by(*row_groups).aggregate_rows(
+        contig=hl.agg.take(mt.locus.contig, 1)[0],
+        n_variants=hl.agg.count()
+    ).aggregate_entries(
+        k=hl.agg.count_where(hl.is_defined(mt.x))
+    ).result()
+
+    ht = gmt.annotate_rows(
+        n_entries=hl.agg.sum(gmt.k),
+        n_pairs=hl.agg.sum(gmt.k * (gmt.k - 1) // 2)
+    ).rows()
+
+    # Splitting the variants in B blocks yields B * (B + 1) / 2 pairs of blocks
+    return ht.annotate(
+        n_blocks=hl.min(
+            hl.max(hl.int32(hl.ceil(hl.sqrt(2 * ht.n_pairs / max_pairs_per_block))), 1),
+            hl.int32(ht.n_variants)
+        )
+    )
+
+
+def log_vp_skew_report(skew_plan_ht: hl.Table, n_top: int = 10) -> None:
+    """
+    Logs the distribution of the estimated number of variant-pairs across row groups.
+
+    :param Table skew_plan_ht: Output of `get_vp_skew_plan_ht`
+    :param int n_top: Number of the largest row groups to report
+    :return: Nothing
+    :rtype: None
+    """
+    stats = skew_plan_ht.aggregate(
+        hl.struct(
+            n_groups=hl.agg.count(),
+            n_pairs=hl.agg.sum(skew_plan_ht.n_pairs),
+            pairs_stats=hl.agg.stats(skew_plan_ht.n_pairs),
+            n_split=hl.agg.count_where(skew_plan_ht.n_blocks > 1),
+            n_split_pairs=hl.agg.sum(hl.or_else(hl.or_missing(skew_plan_ht.n_blocks > 1, skew_plan_ht.n_pairs), 0)),
+            top=hl.agg.take(skew_plan_ht.row, n_top, ordering=-skew_plan_ht.n_pairs)
+        )
+    )
+    logger.info(f"Estimated {stats.n_pairs} variant-pairs in {stats.n_groups} row groups (mean: {stats.pairs_stats.mean:.1f}, max: {stats.pairs_stats.max:.0f}).")
+    logger.info(f"{stats.n_split} row groups, containing {stats.n_split_pairs / max(stats.n_pairs, 1):.1%} of all pairs, are split into blocks.")
+    for row in stats.top:
+        logger.info(f"{', '.join(str(row[k]) for k in skew_plan_ht.key)}: {row.n_variants} variants, {row.n_pairs} pairs ({row.n_pairs / max(stats.n_pairs, 1):.2%}), {row.n_blocks} blocks")
+
+
+def get_vp_cost_plan_ht(mt: hl.MatrixTable, partitions_fraction: float = 0.01, seed: int = 42) -> hl.Table:
+    """
+    Estimates the cost of the VP pipeline from a random sample of the partitions of the filtered MT (output of `filter_freq_and_csq`).
+    For each gene, the number of pairs is estimated as in `get_vp_skew_plan_ht`. This counts each pair once for each sample carrying it,
+    so the number of distinct pairs is estimated as min(C(n_variants, 2), n_pairs).
+    The number of pair-entries (rows x columns of the full VP MT) and output bytes are derived from the number of distinct pairs.
+
+    The returned table contains the estimates for each gene found in the sampled partitions.
+    Its globals contain the estimates for each chromosome and the whole dataset, scaled to all partitions,
+    as well as the suggested number of partitions for each step of the pipeline (`n_partitions`).
+
+    :param MatrixTable mt: Filtered MT with entries filtered to non-ref genotypes
+    :param float partitions_fraction: Fraction of the partitions to sample
+    :param int seed: Random seed used to sample partitions
+    :return: Plan Table keyed by gene_id
+    :rtype: Table
+    """
+    n_samples = mt.count_cols()
+    n_partitions = mt.n_partitions()
+    sampled_partitions = sorted(random.Random(seed).sample(range(n_partitions), max(1, round(n_partitions * partitions_fraction))))
+    scale = n_partitions / len(sampled_partitions)
+    logger.info(f"Planning from {len(sampled_partitions)} out of {n_partitions} partitions ({n_samples} samples).")
+
+    ht = get_vp_skew_plan_ht(mt._filter_partitions(sampled_partitions), ['gene_id'])
+    ht = ht.annotate(n_distinct_pairs=hl.min(ht.n_variants * (ht.n_variants - 1) // 2, ht.n_pairs))
+    ht = ht.annotate(n_pair_entries=ht.n_distinct_pairs * n_samples)
+    ht = ht.annotate(
+        pre_vp_list_bytes=ht.n_entries * PRE_VP_LIST_ENTRY_BYTES,
+        vp_list_bytes=ht.n_distinct_pairs * VP_LIST_ROW_BYTES,
+        full_vp_bytes=ht.n_pair_entries * FULL_VP_ENTRY_BYTES,
+        vp_summary_bytes=ht.n_distinct_pairs * VP_SUMMARY_ROW_BYTES
+    )
+    ht = ht.checkpoint('gs://gnomad-tmp/compound_hets/vp_plan.ht', overwrite=True)
+
+    total_fields = ['n_variants', 'n_entries', 'n_pairs', 'n_distinct_pairs', 'n_pair_entries', 'pre_vp_list_bytes', 'vp_list_bytes', 'full_vp_bytes', 'vp_summary_bytes']
+
+    def get_totals_expr():
+        return hl.struct(
+            n_genes=hl.int64(hl.agg.count() * scale),
+            **{f: hl.int64(hl.agg.sum(ht[f]) * scale) for f in total_fields}
+        )
+
+    totals_type = hl.tstruct(n_genes=hl.tint64, **{f: hl.tint64 for f in total_fields})
+
+    by_chrom, total = ht.aggregate((hl.agg.group_by(ht.contig, get_totals_expr()), get_totals_expr()))
+
+    def suggested_n_partitions(n_bytes):
+        return max(1, -(-n_bytes // TARGET_PARTITION_BYTES))
+
+    suggested_partitions = hl.Struct(
+        pre_vp_list=suggested_n_partitions(total.pre_vp_list_bytes),
+        full_vp=suggested_n_partitions(total.full_vp_bytes),
+        vp_summary=suggested_n_partitions(total.vp_summary_bytes)
+    )
+
+    for contig, c in sorted(by_chrom.items(), key=lambda x: -x[1].n_distinct_pairs):
+        logger.info(f"chrom {contig}: {c.n_genes} genes, {c.n_distinct_pairs} pairs ({c.n_pairs} carrier pairs), {c.n_pair_entries} pair-entries, {c.full_vp_bytes / 2 ** 30:.1f} GiB full VP MT")
+    logger.info(f"Total: {total.n_genes} genes, {total.n_distinct_pairs} pairs ({total.n_pairs} carrier pairs), {total.n_pair_entries} pair-entries, {total.full_vp_bytes / 2 ** 30:.1f} GiB full VP MT")
+    logger.info(f"Suggested number of partitions: {suggested_partitions}")
+
+    return ht.annotate_globals(
+        partitions_fraction=len(sampled_partitions) / n_partitions,
+        n_samples=n_samples,
+        by_chrom=hl.literal(by_chrom, hl.tdict(hl.tstr, totals_type)),
+        total=hl.literal(total, totals_type),
+        n_partitions=suggested_partitions
+    )
+
+
+def get_planned_n_partitions(plan_ht_path: str) -> hl.Struct:
+    """
+    Returns the suggested number of partitions from the plan at `plan_ht_path` if it exists, or DEFAULT_N_PARTITIONS otherwise.
+
+    :param str plan_ht_path: Path to the output of `get_vp_cost_plan_ht`
+    :return: Number of partitions for each step of the pipeline
+    :rtype: Struct
+    """
+    if hl.hadoop_exists(f'{plan_ht_path}/_SUCCESS'):
+        n_partitions = hl.eval(hl.read_table(plan_ht_path).n_partitions)
+        logger.info(f"Using number of partitions from plan {plan_ht_path}: {n_partitions}")
+        return n_partitions
+
+    logger.info(f"No plan found at {plan_ht_path}, using default number of partitions: {DEFAULT_N_PARTITIONS}")
+    return DEFAULT_N_PARTITIONS
+
+
+def _explode_vp_blocks(mt: hl.MatrixTable, row_groups: List[str], skew_plan_ht: hl.Table) -> hl.MatrixTable:
+    """
+    Assigns each variant to one of the `n_blocks` blocks of its row group (`v_block`)
+    and duplicates it for each pair of blocks it belongs to (`vp_block`).
+    Rows in row groups that aren't split get a single `vp_block` (0, 0).
+    """
+    heavy_ht = skew_plan_ht.filter(skew_plan_ht.n_blocks > 1)
+    heavy_blocks = hl.literal(
+        {hl.Struct(**{g: row[g] for g in row_groups}): row.n_blocks for row in heavy_ht.collect()},
+        hl.tdict(skew_plan_ht.key.dtype, hl.tint32)
+    )
+    n_blocks = hl.or_else(heavy_blocks.get(hl.struct(**{g: mt[g] for g in row_groups})), 1)
+    mt = mt.annotate_rows(v_block=hl.hash(hl.struct(locus=mt.locus, alleles=mt.alleles)) % n_blocks)
+    mt = mt.annotate_rows(
+        vp_block=hl.range(0, n_blocks).map(lambda j: hl.tuple([hl.min(mt.v_block, j), hl.max(mt.v_block, j)]))
+    )
+    return mt.explode_rows(mt.vp_block)
+
+
+def _get_vps_expr(
+        vgt: hl.expr.ArrayExpression,
+        vp_block: hl.expr.TupleExpression = None,
+        pair_filter: Callable[[hl.expr.StructExpression, hl.expr.StructExpression], hl.expr.BooleanExpression] = None
+) -> hl.expr.ArrayExpression:
+    """
+    Returns all ordered variant-pairs from `vgt`.
+    If `vgt` contains variant IDs (`vid`), pairs are returned as struct(id1, id2) with id1 < id2.
+    If `vp_block` is given, `vgt` contains the variants in a pair of blocks and only pairs spanning both blocks are returned
+    (unless both blocks are the same).
+    If `pair_filter` is given, only pairs for which it is true are returned.
+    """
+    def keep_pair(v1, v2):
+        keep = hl.bool(True)
+        if vp_block is not None:
+            keep = keep & ((vp_block[0] == vp_block[1]) | (v1.v_block != v2.v_block))
+        if pair_filter is not None:
+            keep = keep & pair_filter(v1, v2)
+        return keep
+
+    def get_pairs(i1):
+        i2s = hl.range(i1 + 1, hl.len(vgt))
+        if vp_block is not None or pair_filter is not None:
+            i2s = i2s.filter(lambda i2: keep_pair(vgt[i1], vgt[i2]))
+        return i2s.map(lambda i2: get_vp(vgt[i1], vgt[i2]))
+
+    def get_vp(v1, v2):
+        if 'vid' in vgt.dtype.element_type.fields:
+            return hl.struct(id1=hl.min(v1.vid, v2.vid), id2=hl.max(v1.vid, v2.vid))
+        return _get_ordered_vp_struct(v1.select('locus', 'alleles'), v2.select('locus', 'alleles'))
+
+    return hl.range(0, hl.len(vgt)).flatmap(get_pairs)
+
+
+def _key_by_vp(ht: hl.Table, vp: hl.expr.StructExpression) -> hl.Table:
+    if 'id1' in vp.dtype.fields:
+        return ht.key_by(id1=vp.id1, id2=vp.id2)
+    return ht.key_by(locus2=vp.v2.locus, alleles2=vp.v2.alleles, locus1=vp.v1.locus, alleles1=vp.v1.alleles)
+
+
+def create_variant_pair_ht2(mt: hl.MatrixTable, row_groups: List[str], skew_plan_ht: hl.Table = None):
     """
     Create a variant-pair MatrixTable containing all variant-pairs that appear both in the same individual within the row group.
     E.g., if the row group is a gene, this creates a variant-pair MT with all variant-pairs in a given gene.
@@ -38,6 +258,7 @@ def create_variant_pair_ht2(mt: hl.MatrixTable, row_groups: List[str]):
 
     :param MatrixTable mt: Input MatrixTable
     :param list of str row_groups: Row annotations for delimiting variant-pairs territory
+    :param Table skew_plan_ht: Optional output of `get_vp_skew_plan_ht`. If given, the pairs of the row groups with many pairs are computed in blocks.
     :return: Variant-pair MT
     :rtype: MatrixTable
     """
@@ -45,19 +266,23 @@ def create_variant_pair_ht2(mt: hl.MatrixTable, row_groups: List[str]):
     # mt = mt.filter_entries(mt.GT.is_non_ref())
     mt = mt.select_cols().select_rows(*row_groups)
     mt = mt.select_entries(x=True)
+    v_fields = ['locus', 'alleles']
+    if skew_plan_ht is not None:
+        mt = _explode_vp_blocks(mt, row_groups, skew_plan_ht)
+        row_groups = [*row_groups, 'vp_block']
+        v_fields.append('v_block')
+
     gmt = mt.group_rows_by(*row_groups).aggregate(
         vgt=hl.agg.filter(
             hl.is_defined(mt.x),
-            hl.agg.collect(hl.struct(locus=mt.locus, alleles=mt.alleles))
+            hl.agg.collect(hl.struct(**{k: mt[k] for k in v_fields}))
         )
     )
 
     ht = gmt.select_rows(
         vps=hl.agg.explode(
             lambda x: hl.agg.collect_as_set(x),
-            hl.range(0, hl.len(gmt.vgt))
-                .flatmap(lambda i1: hl.range(i1 + 1, hl.len(gmt.vgt))
-                         .map(lambda i2: _get_ordered_vp_struct(gmt.vgt[i1], gmt.vgt[i2])))
+            _get_vps_expr(gmt.vgt, gmt.vp_block if skew_plan_ht is not None else None)
         )
     ).rows()
 
@@ -69,7 +294,7 @@ def create_variant_pair_ht2(mt: hl.MatrixTable, row_groups: List[str]):
     return ht
 
 
-def create_variant_pair_ht(mt: hl.MatrixTable, row_groups: List[str]):
+def create_variant_pair_ht(mt: hl.MatrixTable, row_groups: List[str], skew_plan_ht: hl.Table = None, variant_dict_ht: hl.Table = None):
     """
     Create a variant-pair MatrixTable containing all variant-pairs that appear both in the same individual within the row group.
     E.g., if the row group is a gene, this creates a variant-pair MT with all variant-pairs in a given gene.
@@ -78,29 +303,148 @@ def create_variant_pair_ht(mt: hl.MatrixTable, row_groups: List[str]):
 
     :param MatrixTable mt: Input MatrixTable
     :param list of str row_groups: Row annotations for delimiting variant-pairs territory
+    :param Table skew_plan_ht: Optional output of `get_vp_skew_plan_ht`. If given, the pairs of the row groups with many pairs are computed in blocks.
+    :param Table variant_dict_ht: Optional output of `create_variant_dict_ht`. If given, the pairs are keyed by variant IDs (id1, id2) rather than by locus and alleles.
     :return: Variant-pair MT
     :rtype: MatrixTable
     """
 
     # mt = mt.filter_entries(mt.GT.is_non_ref())
-    et = mt.select_cols().select_rows(*row_groups).entries()
+    mt = mt.select_cols().select_rows(*row_groups)
+    v_fields = ['locus', 'alleles']
+    if variant_dict_ht is not None:
+        mt = mt.annotate_rows(vid=variant_dict_ht[mt.row_key].vid)
+        v_fields = ['vid']
+    if skew_plan_ht is not None:
+        mt = _explode_vp_blocks(mt, row_groups, skew_plan_ht)
+        row_groups = [*row_groups, 'vp_block']
+        v_fields.append('v_block')
+
+    et = mt.entries()
     et = et.group_by(*row_groups, *mt.col_key)._set_buffer_size(5).aggregate(
-        vgt=(hl.agg.collect(hl.struct(locus=et.locus, alleles=et.alleles)))
+        vgt=(hl.agg.collect(hl.struct(**{k: et[k] for k in v_fields})))
     )
 
     et = et.annotate(
-        vgt=hl.range(0, hl.len(et.vgt))
-                      .flatmap(lambda i1: hl.range(i1+1, hl.len(et.vgt))
-                               .map(lambda i2: _get_ordered_vp_struct(et.vgt[i1], et.vgt[i2])))
+        vgt=_get_vps_expr(et.vgt, et.vp_block if skew_plan_ht is not None else None)
     )
 
     et = et.explode(et.vgt)
-    et = et.key_by(locus2=et.vgt.v2.locus, alleles2=et.vgt.v2.alleles, locus1=et.vgt.v1.locus, alleles1=et.vgt.v1.alleles)
+    et = _key_by_vp(et, et.vgt)
     et = et.select().distinct()
 
     return et
 
 
+def _carriers_intersect_expr(carriers1: hl.expr.DictExpression, carriers2: hl.expr.DictExpression) -> hl.expr.BooleanExpression:
+    return carriers1.keys().any(
+        lambda w: hl.bit_and(carriers1[w], hl.or_else(carriers2.get(w), hl.int64(0))) != 0
+    )
+
+
+def create_variant_pair_ht_bitset(mt: hl.MatrixTable, row_groups: List[str], skew_plan_ht: hl.Table = None, variant_dict_ht: hl.Table = None):
+    """
+    Create a variant-pair MatrixTable containing all variant-pairs that appear both in the same individual within the row group.
+    E.g., if the row group is a gene, this creates a variant-pair MT with all variant-pairs in a given gene.
+
+    This produces the same output as `create_variant_pair_ht`, but rather than exploding all non-ref entries and
+    building the list of pairs for each sample, the carriers of each variant are packed into a sparse bitset
+    (64-bit words indexed by `col_idx // 64`). Within each row group, a variant-pair is then emitted iff
+    the carriers bitsets of both variants intersect.
+
+    Note that this produces an empty shell of an MT with no data in the rows, columns or entries.
+
+    :param MatrixTable mt: Input MatrixTable
+    :param list of str row_groups: Row annotations for delimiting variant-pairs territory
+    :param Table skew_plan_ht: Optional output of `get_vp_skew_plan_ht`. If given, the pairs of the row groups with many pairs are computed in blocks.
+    :param Table variant_dict_ht: Optional output of `create_variant_dict_ht`. If given, the pairs are keyed by variant IDs (id1, id2) rather than by locus and alleles.
+    :return: Variant-pair MT
+    :rtype: MatrixTable
+    """
+
+    mt = mt.select_cols().select_rows(*row_groups)
+    mt = mt.select_entries(x=True)
+    mt = mt.add_col_index('col_idx')
+
+    # Since each column sets a different bit, summing the bits is equivalent to OR-ing them
+    mt = mt.annotate_rows(
+        carriers=hl.agg.filter(
+            hl.is_defined(mt.x),
+            hl.agg.group_by(
+                mt.col_idx // 64,
+                hl.agg.sum(hl.bit_lshift(hl.int64(1), mt.col_idx % 64))
+            )
+        )
+    )
+    mt = mt.filter_rows(hl.len(mt.carriers) > 0)
+
+    v_fields = ['locus', 'alleles', 'carriers']
+    if variant_dict_ht is not None:
+        mt = mt.annotate_rows(vid=variant_dict_ht[mt.row_key].vid)
+        v_fields = ['vid', 'carriers']
+    if skew_plan_ht is not None:
+        mt = _explode_vp_blocks(mt, row_groups, skew_plan_ht)
+        row_groups = [*row_groups, 'vp_block']
+        v_fields.append('v_block')
+
+    ht = mt.rows()
+    ht = ht.group_by(*row_groups).aggregate(
+        vgt=hl.agg.collect(hl.struct(**{k: ht[k] for k in v_fields}))
+    )
+
+    ht = ht.annotate(
+        vgt=_get_vps_expr(
+            ht.vgt,
+            ht.vp_block if skew_plan_ht is not None else None,
+            lambda v1, v2: _carriers_intersect_expr(v1.carriers, v2.carriers)
+        )
+    )
+
+    ht = ht.explode(ht.vgt)
+    ht = _key_by_vp(ht, ht.vgt)
+    ht = ht.select().distinct()
+
+    return ht
+
+
+def create_variant_dict_ht(mt: hl.MatrixTable) -> hl.Table:
+    """
+    Creates a Table assigning a dense int64 ID (`vid`) to each distinct variant in `mt`.
+    IDs are assigned in genomic order, so that the table can be re-keyed by `vid` without a shuffle.
+
+    :param MatrixTable mt: Input MatrixTable (e.g. the filtered MT used to create the VP list)
+    :return: Variant dictionary Table keyed by locus and alleles
+    :rtype: Table
+    """
+    ht = mt.rows().select().distinct()
+    return ht.add_index('vid')
+
+
+def decode_variant_pair_ids(ht: hl.Table, variant_dict_ht: hl.Table) -> hl.Table:
+    """
+    Replaces the (id1, id2) variant IDs key of `ht` by the (locus1, alleles1, locus2, alleles2) key,
+    with the variants ordered as in `_get_ordered_vp_struct`.
+
+    :param Table ht: Table keyed by id1, id2
+    :param Table variant_dict_ht: Variant dictionary used to create the IDs (output of `create_variant_dict_ht`)
+    :return: Table keyed by locus1, alleles1, locus2, alleles2
+    :rtype: Table
+    """
+    variant_dict_ht = variant_dict_ht.key_by('vid')  # IDs are in genomic order, so this doesn't shuffle
+    ht = ht.annotate(
+        vp=_get_ordered_vp_struct(variant_dict_ht[ht.id1], variant_dict_ht[ht.id2])
+    )
+    ht = ht.key_by(locus1=ht.vp.v1.locus, alleles1=ht.vp.v1.alleles, locus2=ht.vp.v2.locus, alleles2=ht.vp.v2.alleles)
+    return ht.drop('vp', 'id1', 'id2')
+
+
+def _decode_if_variant_ids(ht: hl.Table, variant_dict_ht_path: str) -> hl.Table:
+    if 'id1' in ht.key.dtype.fields:
+        logger.info(f"Decoding variant IDs using {variant_dict_ht_path}")
+        return decode_variant_pair_ids(ht, hl.read_table(variant_dict_ht_path))
+    return ht
+
+
 def filter_freq_and_csq(mt: hl.MatrixTable, data_type: str, max_freq: float, least_consequence: str):
     """
     Filters MatrixTable to include variants that:
@@ -160,12 +504,24 @@ def get_counts_agg_expr(mt: hl.MatrixTable):
 def create_full_vp(
         mt: hl.MatrixTable,
         vp_list_ht: hl.Table,
-        data_type: str
+        data_type: str,
+        n_partitions: int = DEFAULT_N_PARTITIONS.full_vp,
+        variant_dict_ht: hl.Table = None
 ):
     # TODO: This implementation was causing memory challenges.
 
-    vp_list_ht = vp_list_ht.key_by('locus2', 'alleles2')
-    vp_list_ht = vp_list_ht.select(locus1=vp_list_ht.locus1, alleles1=vp_list_ht.alleles1)
+    # If the VP list is keyed by variant IDs, key the rows by ID too.
+    # IDs are in genomic order, so re-keying the rows doesn't shuffle.
+    if variant_dict_ht is not None:
+        mt = mt.annotate_rows(vid=variant_dict_ht[mt.row_key].vid)
+        mt = mt.filter_rows(hl.is_defined(mt.vid))
+        mt = mt.key_rows_by('vid').drop('locus', 'alleles')
+        v1_fields, v2_fields = ['id1'], ['id2']
+    else:
+        v1_fields, v2_fields = ['locus1', 'alleles1'], ['locus2', 'alleles2']
+
+    vp_list_ht = vp_list_ht.key_by(*v2_fields)
+    vp_list_ht = vp_list_ht.select(*v1_fields)
     vp_mt = mt.annotate_rows(v1=vp_list_ht.index(mt.row_key, all_matches=True))
     vp_mt = vp_mt.filter_rows(hl.len(vp_mt.v1) > 0)
     vp_mt = vp_mt.rename({x: f'{x}2' for x in vp_mt.entry})
@@ -174,34 +530,78 @@ def create_full_vp(
     vp_mt = vp_mt.transmute_rows(**vp_mt.v1)
     vp_mt = vp_mt.checkpoint(f'gs://gnomad-tmp/compound_hets/{data_type}_vp_mt_tmp0.mt', overwrite=True)
 
-    vp_mt = vp_mt.key_rows_by('locus1', 'alleles1')
+    vp_mt = vp_mt.key_rows_by(*v1_fields)
     vp_mt = vp_mt.checkpoint(f'gs://gnomad-tmp/compound_hets/{data_type}_vp_mt_tmp1.mt', overwrite=True)
 
     mt_joined = mt[vp_mt.row_key, vp_mt.col_key]
     vp_mt = vp_mt.annotate_entries(**{f'{x}1': mt_joined[x] for x in mt.entry})
     vp_mt = vp_mt.checkpoint(f'gs://gnomad-tmp/compound_hets/{data_type}_vp_mt_tmp2.mt', overwrite=True)
-    vp_mt = vp_mt.repartition(10000, shuffle=True)
+    vp_mt = vp_mt.repartition(n_partitions, shuffle=True)
     vp_mt = vp_mt.checkpoint(f'gs://gnomad-tmp/compound_hets/{data_type}_vp_mt_tmp3.mt', overwrite=True)
-    vp_mt = vp_mt.rename({'locus': 'locus2', 'alleles': 'alleles2'})
-    vp_mt = vp_mt.key_rows_by('locus1', 'alleles1', 'locus2', 'alleles2')
+    vp_mt = vp_mt.rename(dict(zip(mt.row_key.dtype.fields, v2_fields)))
+    vp_mt = vp_mt.key_rows_by(*v1_fields, *v2_fields)
 
     return vp_mt
 
 
-def create_vp_summary(mt: hl.MatrixTable) -> hl.Table:
-    mt = mt.select_entries('adj1', 'adj2', gt_array=get_counts_agg_expr(mt))
-    ht = mt.annotate_rows(
-        gt_counts=hl.agg.group_by(
-            mt.pop,
-            hl.struct(
-                raw=hl.agg.array_agg(lambda x: hl.agg.sum(x), mt.gt_array),
-                adj=hl.or_else(
-                    hl.agg.filter(mt.adj1 & mt.adj2, hl.agg.array_agg(lambda x: hl.agg.sum(x), mt.gt_array)),
-                    [0, 0, 0, 0, 0, 0, 0, 0, 0] # In case there are no adj entries
+def get_gt_code_expr(mt: hl.MatrixTable) -> hl.expr.Int32Expression:
+    """
+    Returns the index of the entry genotype pair in the GT counts array (3 * gt1 + gt2, where 0 is hom ref, 1 het and 2 hom var),
+    or missing if either genotype is missing. This matches the array returned by `get_counts_agg_expr`.
+
+    :param MatrixTable mt: VP MT
+    :return: GT code
+    :rtype: Int32Expression
+    """
+    def get_gt_expr(gt, missing):
+        return (
+            hl.case(missing_false=True)
+                .when(hl.is_missing(gt) & ~missing, 0)
+                .when(gt.is_het(), 1)
+                .when(gt.is_hom_var(), 2)
+                .or_missing()
+        )
+
+    return 3 * get_gt_expr(mt.GT1, mt.missing1) + get_gt_expr(mt.GT2, mt.missing2)
+
+
+def create_vp_summary(mt: hl.MatrixTable, n_partitions: int = DEFAULT_N_PARTITIONS.vp_summary, use_gt_codes: bool = False) -> hl.Table:
+    if use_gt_codes:
+        # Count a single code per entry: the GT code for non-adj entries and the GT code + 9 for adj entries
+        mt = mt.select_entries(
+            gt_code=get_gt_code_expr(mt) + 9 * hl.int32(hl.or_else(mt.adj1 & mt.adj2, False))
+        )
+        ht = mt.annotate_rows(
+            gt_counts=hl.agg.group_by(
+                mt.pop,
+                hl.agg.filter(hl.is_defined(mt.gt_code), hl.agg.counter(mt.gt_code))
+            )
+        ).rows()
+        ht = ht.annotate(
+            gt_counts=ht.gt_counts.map_values(
+                lambda counter: hl.bind(
+                    lambda adj: hl.struct(
+                        raw=hl.range(0, 9).map(lambda i: counter.get(i, 0) + adj[i]),
+                        adj=adj
+                    ),
+                    hl.range(9, 18).map(lambda i: counter.get(i, 0))
                 )
             )
         )
-    ).rows()
+    else:
+        mt = mt.select_entries('adj1', 'adj2', gt_array=get_counts_agg_expr(mt))
+        ht = mt.annotate_rows(
+            gt_counts=hl.agg.group_by(
+                mt.pop,
+                hl.struct(
+                    raw=hl.agg.array_agg(lambda x: hl.agg.sum(x), mt.gt_array),
+                    adj=hl.or_else(
+                        hl.agg.filter(mt.adj1 & mt.adj2, hl.agg.array_agg(lambda x: hl.agg.sum(x), mt.gt_array)),
+                        [0, 0, 0, 0, 0, 0, 0, 0, 0] # In case there are no adj entries
+                    )
+                )
+            )
+        ).rows()
 
     ht = ht.select(
         gt_counts=hl.bind(
@@ -222,14 +622,360 @@ def create_vp_summary(mt: hl.MatrixTable) -> hl.Table:
     )
 
     ht = ht.checkpoint(f'gs://gnomad-tmp/compound_hets/ht_sites_by_pop.ht', overwrite=True)
+    ht = ht.key_by(*mt.row_key.dtype.fields)
+    return ht.repartition(n_partitions, shuffle=False)
+
+
+def create_sparse_gt_ht(mt: hl.MatrixTable) -> hl.Table:
+    """
+    Creates a sparse genotype store: for each variant, the sorted indices of the columns with a het, hom var, missing or non-adj genotype.
+    All other columns are hom ref and adj.
+    The globals contain the key and pop of each column (`col_keys`, `col_pops`), the list of pops (`pops`)
+    and the number of samples in each pop (`pop_sizes`).
+
+    :param MatrixTable mt: Input MT with GT (missing for hom ref), missing and adj entries and pop column annotation
+    :return: Sparse genotype Table keyed by locus and alleles
+    :rtype: Table
+    """
+    mt = mt.add_col_index('col_idx')
+    cols = mt.aggregate_cols(hl.agg.collect(hl.struct(col_idx=mt.col_idx, key=mt.col_key, pop=mt.pop)))
+    cols = sorted(cols, key=lambda c: c.col_idx)
+
+    def get_col_idx_expr(entry_filter):
+        return hl.sorted(hl.agg.filter(entry_filter, hl.agg.collect(mt.col_idx)))
+
+    ht = mt.select_rows(
+        het=get_col_idx_expr(mt.GT.is_het()),
+        hom_var=get_col_idx_expr(mt.GT.is_hom_var()),
+        missing=get_col_idx_expr(mt.missing),
+        non_adj=get_col_idx_expr(~hl.or_else(mt.adj, False))
+    ).rows()
+
+    return ht.select_globals(**_get_sparse_gt_globals([c.key for c in cols], [c.pop for c in cols], mt.col_key.dtype))
+
+
+def _get_sparse_gt_globals(col_keys: List[hl.Struct], col_pops: List[str], col_key_type: hl.tstruct) -> Dict[str, hl.expr.Expression]:
+    pop_sizes = {pop: col_pops.count(pop) for pop in set(col_pops) if pop is not None}
+    return dict(
+        col_keys=hl.literal(col_keys, hl.tarray(col_key_type)),
+        col_pops=hl.literal(col_pops, hl.tarray(hl.tstr)),
+        pops=hl.literal(sorted(pop_sizes), hl.tarray(hl.tstr)),
+        pop_sizes=hl.literal(pop_sizes, hl.tdict(hl.tstr, hl.tint64))
+    )
+
+
+SPARSE_GT_FIELDS = ['het', 'hom_var', 'missing', 'non_adj']
+
+
+def merge_sparse_gt_hts(ht1: hl.Table, ht2: hl.Table) -> hl.Table:
+    """
+    Merges two sparse genotype Tables (see `create_sparse_gt_ht`) with distinct samples.
+    The columns of `ht2` are appended after those of `ht1`.
+    Variants absent from one of the Tables are considered hom ref (and adj) in all its samples.
+
+    :param Table ht1: Sparse genotype Table
+    :param Table ht2: Sparse genotype Table
+    :return: Merged sparse genotype Table
+    :rtype: Table
+    """
+    g1 = hl.eval(ht1.globals)
+    g2 = hl.eval(ht2.globals)
+    shared_samples = set(g1.col_keys).intersection(g2.col_keys)
+    if shared_samples:
+        raise ValueError(f"Sparse genotype Tables share {len(shared_samples)} sample(s), e.g. {next(iter(shared_samples))}.")
+    offset = len(g1.col_pops)
+    empty = hl.empty_array(hl.tint32)
+
+    ht = ht1.select(v1=ht1.row_value).join(ht2.select(v2=ht2.row_value).select_globals(), how='outer')
+    ht = ht.select(**{
+        f: hl.or_else(ht.v1[f], empty).extend(hl.or_else(ht.v2[f], empty).map(lambda i: i + offset))
+        for f in SPARSE_GT_FIELDS
+    })
+
+    return ht.select_globals(**_get_sparse_gt_globals(g1.col_keys + g2.col_keys, g1.col_pops + g2.col_pops, ht1.col_keys.dtype.element_type))
+
+
+def subset_sparse_gt_ht(ht: hl.Table, samples_ht: hl.Table, keep: bool = True) -> hl.Table:
+    """
+    Restricts a sparse genotype Table to the samples in `samples_ht` (or to all other samples if `keep` is False).
+    Column indices are unchanged: the removed columns stay in `col_keys`, but have no pop and are never counted.
+
+    :param Table ht: Sparse genotype Table
+    :param Table samples_ht: Table keyed by the column key of the sparse genotype Table
+    :param bool keep: Whether to keep or remove the samples in `samples_ht`
+    :return: Sparse genotype Table
+    :rtype: Table
+    """
+    g = hl.eval(ht.globals)
+    samples = set(samples_ht.aggregate(hl.agg.collect(samples_ht.key)))
+    kept = [(k in samples) == keep and p is not None for k, p in zip(g.col_keys, g.col_pops)]
+    logger.info(f"Keeping {sum(kept)} out of {len(kept)} samples in sparse genotypes.")
+    removed_idx = hl.literal({i for i, k in enumerate(kept) if not k}, hl.tset(hl.tint32))
+
+    ht = ht.annotate(**{f: ht[f].filter(lambda i: ~removed_idx.contains(i)) for f in SPARSE_GT_FIELDS})
+    return ht.select_globals(**_get_sparse_gt_globals(g.col_keys, [p if k else None for p, k in zip(g.col_pops, kept)], ht.col_keys.dtype.element_type))
+
+
+def get_sparse_gt_counts_expr(
+        v1: hl.expr.StructExpression,
+        v2: hl.expr.StructExpression,
+        sparse_gt_globals: hl.expr.StructExpression,
+        pops: List[str]
+) -> hl.expr.DictExpression:
+    """
+    Computes the GT counts of a variant-pair by pop from the sparse genotypes of both variants (see `create_sparse_gt_ht`).
+    This produces the same counts as `create_vp_summary`: only the columns carrying one of the variants (or missing for one of them)
+    are looked at, and all other columns of a pop are hom ref / hom ref.
+
+    :param StructExpression v1: Sparse genotypes of variant 1
+    :param StructExpression v2: Sparse genotypes of variant 2
+    :param StructExpression sparse_gt_globals: Globals of the sparse genotype Table
+    :param list of str pops: Pops
+    :return: Dict of pop -> struct(raw, adj) GT counts, including 'all'
+    :rtype: DictExpression
+    """
+    def get_code_expr(v, i):
+        return (
+            hl.case()
+                .when(v.missing.contains(i), hl.missing(hl.tint32))
+                .when(v.het.contains(i), 1)
+                .when(v.hom_var.contains(i), 2)
+                .default(0)
+        )
+
+    def get_counts_expr(v1, v2):
+        carriers = v1.het.union(v1.hom_var).union(v1.missing).union(v2.het).union(v2.hom_var).union(v2.missing)
+        non_adj = hl.set(v1.non_adj.extend(v2.non_adj))
+        entries = hl.array(carriers).map(
+            lambda i: hl.struct(
+                pop=sparse_gt_globals.col_pops[i],
+                code=3 * get_code_expr(v1, i) + get_code_expr(v2, i),
+                adj=~non_adj.contains(i)
+            )
+        )
+        non_adj_hom_ref_pops = hl.array(non_adj.difference(carriers)).map(lambda i: sparse_gt_globals.col_pops[i])
+
+        def get_pop_counts_expr(pop, adj):
+            pop_entries = entries.filter(lambda e: (e.pop == pop) & (e.adj if adj else True))
+            n_hom_ref = sparse_gt_globals.pop_sizes[pop] - hl.len(entries.filter(lambda e: e.pop == pop))
+            if adj:
+                n_hom_ref = n_hom_ref - hl.len(non_adj_hom_ref_pops.filter(lambda x: x == pop))
+            return hl.array([hl.int64(n_hom_ref)]).extend(
+                hl.range(1, 9).map(lambda k: hl.int64(hl.len(pop_entries.filter(lambda e: e.code == k))))
+            )
+
+        gt_counts = [hl.struct(raw=get_pop_counts_expr(pop, False), adj=get_pop_counts_expr(pop, True)) for pop in pops]
+        return hl.dict(
+            [(pop, c) for pop, c in zip(pops, gt_counts)] +
+            [('all', hl.fold(lambda i, j: hl.struct(raw=i.raw + j.raw, adj=i.adj + j.adj), gt_counts[0], gt_counts[1:]))]
+        )
+
+    # Convert the sorted arrays to sets once for all lookups
+    return hl.bind(
+        get_counts_expr,
+        v1.annotate(**{f: hl.set(v1[f]) for f in ['het', 'hom_var', 'missing']}),
+        v2.annotate(**{f: hl.set(v2[f]) for f in ['het', 'hom_var', 'missing']})
+    )
+
+
+def create_vp_summary_sparse(
+        vp_list_ht: hl.Table,
+        sparse_gt_ht: hl.Table,
+        n_partitions: int = DEFAULT_N_PARTITIONS.vp_summary,
+        missing_as_hom_ref: bool = False,
+        tmp_path: str = 'gs://gnomad-tmp/compound_hets/ht_sites_sparse_gt.ht'
+) -> hl.Table:
+    """
+    Creates the same summarised VP table as `create_vp_summary`, but directly from the VP list and the sparse genotype store,
+    without going through the full VP MT.
+
+    :param Table vp_list_ht: VP list with locus1, alleles1, locus2 and alleles2 fields
+    :param Table sparse_gt_ht: Sparse genotype Table (output of `create_sparse_gt_ht`)
+    :param int n_partitions: Number of partitions of the output
+    :param bool missing_as_hom_ref: If set, variants absent from `sparse_gt_ht` are considered hom ref in all samples. Otherwise, pairs with such variants are dropped.
+    :param str tmp_path: Path used to checkpoint the joined sparse genotypes
+    :return: Summarised VP Table
+    :rtype: Table
+    """
+    pops = hl.eval(sparse_gt_ht.pops)
+    sparse_gt_ht = sparse_gt_ht.select(*SPARSE_GT_FIELDS)
+
+    ht = vp_list_ht.key_by('locus2', 'alleles2').select('locus1', 'alleles1')
+    ht = ht.annotate(v2=sparse_gt_ht[ht.key])
+    ht = ht.key_by('locus1', 'alleles1')
+    ht = ht.annotate(v1=sparse_gt_ht[ht.key])
+    if missing_as_hom_ref:
+        hom_ref = hl.struct(**{f: hl.empty_array(hl.tint32) for f in SPARSE_GT_FIELDS})
+        ht = ht.annotate(v1=hl.or_else(ht.v1, hom_ref), v2=hl.or_else(ht.v2, hom_ref))
+    else:
+        ht = ht.filter(hl.is_defined(ht.v1) & hl.is_defined(ht.v2))
+    ht = ht.checkpoint(tmp_path, overwrite=True)
+
+    ht = ht.select(
+        'locus2',
+        'alleles2',
+        gt_counts=get_sparse_gt_counts_expr(ht.v1, ht.v2, sparse_gt_ht.index_globals(), pops)
+    )
     ht = ht.key_by('locus1', 'alleles1', 'locus2', 'alleles2')
-    return ht.repartition(1000, shuffle=False)
+    return ht.repartition(n_partitions, shuffle=False)
+
+
+def _merge_gt_counts_expr(gt_counts: hl.expr.DictExpression, delta: hl.expr.DictExpression, sign: int = 1) -> hl.expr.DictExpression:
+    zeros = hl.range(0, 9).map(lambda _: hl.int64(0))
+    no_counts = hl.struct(raw=zeros, adj=zeros)
+    return hl.dict(
+        hl.array(gt_counts.key_set().union(delta.key_set())).map(
+            lambda pop: hl.bind(
+                lambda x, d: (pop, hl.struct(raw=x.raw + sign * d.raw, adj=x.adj + sign * d.adj)),
+                gt_counts.get(pop, no_counts),
+                delta.get(pop, no_counts)
+            )
+        )
+    )
+
+
+def update_vp_summary(
+        vp_count_ht: hl.Table,
+        batch_sparse_gt_ht: hl.Table,
+        remove: bool = False,
+        new_vp_list_ht: hl.Table = None,
+        sparse_gt_ht: hl.Table = None,
+        n_partitions: int = DEFAULT_N_PARTITIONS.vp_summary
+) -> hl.Table:
+    """
+    Incrementally updates a summarised VP table (output of `create_vp_summary`) when a batch of samples is added or removed.
+    Since GT counts are sums over samples, only the counts of the batch samples are computed (from `batch_sparse_gt_ht`)
+    and added to (or subtracted from) the existing counts.
+
+    When adding samples, the pairs of `new_vp_list_ht` (pairs seen in the batch samples) that aren't in `vp_count_ht` yet
+    are counted over all samples using `sparse_gt_ht` and added to the table.
+
+    :param Table vp_count_ht: Existing summarised VP table
+    :param Table batch_sparse_gt_ht: Sparse genotypes of the batch samples (see `create_sparse_gt_ht` and `subset_sparse_gt_ht`)
+    :param bool remove: Whether the batch is removed rather than added
+    :param Table new_vp_list_ht: Optional VP list of the batch samples
+    :param Table sparse_gt_ht: Sparse genotypes of all samples after the update. Required if `new_vp_list_ht` is given.
+    :param int n_partitions: Number of partitions of the output
+    :return: Updated summarised VP table
+    :rtype: Table
+    """
+    delta_ht = create_vp_summary_sparse(
+        vp_count_ht, batch_sparse_gt_ht, n_partitions, missing_as_hom_ref=True,
+        tmp_path='gs://gnomad-tmp/compound_hets/ht_sites_sparse_gt_delta.ht'
+    )
+    ht = vp_count_ht.annotate(
+        gt_counts=_merge_gt_counts_expr(vp_count_ht.gt_counts, delta_ht[vp_count_ht.key].gt_counts, -1 if remove else 1)
+    )
+
+    if new_vp_list_ht is not None:
+        new_vp_list_ht = new_vp_list_ht.key_by('locus1', 'alleles1', 'locus2', 'alleles2')
+        new_vp_list_ht = new_vp_list_ht.anti_join(vp_count_ht)
+        new_ht = create_vp_summary_sparse(
+            new_vp_list_ht, sparse_gt_ht, n_partitions, missing_as_hom_ref=True,
+            tmp_path='gs://gnomad-tmp/compound_hets/ht_sites_sparse_gt_new.ht'
+        )
+        ht = ht.union(new_ht)
+
+    return ht
+
+
+def get_vp_variants_ht(vp_ht: hl.Table) -> hl.Table:
+    """
+    Returns the distinct variants in a VP table, keyed by locus and alleles.
+
+    :param Table vp_ht: VP table with locus1, alleles1, locus2 and alleles2 fields
+    :return: Variants table
+    :rtype: Table
+    """
+    return vp_ht.key_by(locus=vp_ht.locus1, alleles=vp_ht.alleles1).select().union(
+        vp_ht.key_by(locus=vp_ht.locus2, alleles=vp_ht.alleles2).select()
+    ).distinct()
+
+
+def _get_intervals_expr(locus: hl.expr.LocusExpression, interval_index: bool) -> hl.expr.StructExpression:
+    if interval_index:
+        return get_gnomad_intervals_expr(locus)
+
+    return hl.struct(
+        lcr=hl.is_defined(lcr_intervals.ht()[locus]),
+        decoy=hl.is_defined(decoy_intervals.ht()[locus]),
+        segdup=hl.is_defined(seg_dup_intervals.ht()[locus])
+    )
+
+
+def create_variant_ann_ht(
+        variants_ht: hl.Table,
+        data_type: str,
+        interval_index: bool = False
+) -> hl.Table:
+    """
+    Creates a per-variant table with the same freq, RF filters, CpG, VEP and interval annotations as `create_vp_ann`,
+    so that each variant is looked up once rather than once per pair it is part of.
+    Pairs can then be annotated using `chet_utils.annotate_vp_with_variant_ann`.
+
+    :param Table variants_ht: Distinct variants, keyed by locus and alleles. If it has a `vid` field (e.g. output of `create_variant_dict_ht`), it is kept.
+    :param str data_type: One of 'exomes' or 'genomes'
+    :param bool interval_index: If set, LCR, decoy and segdup membership is computed from broadcast interval indices (see `interval_index.py`) rather than interval table joins
+    :return: Variant annotation table
+    :rtype: Table
+    """
+    methyation_ht = hl.read_table(methylation_sites_ht_path())
+    freq_ht = hl.read_table(annotations_ht_path(data_type, 'frequencies'))
+    rf_ht = hl.read_table(annotations_ht_path(data_type, 'rf'))
+    vep_ht = hl.read_table(annotations_ht_path(data_type, 'vep'))
+
+    freq_meta = hl.eval(freq_ht.globals.freq_meta)
+    freq_dict = {f['pop']: i for i, f in enumerate(freq_meta[:10]) if 'pop' in f}
+    freq_dict['all'] = 0
+    freq_dict = hl.literal(freq_dict)
+
+    ht = variants_ht.select(*[f for f in ['vid'] if f in variants_ht.row_value.dtype.fields]).select_globals()
+    _freq_ht_indexed = freq_ht[ht.key]
+    return ht.annotate(
+        filters=rf_ht[ht.key].filters,
+        freq=freq_dict.map_values(lambda i: _freq_ht_indexed.freq[i]),
+        popmax=_freq_ht_indexed.popmax,
+        cpg=methyation_ht[ht.locus].MEAN > 0.6,
+        snv=hl.is_snp(ht.alleles[0], ht.alleles[1]),
+        vep=vep_ht[ht.key].vep.select(
+            'ancestral',
+            'most_severe_consequence',
+            'transcript_consequences'
+        ),
+        **_get_intervals_expr(ht.locus, interval_index)
+    )
 
 
 def create_vp_ann(
         vp_ht: hl.Table,
-        data_type
+        data_type,
+        variant_ann_ht: hl.Table = None,
+        interval_index: bool = False
 ) -> hl.Table:
+    """
+    Annotates variant-pairs with freq, RF filters, CpG, VEP and interval information for both variants.
+
+    :param Table vp_ht: VP table, keyed by locus1, alleles1, locus2, alleles2 (or by id1, id2 if `variant_ann_ht` has variant IDs)
+    :param str data_type: One of 'exomes' or 'genomes'
+    :param Table variant_ann_ht: Optional output of `create_variant_ann_ht`. If given, annotations are taken from it rather than looked up for each pair.
+    :param bool interval_index: If set, LCR, decoy and segdup membership is computed from broadcast interval indices (see `interval_index.py`) rather than interval table joins
+    :return: Annotated VP table
+    :rtype: Table
+    """
+    if variant_ann_ht is not None:
+        ht_ann = annotate_vp_with_variant_ann(vp_ht.select(), variant_ann_ht)
+        if 'id1' in ht_ann.key.dtype.fields:
+            # Pairs joined by ID are in ID order: re-order them as in the (locus1, alleles1, locus2, alleles2) key
+            fields = ['locus', 'alleles'] + [f for f in variant_ann_ht.row_value.dtype.fields if f not in ['vid', 'locus', 'alleles']]
+            vp = _get_ordered_vp_struct(
+                hl.struct(**{f: ht_ann[f'{f}1'] for f in fields}),
+                hl.struct(**{f: ht_ann[f'{f}2'] for f in fields})
+            )
+            ht_ann = ht_ann.annotate(
+                **{f'{f}1': vp.v1[f] for f in fields},
+                **{f'{f}2': vp.v2[f] for f in fields}
+            )
+        return ht_ann.key_by('locus1', 'alleles1', 'locus2', 'alleles2')
 
 
     # Annotate freq, VEP and CpG information
@@ -244,9 +990,6 @@ def create_vp_ann(
             'transcript_consequences'
         )
     )
-    lcr_ht =lcr_intervals.ht()
-    decoy_ht = decoy_intervals.ht()
-    seg_dup_ht = seg_dup_intervals.ht()
 
     freq_meta = hl.eval(freq_ht.globals.freq_meta)
     freq_dict = {f['pop']: i for i, f in enumerate(freq_meta[:10]) if 'pop' in f}
@@ -262,9 +1005,7 @@ def create_vp_ann(
         cpg2=methyation_ht[ht_ann.locus2].MEAN > 0.6,
         snv2=hl.is_snp(ht_ann.alleles2[0], ht_ann.alleles2[1]),
         vep2=vep_ht[ht_ann.key].vep,
-        lcr2=hl.is_defined(lcr_ht[ht_ann.locus2]),
-        decoy2=hl.is_defined(decoy_ht[ht_ann.locus2]),
-        segdup2=hl.is_defined(seg_dup_ht[ht_ann.locus2])
+        **{f'{k}2': v for k, v in _get_intervals_expr(ht_ann.locus2, interval_index).items()}
     )
     ht_ann = ht_ann.checkpoint(f'gs://gnomad-tmp/compound_hets/{data_type}_ann2.ht', overwrite=True)
     ht_ann = ht_ann.key_by('locus1', 'alleles1')
@@ -276,9 +1017,7 @@ def create_vp_ann(
         cpg1=methyation_ht[ht_ann.locus1].MEAN > 0.6,
         snv1=hl.is_snp(ht_ann.alleles1[0], ht_ann.alleles1[1]),
         vep1=vep_ht[ht_ann.key].vep,
-        lcr1=hl.is_defined(lcr_ht[ht_ann.locus1]),
-        decoy1=hl.is_defined(decoy_ht[ht_ann.locus1]),
-        segdup1=hl.is_defined(seg_dup_ht[ht_ann.locus1])
+        **{f'{k}1': v for k, v in _get_intervals_expr(ht_ann.locus1, interval_index).items()}
     )
     return ht_ann.key_by('locus1', 'alleles1', 'locus2', 'alleles2')
 
@@ -338,6 +1077,7 @@ def create_pbt_summary(data_type, path_args, args):
 
     # pbt = pbt.filter(pbt.phase_by_pop['all'].raw.n_same_hap + pbt.phase_by_pop['all'].raw.n_chet > 0) # I think that's not needed
     pbt = pbt.filter(hl.len(pbt.phase_by_pop)>0)
+    pbt = _decode_if_variant_ids(pbt, variant_dict_ht_path(data_type, True, args.least_consequence, args.max_freq, args.chrom))
     pbt = pbt.repartition(1000, shuffle=False)
     pbt.write(pbt_phase_count_ht_path(*path_args), overwrite=args.overwrite)
 
@@ -414,11 +1154,83 @@ def create_pbt_trio_ht(data_type, args):
     tm = hl.read_matrix_table(pbt_trio_mt_path(data_type, True, args.least_consequence, args.max_freq, args.chrom))
     et = tm.entries()
     et = et.filter(hl.is_defined(et.chet))
+    et = _decode_if_variant_ids(et, variant_dict_ht_path(data_type, True, args.least_consequence, args.max_freq, args.chrom))
     et = et.flatten()
 
     et.write(pbt_trio_et_path(data_type, True, args.least_consequence, args.max_freq, args.chrom), overwrite=args.overwrite)
 
 
+def get_vp_list_input_mt(data_type: str, pbt: bool, least_consequence: str, max_freq: float, chrom: str = None) -> hl.MatrixTable:
+    """
+    Returns the MT used to create the VP list: non-ref entries of high quality samples (or PBT probands),
+    filtered using `filter_freq_and_csq` and with rows exploded by gene.
+
+    :param str data_type: One of 'exomes' or 'genomes'
+    :param bool pbt: Whether to use PBT data
+    :param str least_consequence: Least consequence to keep
+    :param float max_freq: Max. AF to keep
+    :param str chrom: Optional chromosome to filter to
+    :return: Filtered MT
+    :rtype: MatrixTable
+    """
+    if pbt:
+        mt = get_pbt_mt(data_type)
+    else:
+        mt = get_gnomad_data(data_type)
+        mt = mt.filter_cols(mt.meta.high_quality)
+
+    mt = mt.select_cols().select_rows()
+    mt = mt.filter_entries(mt.GT.is_non_ref())
+    mt = mt.select_entries()
+
+    if not pbt:
+        mt = mt.filter_cols(get_gnomad_meta('exomes')[mt.col_key].high_quality)
+
+    if chrom:
+        print(f"Selecting chrom {chrom}")
+        mt = hl.filter_intervals(mt, [hl.parse_locus_interval(chrom)])
+
+    return filter_freq_and_csq(mt, data_type, max_freq, least_consequence)
+
+
+def read_vp_list_ht(data_type: str, pbt: bool, least_consequence: str, max_freq: float, chrom: str = None, variant_ids: bool = False) -> hl.Table:
+    """
+    Reads the VP list, decoding the variant IDs if it was created with --variant_ids.
+
+    :param str data_type: One of 'exomes' or 'genomes'
+    :param bool pbt: Whether to read the PBT VP list
+    :param str least_consequence: Least consequence used to create the VP list
+    :param float max_freq: Max. AF used to create the VP list
+    :param str chrom: Optional chromosome
+    :param bool variant_ids: Whether the VP list is keyed by variant IDs
+    :return: VP list with locus1, alleles1, locus2 and alleles2 fields
+    :rtype: Table
+    """
+    path_args = [data_type, pbt, least_consequence, max_freq, chrom]
+    if variant_ids:
+        return decode_variant_pair_ids(hl.read_table(vp_id_list_ht_path(*path_args)), hl.read_table(variant_dict_ht_path(*path_args)))
+    return hl.read_table(vp_list_ht_path(*path_args))
+
+
+def _get_filtered_variants_ht(data_type: str, args) -> hl.Table:
+    mt = get_vp_list_input_mt(data_type, False, args.least_consequence, args.max_freq, args.chrom)
+    mt = mt.filter_rows(hl.is_defined(mt.gene_id))
+    return mt.rows().select().distinct()
+
+
+def _filter_vp_summary_samples(mt: hl.MatrixTable, data_type: str, args) -> hl.MatrixTable:
+    # Release samples only, excluding PBT samples if --pbt is specified
+    meta = get_gnomad_meta(data_type).select('pop', 'release')
+    mt = mt.annotate_cols(**meta[mt.col_key])
+    mt = mt.filter_cols(mt.release)
+
+    if args.pbt:
+        pbt_samples = hl.read_matrix_table(full_mt_path(data_type, True, args.least_consequence, args.max_freq, args.chrom)).cols().key_by('s')
+        mt = mt.filter_cols(hl.is_missing(pbt_samples[mt.col_key]))
+
+    return mt
+
+
 def get_pbt_mt(data_type) -> hl.MatrixTable:
     mt = hl.read_matrix_table(pbt_phased_trios_mt_path(data_type))
     mt = mt.key_cols_by('s', trio_id=mt.source_trio.id)
@@ -434,46 +1246,53 @@ def main(args):
     data_type = 'exomes' if args.exomes else 'genomes'
     path_args = [data_type, args.pbt, args.least_consequence, args.max_freq, args.chrom]
 
-    if args.create_vp_list:
-
-        if args.pbt:
-            mt = get_pbt_mt(data_type)
-        else:
-            mt = get_gnomad_data(data_type)
-            mt = mt.filter_cols(mt.meta.high_quality)
-
-        mt = mt.select_cols().select_rows()
-        mt = mt.filter_entries(mt.GT.is_non_ref())
-        mt = mt.select_entries()
+    if args.plan:
+        logger.info("Planning VP pipeline")
+        mt = get_vp_list_input_mt(data_type, args.pbt, args.least_consequence, args.max_freq, args.chrom)
+        mt = mt.filter_rows(hl.is_defined(mt.gene_id))
+        plan_ht = get_vp_cost_plan_ht(mt, args.plan_partitions_fraction)
+        plan_ht.write(vp_plan_ht_path(*path_args), overwrite=args.overwrite)
 
-        if not args.pbt:
-            mt = mt.filter_cols(get_gnomad_meta('exomes')[mt.col_key].high_quality)
+    n_partitions = get_planned_n_partitions(vp_plan_ht_path(*path_args))
 
-        if args.chrom:
-            print(f"Selecting chrom {args.chrom}")
-            mt = hl.filter_intervals(mt, [hl.parse_locus_interval(args.chrom)])
+    if args.create_vp_list:
 
-        mt = filter_freq_and_csq(mt, data_type, args.max_freq, args.least_consequence)
+        mt = get_vp_list_input_mt(data_type, args.pbt, args.least_consequence, args.max_freq, args.chrom)
         mt = mt.checkpoint('gs://gnomad-tmp/pre_vp_ht2.mt', overwrite=True)
         mt = mt.filter_rows(hl.is_defined(mt.gene_id))
-        mt = mt.repartition(11000)
+        mt = mt.repartition(n_partitions.pre_vp_list)
         mt = mt.checkpoint('gs://gnomad-tmp/pre_vp_ht_rep.mt', overwrite=True)
 
+        create_variant_pair_ht_fun = create_variant_pair_ht_bitset if args.vp_list_method == 'bitset' else create_variant_pair_ht
+        out_path_fun = vp_id_list_ht_path if args.variant_ids else vp_list_ht_path
+
+        variant_dict_ht = None
+        if args.variant_ids:
+            logger.info("Creating variant dictionary")
+            variant_dict_ht = create_variant_dict_ht(mt).checkpoint(variant_dict_ht_path(*path_args[:-1]), overwrite=args.overwrite, _read_if_exists=not args.overwrite)
+
+        skew_plan_ht = None
+        if args.skew_aware:
+            logger.info("Computing variant-pairs skew plan")
+            skew_plan_ht = get_vp_skew_plan_ht(mt, ['gene_id'], args.max_pairs_per_block)
+            skew_plan_ht = skew_plan_ht.checkpoint('gs://gnomad-tmp/compound_hets/vp_skew_plan.ht', overwrite=True)
+            log_vp_skew_report(skew_plan_ht)
+
         if args.vp_list_by_chrom:
             chroms = [str(x) for x in range(1,23)] + ['X']
             for chrom in chroms:
                 logger.info(f"Now writing VP list HT for chrom {chrom}")
 
                 c_mt = hl.filter_intervals(mt, [hl.parse_locus_interval(chrom)])
-                vp_ht = create_variant_pair_ht(c_mt, ['gene_id'])
-                vp_ht.write(vp_list_ht_path(*path_args[:-1], chrom=chrom), overwrite=args.overwrite)
+                vp_ht = create_variant_pair_ht_fun(c_mt, ['gene_id'], skew_plan_ht, variant_dict_ht)
+                vp_ht.write(out_path_fun(*path_args[:-1], chrom=chrom), overwrite=args.overwrite)
 
-            chrom_hts = [hl.read_table(vp_list_ht_path(*path_args[:-1], chrom=chrom)) for chrom in chroms]
+            chrom_hts = [hl.read_table(out_path_fun(*path_args[:-1], chrom=chrom)) for chrom in chroms]
             vp_ht = chrom_hts[0].union(*chrom_hts[1:])
         else:
-            vp_ht = create_variant_pair_ht(mt, ['gene_id'])
+            vp_ht = create_variant_pair_ht_fun(mt, ['gene_id'], skew_plan_ht, variant_dict_ht)
 
-        vp_ht.write(vp_list_ht_path(*path_args[:-1]), overwrite=args.overwrite)
+        vp_ht.write(out_path_fun(*path_args[:-1]), overwrite=args.overwrite)
 
     if args.create_full_vp:
         if args.pbt:
@@ -501,33 +1320,110 @@ def main(args):
             meta = get_gnomad_meta('exomes')
             mt = mt.filter_cols(meta[mt.col_key].high_quality)
 
-        logger.info(f"Reading VP list from {vp_list_ht_path(*path_args)}")
+        vp_list_path = vp_id_list_ht_path(*path_args) if args.variant_ids else vp_list_ht_path(*path_args)
+        logger.info(f"Reading VP list from {vp_list_path}")
         vp_mt = create_full_vp(
             mt,
-            vp_list_ht=hl.read_table(vp_list_ht_path(*path_args)),
-            data_type=data_type
+            vp_list_ht=hl.read_table(vp_list_path),
+            data_type=data_type,
+            n_partitions=n_partitions.full_vp,
+            variant_dict_ht=hl.read_table(variant_dict_ht_path(*path_args)) if args.variant_ids else None
         )
         vp_mt.write(full_mt_path(*path_args), overwrite=args.overwrite)
 
+    if args.create_variant_ann:
+        if args.variant_ids:
+            variants_ht = hl.read_table(variant_dict_ht_path(*path_args))
+        else:
+            variants_ht = get_vp_variants_ht(hl.read_matrix_table(full_mt_path(*path_args)).rows())
+        ht = create_variant_ann_ht(variants_ht, data_type, args.interval_index)
+        ht.write(variant_ann_ht_path(*path_args), overwrite=args.overwrite)
+
     if args.create_vp_ann:
         vp_ht = hl.read_matrix_table(full_mt_path(*path_args)).rows()
+        if args.use_variant_ann:
+            # Pairs keyed by variant IDs are decoded by the same join as the annotations
+            variant_ann_ht = hl.read_table(variant_ann_ht_path(*path_args))
+        else:
+            variant_ann_ht = None
+            vp_ht = _decode_if_variant_ids(vp_ht, variant_dict_ht_path(*path_args))
         ht_ann = create_vp_ann(
             vp_ht,
-            data_type
+            data_type,
+            variant_ann_ht,
+            args.interval_index
         )
         ht_ann.write(vp_ann_ht_path(*path_args), overwrite=args.overwrite)
 
-    if args.create_vp_summary:
-        mt = hl.read_matrix_table(full_mt_path(data_type, False, args.least_consequence, args.max_freq, args.chrom))
-        meta = get_gnomad_meta(data_type).select('pop', 'release')
-        mt = mt.annotate_cols(**meta[mt.col_key])
-        mt = mt.filter_cols(mt.release)
+    if args.create_sparse_gt:
+        mt = get_adj_missing_mt(data_type, False)
+        mt = _filter_vp_summary_samples(mt, data_type, args)
 
-        if args.pbt:
-            pbt_samples = hl.read_matrix_table(full_mt_path(data_type, True, args.least_consequence, args.max_freq, args.chrom)).cols().key_by('s')
-            mt = mt.filter_cols(hl.is_missing(pbt_samples[mt.col_key]))
+        # All variants passing the VP list filters are stored (not only those in the VP list),
+        # so that pairs created by new samples can later be counted in the existing samples (see --update_vp_summary)
+        mt = mt.semi_join_rows(_get_filtered_variants_ht(data_type, args))
+
+        ht = create_sparse_gt_ht(mt)
+        ht.write(sparse_gt_ht_path(*path_args), overwrite=args.overwrite)
+
+    if args.update_vp_summary:
+        batch_samples_ht = hl.import_table(args.batch_samples, no_header=True)
+        batch_samples_ht = batch_samples_ht.key_by(s=batch_samples_ht.f0).select()
+        vp_count_ht = hl.read_table(vp_count_ht_path(*path_args))
+        sparse_gt_ht = hl.read_table(sparse_gt_ht_path(*path_args))
+
+        if args.remove_batch:
+            logger.info("Removing sample batch from VP summary")
+            batch_sparse_gt_ht = subset_sparse_gt_ht(sparse_gt_ht, batch_samples_ht)
+            updated_sparse_gt_ht = subset_sparse_gt_ht(sparse_gt_ht, batch_samples_ht, keep=False)
+            ht = update_vp_summary(vp_count_ht, batch_sparse_gt_ht, remove=True, n_partitions=n_partitions.vp_summary)
+        else:
+            logger.info("Adding sample batch to VP summary")
+            # Like the summaries, only release samples are counted
+            batch_samples_ht = batch_samples_ht.filter(hl.or_else(get_gnomad_meta(data_type)[batch_samples_ht.key].release, False))
+            # Samples already in the store (including removed ones) would be counted twice
+            existing_samples = set(batch_samples_ht.key.collect()).intersection(hl.eval(sparse_gt_ht.col_keys))
+            if existing_samples:
+                raise ValueError(f"{len(existing_samples)} batch sample(s) are already in {sparse_gt_ht_path(*path_args)}, e.g. {next(iter(existing_samples))}.")
+
+            list_mt = get_vp_list_input_mt(data_type, False, args.least_consequence, args.max_freq, args.chrom)
+            list_mt = list_mt.semi_join_cols(batch_samples_ht)
+            list_mt = list_mt.filter_rows(hl.is_defined(list_mt.gene_id))
+            new_vp_list_ht = create_variant_pair_ht(list_mt, ['gene_id'])
+            new_vp_list_ht = new_vp_list_ht.checkpoint('gs://gnomad-tmp/compound_hets/batch_vp_list.ht', overwrite=True)
+
+            mt = get_adj_missing_mt(data_type, False)
+            mt = mt.semi_join_cols(batch_samples_ht)
+            mt = _filter_vp_summary_samples(mt, data_type, args)
+            mt = mt.semi_join_rows(
+                sparse_gt_ht.select().select_globals().union(list_mt.rows().select().distinct()).distinct()
+            )
+            batch_sparse_gt_ht = create_sparse_gt_ht(mt)
+            batch_sparse_gt_ht = batch_sparse_gt_ht.checkpoint('gs://gnomad-tmp/compound_hets/batch_sparse_gt.ht', overwrite=True)
+
+            updated_sparse_gt_ht = merge_sparse_gt_hts(sparse_gt_ht, batch_sparse_gt_ht)
+            ht = update_vp_summary(
+                vp_count_ht, batch_sparse_gt_ht,
+                new_vp_list_ht=new_vp_list_ht,
+                sparse_gt_ht=updated_sparse_gt_ht,
+                n_partitions=n_partitions.vp_summary
+            )
+
+        # The inputs are overwritten, so the outputs are checkpointed first
+        updated_sparse_gt_ht = updated_sparse_gt_ht.checkpoint('gs://gnomad-tmp/compound_hets/updated_sparse_gt.ht', overwrite=True)
+        ht = ht.checkpoint('gs://gnomad-tmp/compound_hets/updated_vp_counts.ht', overwrite=True)
+        updated_sparse_gt_ht.write(sparse_gt_ht_path(*path_args), overwrite=True)
+        ht.write(vp_count_ht_path(*path_args), overwrite=True)
 
-        ht = create_vp_summary(mt)
+    if args.create_vp_summary:
+        if args.sparse:
+            vp_list_ht = read_vp_list_ht(data_type, False, args.least_consequence, args.max_freq, args.chrom, args.variant_ids)
+            ht = create_vp_summary_sparse(vp_list_ht, hl.read_table(sparse_gt_ht_path(*path_args)), n_partitions.vp_summary)
+        else:
+            mt = hl.read_matrix_table(full_mt_path(data_type, False, args.least_consequence, args.max_freq, args.chrom))
+            mt = _filter_vp_summary_samples(mt, data_type, args)
+            ht = create_vp_summary(mt, n_partitions.vp_summary, args.use_gt_codes)
+            ht = _decode_if_variant_ids(ht, variant_dict_ht_path(data_type, False, args.least_consequence, args.max_freq, args.chrom))
         ht.write(vp_count_ht_path(*path_args), overwrite=args.overwrite)
 
     if args.create_pbt_summary:
@@ -546,12 +1442,30 @@ if __name__ == '__main__':
                         action='store_true')
     parser.add_argument('--pbt', help='Runs on PBT-phased data instead of the entire gnomAD. Note that the PBT_GT will be renamed as GT',
                         action='store_true')
+    parser.add_argument('--plan', help='Estimates the number of pairs, pair-entries and output size per chromosome and gene from a sample of partitions, and writes a plan with suggested partition counts. Later steps use the plan partition counts when it exists.', action='store_true')
+    parser.add_argument('--plan_partitions_fraction', help='Fraction of partitions sampled when using --plan (default: 0.01)', default=0.01, type=float)
     parser.add_argument('--create_vp_list', help='Creates a HT containing all variant pairs but no other data.', action='store_true')
     parser.add_argument('--vp_list_by_chrom', help=f'If set, computes the VP HT by chrom first and then union them', action='store_true')
+    parser.add_argument('--vp_list_method', help='Method used to generate the VP list. entries: pairs variants within each sample from the exploded entries. bitset: intersects the per-variant carrier bitsets within each gene. (default: entries)',
+                        choices=['entries', 'bitset'], default='entries')
+    parser.add_argument('--skew_aware', help='If set, estimates the number of variant-pairs in each gene first and computes the pairs of the largest genes in blocks spread across tasks.', action='store_true')
+    parser.add_argument('--max_pairs_per_block', help=f'Maximum number of estimated variant-pairs per block when using --skew_aware (default: {MAX_PAIRS_PER_BLOCK})', default=MAX_PAIRS_PER_BLOCK, type=int)
+    parser.add_argument('--variant_ids', help='If set, --create_vp_list creates a variant dictionary and keys the VP list by integer variant IDs, and --create_full_vp uses it. Downstream tables are decoded back to locus / alleles keys when written.', action='store_true')
     parser.add_argument('--create_vp_ann', help='Creates a  HT with freq and methylation information for all variant pairs.', action='store_true')
+    parser.add_argument('--create_variant_ann', help='Creates a HT with freq, filters, VEP and methylation information for each distinct variant in the VP MT (or in the variant dictionary with --variant_ids).', action='store_true')
+    parser.add_argument('--use_variant_ann', help='If set, --create_vp_ann annotates the pairs from the variant annotation HT (see --create_variant_ann) instead of looking up each variant once per pair.', action='store_true')
+    parser.add_argument('--interval_index', help='If set, --create_variant_ann and --create_vp_ann compute LCR, decoy and segdup membership from broadcast local interval indices (see interval_index.py) instead of joining the interval tables.', action='store_true')
     parser.add_argument('--create_full_vp', help='Creates the VP MT.', action='store_true')
     parser.add_argument('--create_vp_summary', help='Creates a summarised VP table, with counts in release samples only. If --pbt is specified, then only sites present in PBT samples are used and counts exclude PBT samples.',
                         action='store_true')
+    parser.add_argument('--create_sparse_gt', help='Creates a sparse genotype HT with the indices of the het, hom var, missing and non-adj release samples for each variant passing the VP list filters (not only those in the VP list), so that --update_vp_summary can count pairs created by new samples. If --pbt is specified, PBT samples are excluded.',
+                        action='store_true')
+    parser.add_argument('--update_vp_summary', help='Incrementally adds (or removes, with --remove_batch) the samples in --batch_samples to the VP summary and sparse genotype HT, instead of recomputing them. Phase can then be updated with compute_gnomad_phase.py --update.',
+                        action='store_true')
+    parser.add_argument('--batch_samples', help='File with one sample ID per line (no header), used with --update_vp_summary.')
+    parser.add_argument('--remove_batch', help='If set, --update_vp_summary removes the batch samples instead of adding them.', action='store_true')
+    parser.add_argument('--sparse', help='If set, --create_vp_summary computes the counts from the VP list and the sparse genotype HT (see --create_sparse_gt) instead of the full VP MT.', action='store_true')
+    parser.add_argument('--use_gt_codes', help='If set, --create_vp_summary counts a single genotype-pair code per entry instead of summing count arrays.', action='store_true')
     parser.add_argument('--create_pbt_summary', help='Creates a summarised PBT table, with counts of same/diff hap in unique parents. Note that --pbt flag has no effect on this.',
                         action='store_true')
     parser.add_argument('--create_pbt_trio_ht', help='Creates a HT with one line per trio/variant-pair (where trio is non-ref). Note that --pbt flag has no effect on this.',
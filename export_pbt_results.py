@@ -3,6 +3,7 @@ from resources import *
 import hail as hl
 import logging
 import argparse
+from chet_utils import FilterFunnel
 
 logger = logging.getLogger("export_pbt_results")
 
@@ -20,31 +21,30 @@ def main(args):
         autosomes = hl.parse_locus_interval('1-22')
         ht = ht.filter(autosomes.contains(ht.locus1)) # locus1 and locus2 are always on the same contig
 
+    # The remaining filters are applied at once, and the rows remaining after each are only counted with --debug
+    funnel = FilterFunnel()
     if not args.export_filtered:
-        ht = ht.filter((hl.len(ht.filters1) == 0) & (hl.len(ht.filters2) == 0))
-        logger.debug(f'Rows remaining after keeping non-filtered variants: {ht.count()}')
+        ht = funnel.add(ht, 'keeping non-filtered variants', (hl.len(ht.filters1) == 0) & (hl.len(ht.filters2) == 0))
 
     if not args.export_raw:
-        ht = ht.filter(ht.adj1 & ht.adj2)
-        logger.debug(f'Rows remaining after keeping adj-only: {ht.count()}')
+        ht = funnel.add(ht, 'keeping adj-only', ht.adj1 & ht.adj2)
 
     if not args.export_other_pop:
-        ht = ht.filter(hl.is_defined(ht.pop) & (ht.pop != 'oth'))
-        logger.debug(f'Rows remaining after removing oth samples: {ht.count()}')
+        ht = funnel.add(ht, 'removing oth samples', hl.is_defined(ht.pop) & (ht.pop != 'oth'))
 
     pbt_vp_summary = hl.read_table(pbt_phase_count_ht_path(*path_args))
     pbt_vp_summary = pbt_vp_summary.filter(pbt_vp_summary.adj.n_same_hap + pbt_vp_summary.adj.n_chet > 0)
     indexed_pbt_vp_summary = pbt_vp_summary[ht.key]
     discordant_expr = (indexed_pbt_vp_summary.adj.n_same_hap > 0) & (indexed_pbt_vp_summary.adj.n_chet > 0)
     if args.exclude_discordant_vps:
-        ht = ht.filter(discordant_expr)
+        ht = funnel.add(ht, 'applying --exclude_discordant_vps', discordant_expr)
     else:
         ht = ht.annotate(
             trio_phase_discordant=discordant_expr
         )
 
-    ht = ht.filter((ht.pop_freq1.af <= args.max_pop_freq) & (ht.pop_freq2.af <= args.max_pop_freq))
-    logger.debug(f'Rows remiaining after removing sites with freq > {args.max_pop_freq}: {ht.count()}')
+    ht = funnel.add(ht, f'removing sites with freq > {args.max_pop_freq}', (ht.pop_freq1.af <= args.max_pop_freq) & (ht.pop_freq2.af <= args.max_pop_freq))
+    ht = funnel.apply(ht, logger, logging.DEBUG)
 
     # Annotate phase from gnomAD
     vp_ht = hl.read_table(phased_vp_count_ht_path(*path_args))
@@ -0,0 +1,266 @@
+import argparse
+import logging
+import os
+import numpy as np
+from typing import Dict, List, Tuple
+
+"""
+# Sorted interval index
+
+Membership of loci in a set of genomic intervals (e.g. LCR, decoy or segdup intervals), without interval table joins.
+
+For each contig, overlapping intervals are merged and stored as two sorted arrays of
+1-based start (inclusive) and end (exclusive) positions. A position is in the index if the
+last start <= position has an end > position, which is found with a binary search.
+
+Indices are cached as a single compressed `.npz` file, with one `<name>/<contig>/starts` and
+`<name>/<contig>/ends` array per contig.
+"""
+
+logger = logging.getLogger("interval_index")
+
+GNOMAD_INTERVALS = ['lcr', 'decoy', 'segdup']
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'compound_hets', 'grch37_intervals.npz')
+
+
+class IntervalIndex:
+    """
+    Merged, sorted intervals per contig.
+    """
+
+    def __init__(self, intervals: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.intervals = intervals
+
+    @staticmethod
+    def from_arrays(contigs: List[str], starts: np.ndarray, ends: np.ndarray) -> 'IntervalIndex':
+        """
+        Creates an index from (possibly unsorted and overlapping) intervals.
+
+        :param list of str contigs: Contig of each interval
+        :param ndarray starts: 1-based start of each interval (inclusive)
+        :param ndarray ends: 1-based end of each interval (exclusive)
+        :return: Interval index
+        :rtype: IntervalIndex
+        """
+        contigs = np.asarray(contigs)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        intervals = {}
+        for contig in np.unique(contigs):
+            is_contig = contigs == contig
+            order = np.argsort(starts[is_contig], kind='stable')
+            c_starts = starts[is_contig][order]
+            c_ends = np.maximum.accumulate(ends[is_contig][order])
+
+            # A new merged interval begins wherever the start is after the end of all previous intervals
+            is_new = np.ones(len(c_starts), dtype=bool)
+            is_new[1:] = c_starts[1:] > c_ends[:-1]
+            new_idx = np.flatnonzero(is_new)
+            last_idx = np.append(new_idx[1:] - 1, len(c_starts) - 1)
+            intervals[str(contig)] = (c_starts[new_idx], c_ends[last_idx])
+
+        return IntervalIndex(intervals)
+
+    @staticmethod
+    def from_hail_table(ht) -> 'IntervalIndex':
+        """
+        Creates an index from a Hail Table keyed by interval (e.g. `gnomad.resources.grch37.lcr_intervals.ht()`).
+
+        :param Table ht: Interval table
+        :return: Interval index
+        :rtype: IntervalIndex
+        """
+        import hail as hl
+
+        interval = ht.key[0]
+        intervals = ht.aggregate(
+            hl.agg.collect(
+                hl.struct(
+                    contig=interval.start.contig,
+                    start=interval.start.position + hl.int(~interval.includes_start),
+                    end=interval.end.position + hl.int(interval.includes_end)
+                )
+            )
+        )
+        return IntervalIndex.from_arrays(
+            [i.contig for i in intervals],
+            np.array([i.start for i in intervals], dtype=np.int64),
+            np.array([i.end for i in intervals], dtype=np.int64)
+        )
+
+    @property
+    def n_intervals(self) -> int:
+        return sum(len(starts) for starts, _ in self.intervals.values())
+
+    def contains(self, contigs: np.ndarray, positions: np.ndarray) -> np.ndarray:
+        """
+        Vectorized membership test.
+
+        :param ndarray contigs: Contig of each locus
+        :param ndarray positions: 1-based position of each locus
+        :return: Boolean array, True for loci within an interval
+        :rtype: ndarray
+        """
+        contigs = np.asarray(contigs)
+        positions = np.asarray(positions, dtype=np.int64)
+        res = np.zeros(len(positions), dtype=bool)
+        for contig in np.unique(contigs):
+            if str(contig) not in self.intervals:
+                continue
+            starts, ends = self.intervals[str(contig)]
+            is_contig = np.flatnonzero(contigs == contig)
+            pos = positions[is_contig]
+            idx = np.searchsorted(starts, pos, side='right') - 1
+            res[is_contig] = (idx >= 0) & (pos < ends[np.maximum(idx, 0)])
+        return res
+
+    def to_hail_literal(self):
+        """
+        Returns the index as a Hail dict literal of contig -> struct(starts, ends), to be broadcast and queried with `contains_expr`.
+
+        :return: Index literal
+        :rtype: DictExpression
+        """
+        import hail as hl
+
+        return hl.literal(
+            {
+                contig: hl.Struct(starts=starts.tolist(), ends=ends.tolist())
+                for contig, (starts, ends) in self.intervals.items()
+            },
+            dtype=hl.tdict(hl.tstr, hl.tstruct(starts=hl.tarray(hl.tint32), ends=hl.tarray(hl.tint32)))
+        )
+
+    def _to_npz_dict(self, name: str) -> Dict[str, np.ndarray]:
+        res = {}
+        for contig, (starts, ends) in self.intervals.items():
+            res[f'{name}/{contig}/starts'] = starts
+            res[f'{name}/{contig}/ends'] = ends
+        return res
+
+    @staticmethod
+    def _from_npz(npz, name: str) -> 'IntervalIndex':
+        contigs = {k.split('/')[1] for k in npz.files if k.startswith(f'{name}/')}
+        return IntervalIndex({c: (npz[f'{name}/{c}/starts'], npz[f'{name}/{c}/ends']) for c in contigs})
+
+
+def contains_expr(index_expr, locus_expr):
+    """
+    Returns whether a locus is in an index broadcast with `IntervalIndex.to_hail_literal`.
+
+    :param DictExpression index_expr: Index literal
+    :param LocusExpression locus_expr: Locus
+    :return: Whether the locus is within an interval
+    :rtype: BooleanExpression
+    """
+    import hail as hl
+
+    return hl.or_else(
+        hl.bind(
+            lambda c: hl.bind(
+                # Index of the last start <= position
+                lambda i: (i >= 0) & (locus_expr.position < c.ends[hl.max(i, 0)]),
+                hl.binary_search(c.starts, locus_expr.position + 1) - 1
+            ),
+            index_expr.get(locus_expr.contig)
+        ),
+        False
+    )
+
+
+def write_interval_indices(path: str, indices: Dict[str, IntervalIndex]) -> None:
+    """
+    Writes multiple interval indices to a single compressed `.npz` file.
+
+    :param str path: Output path (local)
+    :param dict of str -> IntervalIndex indices: Indices by name
+    :return: Nothing
+    :rtype: None
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    arrays = {}
+    for name, index in indices.items():
+        arrays.update(index._to_npz_dict(name))
+    np.savez_compressed(path, **arrays)
+
+
+def read_interval_indices(path: str) -> Dict[str, IntervalIndex]:
+    """
+    Reads interval indices written with `write_interval_indices`.
+
+    :param str path: Path of the `.npz` file
+    :return: Indices by name
+    :rtype: dict of str -> IntervalIndex
+    """
+    with np.load(path) as npz:
+        names = {k.split('/')[0] for k in npz.files}
+        return {name: IntervalIndex._from_npz(npz, name) for name in names}
+
+
+def get_gnomad_interval_indices(path: str = DEFAULT_CACHE_PATH, overwrite: bool = False) -> Dict[str, IntervalIndex]:
+    """
+    Returns the LCR, decoy and segdup GRCh37 interval indices, building them from the gnomAD interval tables
+    and caching them at `path` the first time.
+
+    :param str path: Cache path (local)
+    :param bool overwrite: If set, the indices are rebuilt even if cached
+    :return: Indices by name (see `GNOMAD_INTERVALS`)
+    :rtype: dict of str -> IntervalIndex
+    """
+    if os.path.exists(path) and not overwrite:
+        return read_interval_indices(path)
+
+    from gnomad.resources.grch37 import lcr_intervals, decoy_intervals, seg_dup_intervals
+
+    indices = {
+        'lcr': IntervalIndex.from_hail_table(lcr_intervals.ht()),
+        'decoy': IntervalIndex.from_hail_table(decoy_intervals.ht()),
+        'segdup': IntervalIndex.from_hail_table(seg_dup_intervals.ht())
+    }
+    for name, index in indices.items():
+        logger.info(f"{name}: {index.n_intervals} merged intervals.")
+    write_interval_indices(path, indices)
+    return indices
+
+
+def get_gnomad_intervals_expr(locus_expr, path: str = DEFAULT_CACHE_PATH):
+    """
+    Returns a struct with the LCR, decoy and segdup membership of a locus, using broadcast interval indices.
+
+    :param LocusExpression locus_expr: Locus
+    :param str path: Interval indices cache path (see `get_gnomad_interval_indices`)
+    :return: Struct with one boolean field per interval set in `GNOMAD_INTERVALS`
+    :rtype: StructExpression
+    """
+    import hail as hl
+
+    indices = get_gnomad_interval_indices(path)
+    return hl.struct(**{name: contains_expr(indices[name].to_hail_literal(), locus_expr) for name in GNOMAD_INTERVALS})
+
+
+def main(args):
+    if args.build:
+        import hail as hl
+        hl.init(log="/tmp/hail_interval_index.log")
+        get_gnomad_interval_indices(args.path, overwrite=True)
+
+    if args.loci:
+        indices = read_interval_indices(args.path)
+        with open(args.loci) as f:
+            loci = [line.strip().split(':') for line in f if line.strip()]
+        contigs = np.array([l[0] for l in loci])
+        positions = np.array([int(l[1]) for l in loci])
+        res = {name: indices[name].contains(contigs, positions) for name in GNOMAD_INTERVALS}
+        print("\t".join(['locus'] + GNOMAD_INTERVALS))
+        for i, l in enumerate(loci):
+            print("\t".join([':'.join(l)] + [str(res[name][i]) for name in GNOMAD_INTERVALS]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', help=f'Path of the interval indices cache (default: {DEFAULT_CACHE_PATH})', default=DEFAULT_CACHE_PATH)
+    parser.add_argument('--build', help='(Re)builds the LCR, decoy and segdup interval indices from the gnomAD interval tables.', action='store_true')
+    parser.add_argument('--loci', help='File with one locus (contig:position) per line. Prints their LCR, decoy and segdup membership.')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,169 @@
+import argparse
+import logging
+import hail as hl
+from gnomad.utils.liftover import get_liftover_genome
+from resources import liftover_cache_ht_path
+
+"""
+# Liftover cache
+
+A persisted table of GRCh38 variants lifted over to GRCh37, keyed by the GRCh38 locus and alleles, with fields:
+* `locus_grch37`, `alleles_grch37`: lifted-over variant (missing if the liftover failed)
+* `is_negative_strand`: whether the variant was lifted over to the negative strand (the alleles are then reverse-complemented)
+* `bad_liftover`: whether the liftover failed or the lifted-over ref allele doesn't match the GRCh37 reference
+
+Only variants not yet in the cache are lifted over, so repeated queries with the same variants don't redo the liftover
+or the reference check.
+"""
+
+logger = logging.getLogger("liftover_cache")
+logger.setLevel(logging.INFO)
+
+
+def liftover_expr(
+        locus: hl.expr.LocusExpression,
+        alleles: hl.expr.ArrayExpression,
+        destination_ref: hl.ReferenceGenome
+) -> hl.expr.StructExpression:
+    lifted_over_locus = hl.liftover(locus, destination_ref, include_strand=True)
+    lifted_over_alleles = alleles.map(
+        lambda a: hl.if_else(lifted_over_locus.is_negative_strand, hl.reverse_complement(a), a)
+    )
+    return hl.struct(
+        locus=lifted_over_locus.result,
+        alleles=lifted_over_alleles
+    )
+
+
+def liftover_variants_ht(variants_ht: hl.Table) -> hl.Table:
+    """
+    Lifts over variants to the other reference genome (GRCh38 -> GRCh37 or GRCh37 -> GRCh38)
+    and checks the lifted-over ref allele against the destination reference.
+
+    :param Table variants_ht: Table keyed by locus and alleles
+    :return: Table with the liftover cache schema (see module docstring), with fields suffixed by the destination reference (e.g. `locus_grch37`)
+    :rtype: Table
+    """
+    _, destination_ref = get_liftover_genome(variants_ht)
+    suffix = destination_ref.name.lower()
+    lifted_over_locus = hl.liftover(variants_ht.locus, destination_ref, include_strand=True)
+    variants_ht = variants_ht.select(
+        **{
+            f'locus_{suffix}': lifted_over_locus.result,
+            'is_negative_strand': lifted_over_locus.is_negative_strand,
+            f'alleles_{suffix}': hl.or_missing(
+                hl.is_defined(lifted_over_locus),
+                liftover_expr(variants_ht.locus, variants_ht.alleles, destination_ref).alleles
+            )
+        }
+    )
+    return variants_ht.annotate(
+        bad_liftover=(
+            hl.is_missing(variants_ht[f'locus_{suffix}']) |
+            (variants_ht[f'locus_{suffix}'].sequence_context() != variants_ht[f'alleles_{suffix}'][0][0])
+        )
+    )
+
+
+def get_liftover_cache_ht(
+        variants_ht: hl.Table,
+        cache_path: str = liftover_cache_ht_path(),
+        tmp_path: str = 'gs://gnomad-tmp/compound_hets/liftover_cache.tmp.ht'
+) -> hl.Table:
+    """
+    Returns a liftover table containing every variant in `variants_ht`.
+
+    If `cache_path` is given, the cache stored there is used and updated with the variants that weren't in it yet,
+    so each variant is only ever lifted over once across runs.
+
+    :param Table variants_ht: Table keyed by locus (GRCh38) and alleles. Keys don't need to be distinct.
+    :param str cache_path: Optional path of the persistent liftover cache
+    :param str tmp_path: Temporary path used when updating an existing cache
+    :return: Liftover cache table
+    :rtype: Table
+    """
+    variants_ht = variants_ht.select().select_globals().distinct()
+
+    cache_ht = None
+    if cache_path is not None and hl.hadoop_exists(f'{cache_path}/_SUCCESS'):
+        cache_ht = hl.read_table(cache_path)
+        new_ht = variants_ht.anti_join(cache_ht)
+    else:
+        new_ht = variants_ht
+
+    new_ht = liftover_variants_ht(new_ht).persist()
+    n_new = new_ht.count()
+    logger.info(f"Liftover cache: {n_new} variant(s) to lift over.")
+
+    if cache_path is None:
+        return new_ht
+
+    if cache_ht is None:
+        new_ht.write(cache_path, overwrite=True)
+    elif n_new > 0:
+        cache_ht = cache_ht.union(new_ht).checkpoint(tmp_path, overwrite=True)
+        cache_ht.write(cache_path, overwrite=True)
+
+    return hl.read_table(cache_path)
+
+
+def liftover_pairs_ht(ht: hl.Table, cache_path: str = liftover_cache_ht_path()) -> hl.Table:
+    """
+    Lifts over a GRCh38 variant-pair table to GRCh37 using the liftover cache.
+    The output is keyed by the GRCh37 locus1, alleles1, locus2, alleles2 (with variants ordered by locus within each pair)
+    and has a `bad_liftover` field.
+
+    :param Table ht: Table keyed by locus1, alleles1, locus2, alleles2 (GRCh38). The GRCh38 key fields are kept with a `_grch38` suffix.
+    :param str cache_path: Optional path of the persistent liftover cache (see `get_liftover_cache_ht`)
+    :return: GRCh37 variant-pair table
+    :rtype: Table
+    """
+    key = list(ht.key)
+    ht = ht.key_by().rename({k: f'{k}_grch38' for k in key})
+    locus1, alleles1, locus2, alleles2 = [ht[f'{k}_grch38'] for k in key]
+    variants_ht = ht.select(
+        variants=[
+            hl.struct(locus=locus1, alleles=alleles1),
+            hl.struct(locus=locus2, alleles=alleles2)
+        ]
+    ).explode('variants')
+    variants_ht = variants_ht.key_by(locus=variants_ht.variants.locus, alleles=variants_ht.variants.alleles)
+    cache_ht = get_liftover_cache_ht(variants_ht, cache_path)
+
+    variants = hl.sorted(
+        [cache_ht[locus1, alleles1], cache_ht[locus2, alleles2]],
+        key=lambda x: x.locus_grch37
+    )
+    ht = ht.annotate(
+        bad_liftover=hl.or_else(variants[0].bad_liftover | variants[1].bad_liftover, True),
+        locus1=variants[0].locus_grch37,
+        alleles1=variants[0].alleles_grch37,
+        locus2=variants[1].locus_grch37,
+        alleles2=variants[1].alleles_grch37
+    )
+    return ht.key_by('locus1', 'alleles1', 'locus2', 'alleles2')
+
+
+def main(args):
+    hl.init(log="/tmp/hail_liftover_cache.log")
+
+    ht = hl.read_table(args.ht)
+    if 'locus1' in ht.key:
+        ht = ht.select(
+            variants=[
+                hl.struct(locus=ht.locus1, alleles=ht.alleles1),
+                hl.struct(locus=ht.locus2, alleles=ht.alleles2)
+            ]
+        ).explode('variants')
+        ht = ht.key_by(locus=ht.variants.locus, alleles=ht.variants.alleles)
+
+    get_liftover_cache_ht(ht, args.cache)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ht', help='GRCh38 table to add to the liftover cache, keyed either by locus, alleles or by locus1, alleles1, locus2, alleles2.', required=True)
+    parser.add_argument('--cache', help=f'Liftover cache path (default: {liftover_cache_ht_path()})', default=liftover_cache_ht_path())
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,159 @@
+import argparse
+import logging
+import hail as hl
+from liftover_cache import liftover_variants_ht
+from phasing import get_phased_gnomad_ht
+from resources import LEAST_CONSEQUENCE, MAX_FREQ, phased_vp_count_ht_path, single_variant_ht_path
+
+"""
+# GRCh38 phase tables
+
+Lifts over the (GRCh37) phased VP table and slim single-variant table to GRCh38 once, in bulk,
+so that `compute_phase` can look up GRCh38 queries directly, without lifting over each query.
+
+Variants whose liftover fails or whose lifted-over ref allele doesn't match GRCh38 are dropped, since they can't
+match a GRCh38 query. Pairs are re-ordered by their GRCh38 loci. For pairs where the variants order changes, the GT counts
+are transposed and the pair is re-phased.
+"""
+
+logger = logging.getLogger("liftover_phase_tables")
+logger.setLevel(logging.INFO)
+
+# Index of each GT count after swapping the two variants of a pair, for GT counts ordered as [AABB, AABb, AAbb, AaBB, AaBb, Aabb, aaBB, aaBb, aabb]
+TRANSPOSED_GT_COUNTS_INDICES = [0, 3, 6, 1, 4, 7, 2, 5, 8]
+
+
+def transpose_gt_counts_expr(gt_counts: hl.expr.ArrayExpression) -> hl.expr.ArrayExpression:
+    return hl.array([gt_counts[i] for i in TRANSPOSED_GT_COUNTS_INDICES])
+
+
+def get_variants_liftover_ht(ht: hl.Table, tmp_path: str) -> hl.Table:
+    """
+    Lifts over all distinct variants of a variant-pair table to GRCh38.
+
+    :param Table ht: Table keyed by locus1, alleles1, locus2, alleles2 (GRCh37)
+    :param str tmp_path: Path where the liftover table is checkpointed
+    :return: Table keyed by the GRCh37 locus and alleles, with locus_grch38, alleles_grch38, is_negative_strand and bad_liftover fields
+    :rtype: Table
+    """
+    variants_ht = ht.key_by().select(
+        variants=[
+            hl.struct(locus=ht.locus1, alleles=ht.alleles1),
+            hl.struct(locus=ht.locus2, alleles=ht.alleles2)
+        ]
+    ).explode('variants')
+    variants_ht = variants_ht.key_by(locus=variants_ht.variants.locus, alleles=variants_ht.variants.alleles)
+    variants_ht = variants_ht.select().select_globals().distinct()
+    return liftover_variants_ht(variants_ht).checkpoint(tmp_path, overwrite=True)
+
+
+def liftover_phased_vp_ht(phased_ht: hl.Table, liftover_ht: hl.Table) -> hl.Table:
+    """
+    Lifts over the phased VP table to GRCh38, keyed by the GRCh38 locus1, alleles1, locus2, alleles2.
+
+    :param Table phased_ht: Phased VP table (GRCh37)
+    :param Table liftover_ht: Variants liftover table (see `get_variants_liftover_ht`)
+    :return: Phased VP table on GRCh38
+    :rtype: Table
+    """
+    v1 = liftover_ht[phased_ht.locus1, phased_ht.alleles1]
+    v2 = liftover_ht[phased_ht.locus2, phased_ht.alleles2]
+    phased_ht = phased_ht.key_by().annotate(
+        v1=v1.select('locus_grch38', 'alleles_grch38', 'bad_liftover'),
+        v2=v2.select('locus_grch38', 'alleles_grch38', 'bad_liftover')
+    )
+    phased_ht = phased_ht.filter(~hl.or_else(phased_ht.v1.bad_liftover | phased_ht.v2.bad_liftover, True))
+    phased_ht = phased_ht.annotate(swapped=phased_ht.v2.locus_grch38 < phased_ht.v1.locus_grch38)
+    phased_ht = phased_ht.transmute(
+        locus1=hl.if_else(phased_ht.swapped, phased_ht.v2.locus_grch38, phased_ht.v1.locus_grch38),
+        alleles1=hl.if_else(phased_ht.swapped, phased_ht.v2.alleles_grch38, phased_ht.v1.alleles_grch38),
+        locus2=hl.if_else(phased_ht.swapped, phased_ht.v1.locus_grch38, phased_ht.v2.locus_grch38),
+        alleles2=hl.if_else(phased_ht.swapped, phased_ht.v1.alleles_grch38, phased_ht.v2.alleles_grch38)
+    ).persist()
+
+    n_swapped = phased_ht.aggregate(hl.agg.count_where(phased_ht.swapped))
+    logger.info(f"{n_swapped} variant pair(s) have their variants swapped on GRCh38 and are re-phased.")
+
+    # Swapped pairs are re-phased with the same models as the input table
+    phase_fields = list(phased_ht.phase_info.dtype.value_type)
+    swapped_ht = phased_ht.filter(phased_ht.swapped)
+    swapped_ht = swapped_ht.key_by('locus1', 'alleles1', 'locus2', 'alleles2')
+    swapped_ht = swapped_ht.select(
+        gt_counts=swapped_ht.phase_info.map_values(
+            lambda x: hl.struct(
+                raw=transpose_gt_counts_expr(x.gt_counts.raw),
+                adj=transpose_gt_counts_expr(x.gt_counts.adj)
+            )
+        )
+    )
+    swapped_ht = get_phased_gnomad_ht(
+        swapped_ht,
+        em='em' in phase_fields,
+        lr='likelihood_model' in phase_fields,
+        shr='singlet_het_ratio' in phase_fields
+    )
+    swapped_ht = swapped_ht.annotate(
+        phase_info=swapped_ht.phase_info.map_values(lambda x: x.select(*phase_fields))
+    )
+
+    phased_ht = phased_ht.filter(~phased_ht.swapped).drop('swapped')
+    return phased_ht.key_by('locus1', 'alleles1', 'locus2', 'alleles2').union(swapped_ht)
+
+
+def liftover_single_variant_ht(single_variant_ht: hl.Table, liftover_ht: hl.Table) -> hl.Table:
+    """
+    Lifts over the slim single-variant table to GRCh38, keyed by the GRCh38 locus and alleles.
+
+    :param Table single_variant_ht: Slim single-variant table (see `compute_phase.create_single_variant_ht`)
+    :param Table liftover_ht: Variants liftover table (see `get_variants_liftover_ht`)
+    :return: Slim single-variant table on GRCh38
+    :rtype: Table
+    """
+    lifted = liftover_ht[single_variant_ht.key]
+    single_variant_ht = single_variant_ht.annotate(_lifted=lifted.select('locus_grch38', 'alleles_grch38', 'bad_liftover'))
+    single_variant_ht = single_variant_ht.filter(~hl.or_else(single_variant_ht._lifted.bad_liftover, True))
+    return single_variant_ht.key_by(
+        locus=single_variant_ht._lifted.locus_grch38,
+        alleles=single_variant_ht._lifted.alleles_grch38
+    ).drop('_lifted')
+
+
+def main(args):
+    hl.init(log="/tmp/hail_liftover_phase_tables.log")
+
+    data_type = 'exomes' if args.exomes else 'genomes'
+    path_args = [data_type, args.pbt, args.least_consequence, args.max_freq, args.chrom]
+
+    if args.phased_vp:
+        phased_ht = hl.read_table(phased_vp_count_ht_path(*path_args))
+        liftover_ht = get_variants_liftover_ht(phased_ht, f'gs://gnomad-tmp/compound_hets/{data_type}_phased_vp_liftover.ht')
+        liftover_phased_vp_ht(phased_ht, liftover_ht).write(phased_vp_count_ht_path(*path_args, reference_genome='GRCh38'), overwrite=args.overwrite)
+
+    if args.single_variants:
+        single_variant_ht = hl.read_table(single_variant_ht_path(data_type))
+        liftover_ht = liftover_variants_ht(single_variant_ht.select().select_globals()).checkpoint(
+            f'gs://gnomad-tmp/compound_hets/{data_type}_single_variants_liftover.ht',
+            overwrite=True
+        )
+        liftover_single_variant_ht(single_variant_ht, liftover_ht).write(single_variant_ht_path(data_type, reference_genome='GRCh38'), overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    data_grp = parser.add_mutually_exclusive_group(required=True)
+    data_grp.add_argument('--exomes', help='Run on exomes. One and only one of --exomes or --genomes is required.',
+                          action='store_true')
+    data_grp.add_argument('--genomes', help='Run on genomes. One and only one of --exomes or --genomes is required.',
+                          action='store_true')
+    parser.add_argument('--phased_vp', help='Lifts over the phased VP table to GRCh38.', action='store_true')
+    parser.add_argument('--single_variants', help='Lifts over the slim single-variant table (see compute_phase.py --create_single_variant_ht) to GRCh38.', action='store_true')
+    parser.add_argument('--pbt', help='If --pbt is specified, then only sites present in PBT samples are used and counts exclude PBT samples.',
+                        action='store_true')
+    parser.add_argument('--least_consequence', help=f'Least consequence for the input (just to get the path right). (default: {LEAST_CONSEQUENCE})',
+                        default=LEAST_CONSEQUENCE)
+    parser.add_argument('--max_freq', help=f'Maximum global adj AF for the input (just to get the path right). (default: {MAX_FREQ:.3f})', default=MAX_FREQ, type=float)
+    parser.add_argument('--chrom', help='Only run on given chromosome')
+    parser.add_argument('--overwrite', help='Overwrite all data from this subset (default: False)', action='store_true')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,448 @@
+import argparse
+import json
+import logging
+import numpy as np
+from typing import Dict, List, Tuple
+
+"""
+# 2-bit packed genotype matrix
+
+Genotypes are stored as 2-bit codes, 32 samples per uint64 word, one row of words per variant:
+
+| code | genotype                |
+|------|-------------------------|
+| 0    | hom ref                 |
+| 1    | het                     |
+| 2    | hom var                 |
+| 3    | missing (or padding)    |
+
+A separate adj bitplane uses the same layout, with only the low bit of each sample set.
+Both planes are stored in a single memory-mapped file, after a fixed-size header:
+
+    | header (64 bytes) | codes (n_variants x n_words uint64) | adj (n_variants x n_words uint64) |
+
+Sample IDs, sample pops and variant IDs are stored in a JSON sidecar (`<path>.json`).
+GT counts are computed with the same semantics as `create_vp_matrix.get_counts_agg_expr`:
+missing genotypes aren't counted and adj counts only use samples that are adj for both variants.
+"""
+
+logger = logging.getLogger("packed_gt")
+logger.setLevel(logging.INFO)
+
+MAGIC = b'PACKEDGT'
+VERSION = 1
+HEADER_SIZE = 64
+SAMPLES_PER_WORD = 32
+
+GT_HOM_REF = 0
+GT_HET = 1
+GT_HOM_VAR = 2
+GT_MISSING = 3
+
+LOW_BITS = np.uint64(0x5555555555555555)
+
+_POPCOUNT_LUT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(words: np.ndarray) -> np.ndarray:
+    """
+    Number of bits set in each row of `words`.
+
+    :param ndarray words: (..., n_words) uint64 array
+    :return: (...) array of bit counts
+    :rtype: ndarray
+    """
+    if hasattr(np, 'bitwise_count'):  # numpy >= 2.0
+        return np.bitwise_count(words).sum(axis=-1, dtype=np.int64)
+    return _POPCOUNT_LUT[words.view(np.uint8)].sum(axis=-1, dtype=np.int64)
+
+
+def pack_codes(codes: np.ndarray) -> np.ndarray:
+    """
+    Packs an (n_variants, n_samples) array of 2-bit genotype codes into (n_variants, n_words) uint64 words.
+    Padding samples are set to GT_MISSING so they are never counted.
+
+    :param ndarray codes: (n_variants, n_samples) array of values in [0, 3]
+    :return: (n_variants, n_words) uint64 array
+    :rtype: ndarray
+    """
+    codes = np.atleast_2d(np.asarray(codes, dtype=np.uint64))
+    n_variants, n_samples = codes.shape
+    n_words = -(-n_samples // SAMPLES_PER_WORD)
+    padded = np.full((n_variants, n_words * SAMPLES_PER_WORD), GT_MISSING, dtype=np.uint64)
+    padded[:, :n_samples] = codes
+    shifts = (2 * np.arange(SAMPLES_PER_WORD, dtype=np.uint64))
+    return np.bitwise_or.reduce(padded.reshape(n_variants, n_words, SAMPLES_PER_WORD) << shifts, axis=2)
+
+
+def unpack_codes(words: np.ndarray, n_samples: int) -> np.ndarray:
+    """
+    Inverse of `pack_codes`.
+
+    :param ndarray words: (n_variants, n_words) uint64 array
+    :param int n_samples: Number of samples
+    :return: (n_variants, n_samples) uint8 array of genotype codes
+    :rtype: ndarray
+    """
+    words = np.atleast_2d(words)
+    shifts = (2 * np.arange(SAMPLES_PER_WORD, dtype=np.uint64))
+    codes = (words[:, :, np.newaxis] >> shifts) & np.uint64(3)
+    return codes.reshape(words.shape[0], -1)[:, :n_samples].astype(np.uint8)
+
+
+def _gt_masks(words: np.ndarray) -> List[np.ndarray]:
+    # One mask per genotype code (hom ref, het, hom var), with the low bit of each matching sample set
+    lo = words & LOW_BITS
+    hi = (words >> np.uint64(1)) & LOW_BITS
+    return [LOW_BITS & ~(lo | hi), lo & ~hi, hi & ~lo]
+
+
+def gt_counts_kernel(codes1: np.ndarray, codes2: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """
+    Computes the GT counts of variant-pairs from their packed genotypes.
+
+    :param ndarray codes1: (n_pairs, n_words) packed genotypes of variant 1
+    :param ndarray codes2: (n_pairs, n_words) packed genotypes of variant 2
+    :param ndarray mask: Optional (n_words,) or (n_pairs, n_words) mask of the samples to count (low bit of each sample)
+    :return: (n_pairs, 9) GT counts
+    :rtype: ndarray
+    """
+    masks1 = _gt_masks(codes1)
+    masks2 = _gt_masks(codes2)
+    if mask is not None:
+        masks1 = [m & mask for m in masks1]
+    return np.stack([popcount(m1 & m2) for m1 in masks1 for m2 in masks2], axis=1)
+
+
+class PackedGenotypeMatrix:
+    """
+    Memory-mapped 2-bit packed genotype matrix.
+    Use `PackedGenotypeMatrix.write` to create one and `PackedGenotypeMatrix.open` to read it.
+    """
+
+    def __init__(self, path: str, codes: np.ndarray, adj: np.ndarray, samples: List[str], pops: List[str], variants: List[str]):
+        self.path = path
+        self.codes = codes
+        self.adj = adj
+        self.samples = samples
+        self.pops = pops
+        self.variants = variants
+        self._variant_index = None
+        self._pop_masks = None
+
+    @property
+    def n_variants(self) -> int:
+        return self.codes.shape[0]
+
+    @property
+    def n_samples(self) -> int:
+        return len(self.samples)
+
+    @staticmethod
+    def write(
+            path: str,
+            codes: np.ndarray,
+            adj: np.ndarray,
+            samples: List[str],
+            pops: List[str] = None,
+            variants: List[str] = None
+    ) -> 'PackedGenotypeMatrix':
+        """
+        Writes a packed genotype matrix from unpacked genotype codes and adj flags.
+
+        :param str path: Output path
+        :param ndarray codes: (n_variants, n_samples) array of genotype codes
+        :param ndarray adj: (n_variants, n_samples) boolean array of adj flags
+        :param list of str samples: Sample IDs
+        :param list of str pops: Optional sample pops
+        :param list of str variants: Optional variant IDs
+        :return: The written matrix, opened for reading
+        :rtype: PackedGenotypeMatrix
+        """
+        codes = np.atleast_2d(codes)
+        writer = PackedGenotypeMatrix.create(path, codes.shape[0], samples, pops, variants)
+        writer.codes[:] = pack_codes(codes)
+        writer.adj[:] = pack_codes(np.atleast_2d(adj).astype(np.uint8)) & LOW_BITS
+        writer.codes.flush()
+        writer.adj.flush()
+        return PackedGenotypeMatrix.open(path)
+
+    @staticmethod
+    def create(path: str, n_variants: int, samples: List[str], pops: List[str] = None, variants: List[str] = None) -> 'PackedGenotypeMatrix':
+        """
+        Creates an empty packed genotype matrix (all genotypes missing) and opens it for writing.
+
+        :param str path: Output path
+        :param int n_variants: Number of variants
+        :param list of str samples: Sample IDs
+        :param list of str pops: Optional sample pops
+        :param list of str variants: Optional variant IDs
+        :return: Matrix opened for writing
+        :rtype: PackedGenotypeMatrix
+        """
+        n_words = -(-len(samples) // SAMPLES_PER_WORD)
+        header = np.zeros(HEADER_SIZE, dtype=np.uint8)
+        header[:len(MAGIC)] = np.frombuffer(MAGIC, dtype=np.uint8)
+        header[8:40].view(np.uint64)[:] = [VERSION, n_variants, len(samples), n_words]
+        with open(path, 'wb') as f:
+            f.write(header.tobytes())
+            f.truncate(HEADER_SIZE + 2 * n_variants * n_words * 8)
+
+        with open(f'{path}.json', 'w') as f:
+            json.dump(dict(samples=samples, pops=pops, variants=variants), f)
+
+        pgm = PackedGenotypeMatrix._memmap(path, 'r+')
+        pgm.codes[:] = np.iinfo(np.uint64).max
+        return pgm
+
+    @staticmethod
+    def open(path: str) -> 'PackedGenotypeMatrix':
+        """
+        Opens a packed genotype matrix for reading.
+
+        :param str path: Path to the matrix
+        :return: Matrix
+        :rtype: PackedGenotypeMatrix
+        """
+        return PackedGenotypeMatrix._memmap(path, 'r')
+
+    @staticmethod
+    def _memmap(path: str, mode: str) -> 'PackedGenotypeMatrix':
+        header = np.fromfile(path, dtype=np.uint8, count=HEADER_SIZE)
+        if header[:len(MAGIC)].tobytes() != MAGIC:
+            raise ValueError(f"{path} is not a packed genotype matrix.")
+        version, n_variants, n_samples, n_words = (int(x) for x in header[8:40].view(np.uint64))
+        if version != VERSION:
+            raise ValueError(f"Unsupported packed genotype matrix version {version} (expected {VERSION}).")
+
+        shape = (n_variants, n_words)
+        codes = np.memmap(path, dtype=np.uint64, mode=mode, offset=HEADER_SIZE, shape=shape)
+        adj = np.memmap(path, dtype=np.uint64, mode=mode, offset=HEADER_SIZE + n_variants * n_words * 8, shape=shape)
+
+        with open(f'{path}.json') as f:
+            meta = json.load(f)
+        if len(meta['samples']) != n_samples:
+            raise ValueError(f"Found {len(meta['samples'])} samples in {path}.json, expected {n_samples}.")
+
+        return PackedGenotypeMatrix(path, codes, adj, meta['samples'], meta['pops'], meta['variants'])
+
+    def variant_index(self, variants: List[str]) -> np.ndarray:
+        """
+        Returns the row index of each of the given variant IDs.
+
+        :param list of str variants: Variant IDs
+        :return: Array of row indices
+        :rtype: ndarray
+        """
+        if self._variant_index is None:
+            if self.variants is None:
+                raise ValueError(f"No variant IDs stored in {self.path}.json")
+            self._variant_index = {v: i for i, v in enumerate(self.variants)}
+        return np.array([self._variant_index[v] for v in variants], dtype=np.int64)
+
+    def pop_masks(self) -> Dict[str, np.ndarray]:
+        """
+        Returns a packed mask of the samples of each pop.
+
+        :return: Dict of pop -> (n_words,) mask
+        :rtype: dict of str -> ndarray
+        """
+        if self._pop_masks is None:
+            if self.pops is None:
+                raise ValueError(f"No sample pops stored in {self.path}.json")
+            pops = np.array(self.pops, dtype=object)
+            self._pop_masks = {
+                pop: pack_codes((pops == pop)[np.newaxis, :].astype(np.uint8))[0] & LOW_BITS
+                for pop in sorted(set(p for p in self.pops if p is not None))
+            }
+        return self._pop_masks
+
+    def gt_counts(self, idx1: np.ndarray, idx2: np.ndarray, adj: bool = False, pop: str = None, batch_size: int = 100000) -> np.ndarray:
+        """
+        Computes the GT counts for each pair of variants (idx1[i], idx2[i]).
+
+        :param ndarray idx1: Row indices of variant 1
+        :param ndarray idx2: Row indices of variant 2
+        :param bool adj: Whether to count only samples that are adj for both variants
+        :param str pop: Optional pop to restrict the counts to
+        :param int batch_size: Number of pairs processed at once
+        :return: (n_pairs, 9) GT counts
+        :rtype: ndarray
+        """
+        idx1 = np.asarray(idx1, dtype=np.int64)
+        idx2 = np.asarray(idx2, dtype=np.int64)
+        pop_mask = self.pop_masks()[pop] if pop is not None else None
+        res = np.zeros((len(idx1), 9), dtype=np.int64)
+        for start in range(0, len(idx1), batch_size):
+            i1 = idx1[start:start + batch_size]
+            i2 = idx2[start:start + batch_size]
+            mask = self.adj[i1] & self.adj[i2] if adj else None
+            if pop_mask is not None:
+                mask = pop_mask if mask is None else mask & pop_mask
+            res[start:start + batch_size] = gt_counts_kernel(self.codes[i1], self.codes[i2], mask)
+        return res
+
+    def gt_counts_by_pop(self, idx1: np.ndarray, idx2: np.ndarray, batch_size: int = 100000) -> Dict[str, Dict[str, np.ndarray]]:
+        """
+        Computes the raw and adj GT counts by pop, as in `create_vp_matrix.create_vp_summary`, including 'all'.
+
+        :param ndarray idx1: Row indices of variant 1
+        :param ndarray idx2: Row indices of variant 2
+        :param int batch_size: Number of pairs processed at once
+        :return: Dict of pop -> {'raw': (n_pairs, 9), 'adj': (n_pairs, 9)} GT counts
+        :rtype: dict
+        """
+        res = {
+            pop: {
+                'raw': self.gt_counts(idx1, idx2, False, pop, batch_size),
+                'adj': self.gt_counts(idx1, idx2, True, pop, batch_size)
+            }
+            for pop in self.pop_masks()
+        }
+        res['all'] = {k: sum(c[k] for c in res.values()) for k in ['raw', 'adj']}
+        return res
+
+
+def export_mt_to_packed_gt(mt, path: str, pop_field: str = 'pop') -> PackedGenotypeMatrix:
+    """
+    Exports a Hail MatrixTable with GT, missing and adj entries (see `resources.get_adj_missing_mt`) to a packed genotype matrix.
+    The MT is exported one partition at a time, so only one partition is held in memory.
+    Variant IDs are stored as `contig:position:ref:alt`.
+
+    :param MatrixTable mt: Input MT
+    :param str path: Output path (local)
+    :param str pop_field: Column field containing the sample pop
+    :return: Exported matrix, opened for reading
+    :rtype: PackedGenotypeMatrix
+    """
+    import hail as hl
+
+    cols = mt.cols().collect()
+    samples = [':'.join(str(c[k]) for k in mt.col_key.dtype.fields) for c in cols]
+    pops = [c[pop_field] for c in cols] if pop_field in mt.col.dtype.fields else None
+
+    ht = mt.select_rows().select_entries(
+        code=hl.case(missing_false=True)
+            .when(mt.missing, GT_MISSING)
+            .when(mt.GT.is_het(), GT_HET)
+            .when(mt.GT.is_hom_var(), GT_HOM_VAR)
+            .default(GT_HOM_REF),
+        adj=hl.or_else(mt.adj, False)
+    ).localize_entries('entries')
+    ht = ht.select(
+        variant=hl.delimit([ht.locus.contig, hl.str(ht.locus.position), ht.alleles[0], ht.alleles[1]], ':'),
+        codes=ht.entries.code,
+        adj=ht.entries.adj
+    )
+
+    n_variants = ht.count()
+    pgm = PackedGenotypeMatrix.create(path, n_variants, samples, pops)
+    variants = []
+    for i in range(ht.n_partitions()):
+        rows = ht._filter_partitions([i]).collect()
+        if not rows:
+            continue
+        start = len(variants)
+        pgm.codes[start:start + len(rows)] = pack_codes(np.array([r.codes for r in rows]))
+        pgm.adj[start:start + len(rows)] = pack_codes(np.array([r.adj for r in rows], dtype=np.uint8)) & LOW_BITS
+        variants.extend(r.variant for r in rows)
+        logger.info(f"Exported partition {i} ({len(variants)} / {n_variants} variants)")
+
+    pgm.codes.flush()
+    pgm.adj.flush()
+    with open(f'{path}.json', 'w') as f:
+        json.dump(dict(samples=samples, pops=pops, variants=variants), f)
+
+    return PackedGenotypeMatrix.open(path)
+
+
+def brute_force_gt_counts(codes1: np.ndarray, codes2: np.ndarray, mask: np.ndarray = None) -> np.ndarray:
+    """
+    Computes the GT counts of a single variant-pair by looping over the samples. Used to check `gt_counts_kernel`.
+
+    :param ndarray codes1: (n_samples,) genotype codes of variant 1
+    :param ndarray codes2: (n_samples,) genotype codes of variant 2
+    :param ndarray mask: Optional (n_samples,) boolean array of the samples to count
+    :return: (9,) GT counts
+    :rtype: ndarray
+    """
+    res = np.zeros(9, dtype=np.int64)
+    for i, (gt1, gt2) in enumerate(zip(codes1, codes2)):
+        if gt1 != GT_MISSING and gt2 != GT_MISSING and (mask is None or mask[i]):
+            res[3 * gt1 + gt2] += 1
+    return res
+
+
+def check_gt_counts(pgm: PackedGenotypeMatrix, idx1: np.ndarray, idx2: np.ndarray) -> int:
+    """
+    Checks the raw and adj GT counts by pop of `PackedGenotypeMatrix.gt_counts_by_pop` against a per-sample count
+    of the unpacked genotypes.
+
+    :param PackedGenotypeMatrix pgm: Matrix
+    :param ndarray idx1: Row indices of variant 1
+    :param ndarray idx2: Row indices of variant 2
+    :return: Number of mismatching pair / pop / raw-or-adj counts
+    :rtype: int
+    """
+    counts = pgm.gt_counts_by_pop(idx1, idx2)
+    pops = np.array(pgm.pops, dtype=object)
+    n_mismatches = 0
+    for i, (i1, i2) in enumerate(zip(idx1, idx2)):
+        codes = unpack_codes(pgm.codes[[i1, i2]], pgm.n_samples)
+        adj = unpack_codes(pgm.adj[[i1, i2]], pgm.n_samples).astype(bool)
+        for pop in pgm.pop_masks():
+            for k, mask in [('raw', pops == pop), ('adj', (pops == pop) & adj[0] & adj[1])]:
+                expected = brute_force_gt_counts(codes[0], codes[1], mask)
+                if not np.array_equal(counts[pop][k][i], expected):
+                    logger.warning(f"GT counts mismatch for pair {i} ({pop}, {k}): {list(counts[pop][k][i])} != {list(expected)}")
+                    n_mismatches += 1
+    return n_mismatches
+
+
+def read_pairs(pairs_path: str) -> Tuple[List[str], List[str]]:
+    with open(pairs_path) as f:
+        pairs = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+    return [p[0] for p in pairs], [p[1] for p in pairs]
+
+
+def main(args):
+    logging.basicConfig(format="%(asctime)s (%(name)s %(lineno)s): %(message)s", datefmt='%m/%d/%Y %I:%M:%S %p')
+
+    if args.export_mt:
+        import hail as hl
+        hl.init(log="/tmp/hail_packed_gt.log")
+        export_mt_to_packed_gt(hl.read_matrix_table(args.export_mt), args.path, args.pop_field)
+
+    if args.check:
+        pgm = PackedGenotypeMatrix.open(args.path)
+        rng = np.random.default_rng(args.seed)
+        idx1 = rng.integers(0, pgm.n_variants, args.check)
+        idx2 = rng.integers(0, pgm.n_variants, args.check)
+        n_mismatches = check_gt_counts(pgm, idx1, idx2)
+        if n_mismatches > 0:
+            raise ValueError(f"Found {n_mismatches} GT counts mismatches in {args.check} random pairs.")
+        logger.info(f"GT counts of {args.check} random pairs match the per-sample counts.")
+
+    if args.pairs:
+        pgm = PackedGenotypeMatrix.open(args.path)
+        v1, v2 = read_pairs(args.pairs)
+        counts = pgm.gt_counts_by_pop(pgm.variant_index(v1), pgm.variant_index(v2))
+        with open(args.out, 'w') as f:
+            f.write("\t".join(['v1', 'v2', 'pop', 'raw', 'adj']) + "\n")
+            for pop, c in counts.items():
+                for i in range(len(v1)):
+                    f.write("\t".join([v1[i], v2[i], pop, ",".join(map(str, c['raw'][i])), ",".join(map(str, c['adj'][i]))]) + "\n")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', help='Path to the packed genotype matrix', required=True)
+    parser.add_argument('--export_mt', help='Exports the MT at this path (with GT, missing and adj entries) to the packed genotype matrix.')
+    parser.add_argument('--pop_field', help='Column field containing the sample pop (default: pop)', default='pop')
+    parser.add_argument('--pairs', help='TSV file with two variant IDs (contig:position:ref:alt) per line. Computes their GT counts by pop.')
+    parser.add_argument('--out', help='Output TSV for --pairs')
+    parser.add_argument('--check', help='Checks the GT counts of this many random pairs against a per-sample count of the unpacked genotypes.', type=int)
+    parser.add_argument('--seed', help='Random seed for --check (default: 0)', default=0, type=int)
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,426 @@
+import argparse
+import csv
+import itertools
+import logging
+import re
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+import hail as hl
+from liftover_cache import get_liftover_cache_ht
+from resources import liftover_cache_ht_path
+
+"""
+# Bulk variant-pair input
+
+Reads lists of variant pairs and builds a pairs table keyed by locus1, alleles1, locus2, alleles2,
+as expected by `compute_phase`. GRCh38 pairs are lifted over to GRCh37 unless the GRCh38 phase tables are used.
+
+Supported formats (plain or gzipped, local or on GCS):
+* One pair per line as two variant strings, e.g. `1:123:A:T,1:456:G:C` or `chr1:123:A:T<tab>chr1:456:G:C`,
+  with or without a `variant1`/`variant2` header.
+* Delimited files (TSV/CSV) with a header and one column per field of each variant, e.g. the CMG lists
+  (`chrom_1,pos_1,ref_1,alt_1,chrom_2,pos_2,ref_2,alt_2`).
+* VCF-like files: same as above, with `##` meta lines and a `#CHROM1 POS1 REF1 ALT1 CHROM2 POS2 REF2 ALT2` header.
+
+All input columns are kept as string fields (`variant1` and `variant2` for files without a header).
+Lines are parsed and validated in chunks on the driver, then the distinct GRCh38 variants are lifted over in a single Hail job,
+using the liftover cache (see `liftover_cache.py`).
+The pairs are sorted locally, so that the resulting table is keyed without a shuffle.
+
+Only parsing and validation are streamed: all valid pairs (with their input fields) are then held in driver memory
+to be sorted and parallelized, so the size of the input is bounded by the driver memory.
+"""
+
+logger = logging.getLogger("pair_input")
+logger.setLevel(logging.INFO)
+
+PAIR_KEY = ['locus1', 'alleles1', 'locus2', 'alleles2']
+COLUMN_ALIASES = {
+    'chrom': 'chrom', 'chr': 'chrom', 'contig': 'chrom', 'chromosome': 'chrom',
+    'pos': 'pos', 'position': 'pos',
+    'ref': 'ref',
+    'alt': 'alt'
+}
+VARIANT_STRING_COLUMNS = [('variant1', 'variant2'), ('variant_1', 'variant_2'), ('v1', 'v2')]
+ALLELE_RE = re.compile(r'^[ACGTN]+$')
+DEFAULT_CHUNK_SIZE = 10000
+MAX_LOGGED_ERRORS = 20
+
+Variant = Tuple[str, int, str, str]
+
+
+def parse_variant(variant: str) -> Variant:
+    """
+    Parses a variant string (contig:pos:ref:alt, `-` and `_` are also accepted as separators).
+
+    :param str variant: Variant string
+    :return: Contig, position, ref and alt
+    :rtype: (str, int, str, str)
+    """
+    fields = re.split(r'[:\-_]', variant.strip())
+    if len(fields) != 4:
+        raise ValueError(f"Invalid variant {variant}, expected contig:pos:ref:alt.")
+    return fields[0], int(fields[1]), fields[2], fields[3]
+
+
+def validate_variant(variant: Variant, reference_genome: str = 'auto') -> Tuple[str, Variant]:
+    """
+    Normalizes and validates a variant against its reference genome.
+    With `reference_genome='auto'`, variants with a contig starting with "chr" are GRCh38 and all others GRCh37.
+    The "chr" prefix is added to / removed from contigs as needed for the reference genome.
+
+    :param tuple variant: Contig, position, ref and alt
+    :param str reference_genome: One of 'auto', 'GRCh37' or 'GRCh38'
+    :return: Reference genome and normalized variant
+    :rtype: (str, tuple)
+    """
+    contig, pos, ref, alt = variant
+    if reference_genome == 'auto':
+        reference_genome = 'GRCh38' if contig.startswith('chr') else 'GRCh37'
+    if reference_genome == 'GRCh38' and not contig.startswith('chr'):
+        contig = f'chr{contig}'
+    elif reference_genome == 'GRCh37' and contig.startswith('chr'):
+        contig = contig[3:]
+
+    lengths = hl.get_reference(reference_genome).lengths
+    if contig not in lengths:
+        raise ValueError(f"Unknown {reference_genome} contig {contig}.")
+    if not 0 < pos <= lengths[contig]:
+        raise ValueError(f"Position {pos} is outside of {reference_genome} contig {contig}.")
+
+    ref, alt = ref.upper(), alt.upper()
+    if not ALLELE_RE.match(ref) or not ALLELE_RE.match(alt):
+        raise ValueError(f"Invalid alleles {ref}/{alt}.")
+    if ref == alt:
+        raise ValueError(f"Ref and alt alleles are identical ({ref}).")
+
+    return reference_genome, (contig, pos, ref, alt)
+
+
+def _get_delimiter(path: str, line: str) -> str:
+    if re.search(r'\.csv(\.b?gz)?$', path):
+        return ','
+    if re.search(r'\.(tsv|vcf)(\.b?gz)?$', path):
+        return '\t'
+    return '\t' if '\t' in line else ','
+
+
+def _normalize_column(column: str) -> str:
+    return re.sub(r'\W', '_', column.strip().lstrip('#').strip().lower())
+
+
+def _get_row_parser(first_row: List[str]) -> Tuple[Callable[[List[str]], Tuple[Variant, Variant]], List[str], bool]:
+    """
+    Infers the input format from the first row.
+
+    :param list of str first_row: First (non-meta) row of the file
+    :return: Function returning the two variants of a row, column names and whether the first row is a header
+    :rtype: (function, list of str, bool)
+    """
+    try:
+        parse_variant(first_row[0])
+        parse_variant(first_row[1])
+        return lambda row: (parse_variant(row[0]), parse_variant(row[1])), ['variant1', 'variant2'], False
+    except (ValueError, IndexError):
+        pass
+
+    # Input columns are kept as fields, so they can't clash with the pairs table fields
+    columns = [_normalize_column(c) for c in first_row]
+    columns = [f'{c}_input' if c in PAIR_KEY + ['bad_liftover'] else c for c in columns]
+
+    # One column per variant field, e.g. chrom_1, pos_1, ref_1, alt_1, chrom_2, ...
+    variant_columns = {}
+    for i, column in enumerate(columns):
+        m = re.match(r'^([a-z]+)_?([12])$', column)
+        if m and m.group(1) in COLUMN_ALIASES:
+            variant_columns[(COLUMN_ALIASES[m.group(1)], m.group(2))] = i
+    if len(variant_columns) == 8:
+        def get_pair(row: List[str]) -> Tuple[Variant, Variant]:
+            return tuple(
+                (
+                    row[variant_columns[('chrom', n)]],
+                    int(row[variant_columns[('pos', n)]]),
+                    row[variant_columns[('ref', n)]],
+                    row[variant_columns[('alt', n)]]
+                )
+                for n in ('1', '2')
+            )
+        return get_pair, columns, True
+
+    # One column per variant string
+    for c1, c2 in VARIANT_STRING_COLUMNS:
+        if c1 in columns and c2 in columns:
+            i1, i2 = columns.index(c1), columns.index(c2)
+            return lambda row: (parse_variant(row[i1]), parse_variant(row[i2])), columns, True
+
+    raise ValueError(
+        "Could not find the variant columns. Expected either two variant strings (contig:pos:ref:alt) per line, "
+        "chrom/pos/ref/alt columns for each variant (e.g. chrom_1, pos_1, ref_1, alt_1, chrom_2, ...) or variant1/variant2 columns."
+    )
+
+
+def read_pair_chunks(
+        path: str,
+        reference_genome: str = 'auto',
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+) -> Iterator[Tuple[List[Tuple[str, Variant, Variant, Dict[str, str]]], List[Tuple[int, str]]]]:
+    """
+    Streams and validates a pair list in chunks.
+
+    :param str path: Input file (see module docstring for the supported formats)
+    :param str reference_genome: One of 'auto', 'GRCh37' or 'GRCh38' (see `validate_variant`)
+    :param int chunk_size: Number of lines per chunk
+    :return: Iterator of (pairs, errors) chunks. Pairs are (reference genome, variant1, variant2, input fields) and errors are (line number, message)
+    :rtype: iterator
+    """
+    with hl.hadoop_open(path, 'r') as f:
+        lines = (
+            (i + 1, line.rstrip('\r\n'))
+            for i, line in enumerate(f)
+            if line.strip() and not line.startswith('##')
+        )
+        first_line_number, first_line = next(lines, (0, None))
+        if first_line is None:
+            return
+
+        delimiter = _get_delimiter(path, first_line)
+
+        def split(line: str) -> List[str]:
+            return next(csv.reader([line], delimiter=delimiter))
+
+        first_row = split(first_line)
+        get_pair, columns, has_header = _get_row_parser(first_row)
+        rows = itertools.chain(
+            [] if has_header else [(first_line_number, first_row)],
+            ((i, split(line)) for i, line in lines if not line.startswith('#'))
+        )
+
+        for chunk in iter(lambda: list(itertools.islice(rows, chunk_size)), []):
+            pairs = []
+            errors = []
+            for i, row in chunk:
+                try:
+                    v1, v2 = get_pair(row)
+                    rg1, v1 = validate_variant(v1, reference_genome)
+                    rg2, v2 = validate_variant(v2, reference_genome)
+                    if rg1 != rg2:
+                        raise ValueError(f"Variants are on different reference genomes ({rg1} and {rg2}).")
+                    if v1 == v2:
+                        raise ValueError(f"Both variants are identical ({':'.join(map(str, v1))}).")
+                except (ValueError, IndexError) as e:
+                    errors.append((i, str(e)))
+                else:
+                    pairs.append((rg1, v1, v2, {name: row[j] if j < len(row) else None for j, name in enumerate(columns)}))
+            yield pairs, errors
+
+
+def liftover_variants(
+        variants: List[Variant],
+        cache_path: str = liftover_cache_ht_path(),
+        n_partitions: int = None
+) -> Dict[Variant, Optional[Tuple[Variant, bool]]]:
+    """
+    Lifts distinct GRCh38 variants over to GRCh37 using the liftover cache (see `liftover_cache.get_liftover_cache_ht`).
+
+    :param list of tuple variants: Distinct GRCh38 variants, sorted
+    :param str cache_path: Optional path of the persistent liftover cache
+    :param int n_partitions: Number of partitions of the variants table (default: Hail's default)
+    :return: Dict of GRCh38 variant -> (GRCh37 variant, bad liftover) or None if the variant couldn't be lifted over
+    :rtype: dict
+    """
+    if not variants:
+        return {}
+
+    variants_ht = hl.Table.parallelize(
+        [hl.Struct(locus=hl.Locus(c, p, reference_genome='GRCh38'), alleles=[r, a]) for c, p, r, a in variants],
+        schema=hl.tstruct(locus=hl.tlocus('GRCh38'), alleles=hl.tarray(hl.tstr)),
+        n_partitions=n_partitions
+    )
+    variants_ht = variants_ht._key_by_assert_sorted('locus', 'alleles')
+    cache_ht = get_liftover_cache_ht(variants_ht, cache_path)
+    variants_ht = variants_ht.annotate(**cache_ht[variants_ht.key])
+
+    lifted_over = {}
+    for row in variants_ht.collect():
+        lifted_over[(row.locus.contig, row.locus.position, row.alleles[0], row.alleles[1])] = (
+            None if row.locus_grch37 is None else
+            ((row.locus_grch37.contig, row.locus_grch37.position, row.alleles_grch37[0], row.alleles_grch37[1]), row.bad_liftover)
+        )
+    n_failed = sum(v is None for v in lifted_over.values())
+    n_bad = sum(v is not None and v[1] for v in lifted_over.values())
+    logger.info(f"Lifted over {len(variants)} distinct GRCh38 variants: {n_failed} failed and {n_bad} with a ref allele mismatch.")
+    return lifted_over
+
+
+def pairs_ht_from_file(
+        path: str,
+        reference_genome: str = 'auto',
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        n_partitions: int = None,
+        liftover_cache_path: str = liftover_cache_ht_path(),
+        liftover: bool = True
+) -> hl.Table:
+    """
+    Builds a pairs table from a pair list (see module docstring for the supported formats).
+
+    The table is keyed by locus1, alleles1, locus2, alleles2, with variants ordered by locus within each pair (as in `compute_phase.get_sorted_variants_expr`).
+    It has a `bad_liftover` field (always False for GRCh37 input) and one string field per input column.
+    Pairs where a variant couldn't be lifted over have missing keys, as in `load_cmg`. Invalid lines are skipped and logged.
+    All valid pairs are held in driver memory before being parallelized, so very large lists need a driver with enough memory.
+
+    :param str path: Input file
+    :param str reference_genome: One of 'auto', 'GRCh37' or 'GRCh38' (see `validate_variant`)
+    :param int chunk_size: Number of lines parsed at once
+    :param int n_partitions: Number of partitions of the output table (default: Hail's default)
+    :param str liftover_cache_path: Optional path of the persistent liftover cache used for GRCh38 variants
+    :param bool liftover: If not set, GRCh38 pairs are kept on GRCh38 (to be looked up in the GRCh38 phase tables) and all pairs need to be on the same reference
+    :return: Pairs table
+    :rtype: Table
+    """
+    pairs = []
+    input_fields = []
+    n_errors = 0
+    for chunk, errors in read_pair_chunks(path, reference_genome, chunk_size):
+        pairs.extend(chunk)
+        if chunk and not input_fields:
+            input_fields = list(chunk[0][3])
+        for line_number, error in errors:
+            if n_errors < MAX_LOGGED_ERRORS:
+                logger.warning(f"{path}, line {line_number}: {error}")
+            n_errors += 1
+    if n_errors:
+        logger.warning(f"Skipped {n_errors} invalid line(s) in {path}.")
+
+    reference_genome = 'GRCh37'
+    if liftover:
+        lifted_over = liftover_variants(
+            sorted({v for rg, v1, v2, _ in pairs if rg == 'GRCh38' for v in (v1, v2)}),
+            liftover_cache_path,
+            n_partitions
+        )
+    else:
+        reference_genomes = {rg for rg, _, _, _ in pairs}
+        if len(reference_genomes) > 1:
+            raise ValueError(f"{path} contains both GRCh37 and GRCh38 pairs, which can only be combined if GRCh38 pairs are lifted over.")
+        if reference_genomes:
+            reference_genome = reference_genomes.pop()
+
+    contig_index = {c: i for i, c in enumerate(hl.get_reference(reference_genome).contigs)}
+
+    def locus_sort_key(v: Optional[Variant]) -> Tuple:
+        # Missing loci are sorted last, as in Hail
+        return (1, ) if v is None else (0, contig_index[v[0]], v[1])
+
+    rows = []
+    for rg, v1, v2, fields in pairs:
+        if rg == 'GRCh38' and liftover:
+            (v1, bad1), (v2, bad2) = [lifted_over[v] or (None, None) for v in (v1, v2)]
+            bad_liftover = v1 is None or v2 is None or bool(bad1) or bool(bad2)
+        else:
+            bad_liftover = False
+        v1, v2 = sorted([v1, v2], key=locus_sort_key)
+        rows.append((locus_sort_key(v1), v1, locus_sort_key(v2), v2, bad_liftover, fields))
+
+    # Sort locally by key, so that the table can be keyed without a shuffle
+    rows.sort(key=lambda r: (r[0], r[1][2:] if r[1] else (), r[2], r[3][2:] if r[3] else ()))
+
+    def get_locus(v: Optional[Variant]) -> Optional[hl.Locus]:
+        return None if v is None else hl.Locus(v[0], v[1], reference_genome=reference_genome)
+
+    def get_alleles(v: Optional[Variant]) -> Optional[List[str]]:
+        return None if v is None else [v[2], v[3]]
+
+    pairs_ht = hl.Table.parallelize(
+        [
+            hl.Struct(
+                locus1=get_locus(v1),
+                alleles1=get_alleles(v1),
+                locus2=get_locus(v2),
+                alleles2=get_alleles(v2),
+                bad_liftover=bad_liftover,
+                **{f: fields[f] for f in input_fields}
+            )
+            for _, v1, _, v2, bad_liftover, fields in rows
+        ],
+        schema=hl.tstruct(
+            locus1=hl.tlocus(reference_genome),
+            alleles1=hl.tarray(hl.tstr),
+            locus2=hl.tlocus(reference_genome),
+            alleles2=hl.tarray(hl.tstr),
+            bad_liftover=hl.tbool,
+            **{f: hl.tstr for f in input_fields}
+        ),
+        n_partitions=n_partitions
+    )
+    pairs_ht = pairs_ht._key_by_assert_sorted(*PAIR_KEY)
+
+    logger.info(f"Read {len(rows)} variant pair(s) from {path}.")
+    return pairs_ht
+
+
+def _parse_str_expr(expr: hl.expr.StringExpression, dtype: hl.HailType) -> hl.expr.Expression:
+    # Same parsing as `hl.import_table`, with "NA" as missing
+    parsers = {hl.tint32: hl.int32, hl.tint64: hl.int64, hl.tfloat32: hl.float32, hl.tfloat64: hl.float64, hl.tbool: hl.bool}
+    if dtype not in parsers:
+        return expr
+    return hl.or_missing(expr != 'NA', parsers[dtype](expr))
+
+
+def load_cmg(cmg_csv: str, liftover_cache_path: str = liftover_cache_ht_path(), liftover: bool = True) -> hl.Table:
+    """
+    Loads a CMG compound het list (GRCh38, with chrom_1, pos_1, ref_1, alt_1, chrom_2, pos_2, ref_2, alt_2 columns) lifted over to GRCh37.
+
+    The table is keyed and has a `bad_liftover` field as in `pairs_ht_from_file`. The GRCh38 variants are kept
+    (in input order) as `locus1_b38`, `alleles1_b38`, `locus2_b38` and `alleles2_b38`, and all other CMG columns are kept
+    with their original names and imputed types (as with `hl.import_table(impute=True)`).
+
+    :param str cmg_csv: CMG CSV file
+    :param str liftover_cache_path: Optional path of the persistent liftover cache
+    :param bool liftover: If not set, the pairs are kept on GRCh38
+    :return: Pairs table
+    :rtype: Table
+    """
+    cmg_ht = pairs_ht_from_file(cmg_csv, reference_genome='GRCh38', liftover_cache_path=liftover_cache_path, liftover=liftover)
+
+    def get_b38_expr(n: str) -> Tuple[hl.expr.LocusExpression, hl.expr.ArrayExpression]:
+        chrom = cmg_ht[f'chrom_{n}']
+        return (
+            hl.locus(hl.if_else(chrom.startswith('chr'), chrom, 'chr' + chrom), hl.int32(cmg_ht[f'pos_{n}']), reference_genome='GRCh38'),
+            hl.array([cmg_ht[f'ref_{n}'], cmg_ht[f'alt_{n}']])
+        )
+
+    (locus1_b38, alleles1_b38), (locus2_b38, alleles2_b38) = get_b38_expr('1'), get_b38_expr('2')
+    cmg_ht = cmg_ht.transmute(
+        locus1_b38=locus1_b38,
+        alleles1_b38=alleles1_b38,
+        locus2_b38=locus2_b38,
+        alleles2_b38=alleles2_b38
+    )
+
+    # Other columns get the types and names they'd have with hl.import_table
+    cmg_types = hl.import_table(cmg_csv, impute=True, delimiter=",", quote='"').row.dtype
+    return cmg_ht.transmute(**{
+        name: _parse_str_expr(cmg_ht[_normalize_column(name)], dtype)
+        for name, dtype in cmg_types.items()
+        if _normalize_column(name) in cmg_ht.row
+    })
+
+
+def main(args):
+    hl.init(log="/tmp/hail_pair_input.log")
+    pairs_ht = pairs_ht_from_file(args.pairs, args.reference_genome, args.chunk_size, args.n_partitions, args.liftover_cache)
+    pairs_ht.write(args.out, overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', help='Variant pair list (TSV, CSV, VCF-like or one pair of variant strings per line, optionally gzipped). All pairs are held in driver memory before being parallelized.', required=True)
+    parser.add_argument('--reference_genome', help='Reference genome of the input variants. With auto, contigs starting with "chr" are GRCh38 and all others GRCh37. (default: auto)',
+                        choices=['auto', 'GRCh37', 'GRCh38'], default='auto')
+    parser.add_argument('--chunk_size', help=f'Number of lines parsed at once (default: {DEFAULT_CHUNK_SIZE})', default=DEFAULT_CHUNK_SIZE, type=int)
+    parser.add_argument('--n_partitions', help='Number of partitions of the output table', type=int)
+    parser.add_argument('--liftover_cache', help=f'Liftover cache used for GRCh38 variants (default: {liftover_cache_ht_path()})', default=liftover_cache_ht_path())
+    parser.add_argument('--out', help='Output HT path', required=True)
+    parser.add_argument('--overwrite', help='Overwrite output if it exists', action='store_true')
+
+    args = parser.parse_args()
+    main(args)
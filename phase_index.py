@@ -0,0 +1,517 @@
+import argparse
+import json
+import logging
+import mmap
+import os
+import struct
+import zlib
+import numpy as np
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+"""
+# Sorted phase index file
+
+A compact, read-only binary export of the phased VP table (`phased_vp_count_ht_path`) for lookups without a JVM.
+
+Each (variant-pair, pop) with carriers is stored as a fixed-width record (`RECORD_DTYPE`), sorted by an encoded key:
+
+    k0 = contig index << 32 | pos1
+    k1 = pos2 << 32 | crc32(ref1:alt1:ref2:alt2)
+
+Only pairs on the same contig are stored. Records are grouped in blocks of `block_size` records, each compressed
+separately (zstd if available, zlib otherwise). The file layout is:
+
+    | header | blocks | block index | footer (JSON) | trailer |
+
+The block index holds the first key, offset, compressed size and number of records of each block; it is small
+enough to be kept in memory, so a point lookup is a binary search in the index followed by a single block read.
+The trailer contains the footer offset and size, followed by the magic.
+The footer records the path and `_SUCCESS` modification time of the exported table (`source`), so that readers can
+check that the index is still up to date (see `compute_phase.phase_index_is_current`).
+
+The same format is used for single-variant indices (`VARIANT_RECORD_DTYPE`), exported from the slim single-variant
+table (see `compute_phase.create_single_variant_ht`), with k0 = contig index << 32 | pos and k1 = crc32(ref:alt).
+Up to `MAX_GENES` genes are stored per variant, as Ensembl gene ID numbers with their most severe consequence rank.
+"""
+
+logger = logging.getLogger("phase_index")
+
+MAGIC = b'PHASEIDX'
+VERSION = 1
+HEADER = struct.Struct('<8sI4x')
+TRAILER = struct.Struct('<QQ8s')
+DEFAULT_BLOCK_SIZE = 4096
+DEFAULT_PHASE_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'compound_hets', 'phased_exomes.idx')
+GRCH37_CONTIGS = [str(c) for c in range(1, 23)] + ['X', 'Y', 'MT']
+
+RECORD_DTYPE = np.dtype([
+    ('k0', '<u8'),
+    ('k1', '<u8'),
+    ('pop', 'u1'),
+    ('raw', '<i4', (9,)),
+    ('adj', '<i4', (9,)),
+    ('hap_counts_raw', '<f4', (4,)),
+    ('hap_counts_adj', '<f4', (4,)),
+    ('p_chet_raw', '<f4'),
+    ('p_chet_adj', '<f4')
+])
+MAX_GENES = 4
+VARIANT_RECORD_DTYPE = np.dtype([
+    ('k0', '<u8'),
+    ('k1', '<u8'),
+    ('adj_AC', '<i4'),
+    ('adj_AN', '<i4'),
+    ('adj_homozygote_count', '<i4'),
+    ('adj_AF', '<f4'),
+    ('raw_AC', '<i4'),
+    ('raw_AN', '<i4'),
+    ('raw_homozygote_count', '<i4'),
+    ('raw_AF', '<f4'),
+    ('gene_ids', '<u4', (MAX_GENES,)),
+    ('csq_ranks', 'i1', (MAX_GENES,))
+])
+RECORD_DTYPES = {'pair': RECORD_DTYPE, 'variant': VARIANT_RECORD_DTYPE}
+INDEX_DTYPE = np.dtype([
+    ('k0', '<u8'),
+    ('k1', '<u8'),
+    ('offset', '<u8'),
+    ('size', '<u8'),
+    ('n_records', '<u4')
+])
+MAX_K1 = np.iinfo(np.uint64).max
+
+
+def _get_codec(compression: str):
+    if compression == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().compress, zstandard.ZstdDecompressor().decompress
+    if compression == 'zlib':
+        return zlib.compress, zlib.decompress
+    if compression == 'none':
+        return bytes, bytes
+    raise ValueError(f"Unknown compression {compression}")
+
+
+def _default_compression() -> str:
+    try:
+        import zstandard  # noqa: F401
+        return 'zstd'
+    except ImportError:
+        return 'zlib'
+
+
+def alleles_hash(*alleles: str) -> int:
+    return zlib.crc32(':'.join(alleles).encode())
+
+
+def encode_keys(contig_idx: np.ndarray, pos1: np.ndarray, pos2: np.ndarray, hashes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Encodes variant-pairs into (k0, k1) keys.
+
+    :param ndarray contig_idx: Contig index of the pairs
+    :param ndarray pos1: Position of the first variant
+    :param ndarray pos2: Position of the second variant
+    :param ndarray hashes: Alleles hash of the pairs (see `alleles_hash`)
+    :return: k0 and k1 arrays
+    :rtype: (ndarray, ndarray)
+    """
+    k0 = (np.asarray(contig_idx, dtype=np.uint64) << np.uint64(32)) | np.asarray(pos1, dtype=np.uint64)
+    k1 = (np.asarray(pos2, dtype=np.uint64) << np.uint64(32)) | np.asarray(hashes, dtype=np.uint64)
+    return k0, k1
+
+
+def _lex_searchsorted(k0: np.ndarray, k1: np.ndarray, q0: int, q1: int, side: str = 'left') -> int:
+    # Keys are sorted by (k0, k1): find the k0 run first, then search k1 within it
+    lo = np.searchsorted(k0, np.uint64(q0), side='left')
+    hi = np.searchsorted(k0, np.uint64(q0), side='right')
+    return int(lo + np.searchsorted(k1[lo:hi], np.uint64(q1), side=side))
+
+
+class PhaseIndexWriter:
+    """
+    Writes a phase index from records added in key order.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            pops: List[str],
+            contigs: List[str],
+            block_size: int = DEFAULT_BLOCK_SIZE,
+            compression: str = None,
+            record_type: str = 'pair',
+            source: Dict = None
+    ):
+        self.path = path
+        self.record_type = record_type
+        self.source = source
+        self.pops = pops
+        self.contigs = contigs
+        self.block_size = block_size
+        self.compression = compression if compression is not None else _default_compression()
+        self._compress, _ = _get_codec(self.compression)
+        self._buffer = np.empty(0, dtype=RECORD_DTYPES[record_type])
+        self._index = []
+        self._last_key = None
+        self.n_records = 0
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._f = open(path, 'wb')
+        self._f.write(HEADER.pack(MAGIC, VERSION))
+
+    def add(self, records: np.ndarray) -> None:
+        """
+        Adds records. Records need to be sorted by (k0, k1), including across calls.
+
+        :param ndarray records: Array of records of the writer record type
+        :return: Nothing
+        :rtype: None
+        """
+        if not len(records):
+            return
+        keys = records[['k0', 'k1']]
+        first = (int(keys['k0'][0]), int(keys['k1'][0]))
+        if (self._last_key is not None and first < self._last_key) or np.any(
+                (keys['k0'][1:] < keys['k0'][:-1]) | ((keys['k0'][1:] == keys['k0'][:-1]) & (keys['k1'][1:] < keys['k1'][:-1]))
+        ):
+            raise ValueError("Records need to be added sorted by (k0, k1).")
+        self._last_key = (int(keys['k0'][-1]), int(keys['k1'][-1]))
+
+        self._buffer = np.concatenate([self._buffer, records])
+        while len(self._buffer) >= self.block_size:
+            self._write_block(self._buffer[:self.block_size])
+            self._buffer = self._buffer[self.block_size:]
+
+    def _write_block(self, block: np.ndarray) -> None:
+        data = self._compress(block.tobytes())
+        self._index.append((block['k0'][0], block['k1'][0], self._f.tell(), len(data), len(block)))
+        self._f.write(data)
+        self.n_records += len(block)
+
+    def close(self) -> None:
+        if len(self._buffer):
+            self._write_block(self._buffer)
+        index_offset = self._f.tell()
+        self._f.write(np.array(self._index, dtype=INDEX_DTYPE).tobytes())
+        footer = json.dumps(dict(
+            version=VERSION,
+            record_type=self.record_type,
+            pops=self.pops,
+            contigs=self.contigs,
+            n_records=self.n_records,
+            n_blocks=len(self._index),
+            block_size=self.block_size,
+            compression=self.compression,
+            index_offset=index_offset,
+            source=self.source
+        )).encode()
+        footer_offset = self._f.tell()
+        self._f.write(footer)
+        self._f.write(TRAILER.pack(footer_offset, len(footer), MAGIC))
+        self._f.close()
+        logger.info(f"Wrote {self.n_records} records in {len(self._index)} blocks to {self.path}.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PhaseIndex:
+    """
+    Memory-mapped reader of a phase index file.
+    """
+
+    def __init__(self, path: str, block_cache_size: int = 256):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version = HEADER.unpack_from(self._mm, 0)
+        footer_offset, footer_size, trailer_magic = TRAILER.unpack_from(self._mm, len(self._mm) - TRAILER.size)
+        if magic != MAGIC or trailer_magic != MAGIC:
+            raise ValueError(f"{path} is not a phase index file.")
+        if version != VERSION:
+            raise ValueError(f"Unsupported phase index version {version} (expected {VERSION}).")
+
+        self.footer = json.loads(self._mm[footer_offset:footer_offset + footer_size])
+        self.pops = self.footer['pops']
+        self.source = self.footer.get('source')
+        self.contigs = {c: i for i, c in enumerate(self.footer['contigs'])}
+        self.record_dtype = RECORD_DTYPES[self.footer.get('record_type', 'pair')]
+        self._decompress = _get_codec(self.footer['compression'])[1]
+        self.index = np.frombuffer(
+            self._mm, dtype=INDEX_DTYPE, count=self.footer['n_blocks'], offset=self.footer['index_offset']
+        ).copy()
+        self._block = lru_cache(maxsize=block_cache_size)(self._read_block)
+
+    def close(self) -> None:
+        self._block.cache_clear()
+        self._mm.close()
+        self._file.close()
+
+    def _read_block(self, i: int) -> np.ndarray:
+        offset, size = int(self.index['offset'][i]), int(self.index['size'][i])
+        return np.frombuffer(self._decompress(self._mm[offset:offset + size]), dtype=self.record_dtype)
+
+    def _records_between(self, lo: Tuple[int, int], hi: Tuple[int, int]) -> np.ndarray:
+        # The first block that can contain `lo` is the last one starting strictly before it
+        first = max(_lex_searchsorted(self.index['k0'], self.index['k1'], lo[0], lo[1], 'left') - 1, 0)
+        last = _lex_searchsorted(self.index['k0'], self.index['k1'], hi[0], hi[1], 'right')
+        res = []
+        for i in range(first, last):
+            block = self._block(i)
+            start = _lex_searchsorted(block['k0'], block['k1'], lo[0], lo[1], 'left')
+            end = _lex_searchsorted(block['k0'], block['k1'], hi[0], hi[1], 'right')
+            if end > start:
+                res.append(block[start:end])
+        return np.concatenate(res) if res else np.empty(0, dtype=self.record_dtype)
+
+    def _encode(self, contig: str, pos1: int, pos2: int, alleles: Tuple[str, str, str, str]) -> Tuple[int, int]:
+        k0, k1 = encode_keys(self.contigs[contig], pos1, pos2, alleles_hash(*alleles))
+        return int(k0), int(k1)
+
+    def get(self, contig: str, pos1: int, ref1: str, alt1: str, pos2: int, ref2: str, alt2: str) -> List[Dict]:
+        """
+        Returns the records of a variant-pair (one per pop with carriers), or an empty list if the pair isn't in the index.
+        Variants need to be sorted by position.
+
+        :return: List of records
+        :rtype: list of dict
+        """
+        if contig not in self.contigs:
+            return []
+        key = self._encode(contig, pos1, pos2, (ref1, alt1, ref2, alt2))
+        return self._to_dicts(self._records_between(key, key))
+
+    def range(self, contig: str, start: int, end: int) -> np.ndarray:
+        """
+        Returns all records for pairs whose first variant is within [start, end] on `contig`.
+
+        :param str contig: Contig
+        :param int start: Start position (inclusive)
+        :param int end: End position (inclusive)
+        :return: Array of records
+        :rtype: ndarray
+        """
+        if contig not in self.contigs:
+            return np.empty(0, dtype=self.record_dtype)
+        k0_start, _ = encode_keys(self.contigs[contig], start, 0, 0)
+        k0_end, _ = encode_keys(self.contigs[contig], end, 0, 0)
+        return self._records_between((int(k0_start), 0), (int(k0_end), int(MAX_K1)))
+
+    def get_variant(self, contig: str, pos: int, ref: str, alt: str) -> Optional[Dict]:
+        """
+        Returns the frequencies and genes of a variant in a single-variant index, or None if the variant isn't in the index.
+
+        :return: Variant record, with genes as a dict of gene ID -> most severe consequence rank
+        :rtype: dict
+        """
+        if contig not in self.contigs:
+            return None
+        k0, k1 = encode_keys(self.contigs[contig], pos, 0, alleles_hash(ref, alt))
+        records = self._records_between((int(k0), int(k1)), (int(k0), int(k1)))
+        if not len(records):
+            return None
+        r = records[0]
+        res = {f: r[f].item() for f in VARIANT_RECORD_DTYPE.names if f.startswith('adj_') or f.startswith('raw_')}
+        res['genes'] = {f'ENSG{g:011d}': int(rank) for g, rank in zip(r['gene_ids'], r['csq_ranks']) if rank >= 0}
+        return res
+
+    def _to_dicts(self, records: np.ndarray) -> List[Dict]:
+        return [
+            dict(
+                pop=self.pops[r['pop']],
+                raw=r['raw'].tolist(),
+                adj=r['adj'].tolist(),
+                hap_counts_raw=r['hap_counts_raw'].tolist(),
+                hap_counts_adj=r['hap_counts_adj'].tolist(),
+                p_chet_raw=float(r['p_chet_raw']),
+                p_chet_adj=float(r['p_chet_adj'])
+            )
+            for r in records
+        ]
+
+
+def get_table_source(ht_path: str) -> Dict:
+    """
+    Returns the path and `_SUCCESS` modification time of a Hail table, as stored in the footer of indices exported from it.
+
+    :param str ht_path: Table path
+    :return: Dict with path and modification_time
+    :rtype: dict
+    """
+    import hail as hl
+    return dict(path=ht_path, modification_time=hl.hadoop_stat(f'{ht_path}/_SUCCESS')['modification_time'])
+
+
+def export_phase_index(phased_ht, path: str, block_size: int = DEFAULT_BLOCK_SIZE, compression: str = None, source_path: str = None) -> None:
+    """
+    Exports a phased VP table (output of `phasing.get_phased_gnomad_ht` with dict GT counts) to a phase index file.
+    The table is exported one partition at a time, so only one partition is held in memory.
+
+    :param Table phased_ht: Phased VP table, keyed by locus1, alleles1, locus2, alleles2
+    :param str path: Output path (local)
+    :param int block_size: Number of records per block
+    :param str compression: One of 'zstd', 'zlib' or 'none'. Defaults to zstd if available.
+    :param str source_path: Path `phased_ht` was read from, recorded in the footer (see `get_table_source`)
+    :return: Nothing
+    :rtype: None
+    """
+    import hail as hl
+
+    pops = sorted(phased_ht.aggregate(hl.agg.explode(lambda pop: hl.agg.collect_as_set(pop), hl.array(phased_ht.phase_info.key_set()))))
+    contigs = phased_ht.locus1.dtype.reference_genome.contigs
+    ht = phased_ht.filter(phased_ht.locus1.contig == phased_ht.locus2.contig)
+    ht = ht.select(
+        contig_idx=hl.literal({c: i for i, c in enumerate(contigs)})[ht.locus1.contig],
+        pos1=ht.locus1.position,
+        pos2=ht.locus2.position,
+        alleles=hl.delimit(ht.alleles1.extend(ht.alleles2), ':'),
+        phase=hl.array(ht.phase_info).filter(
+            lambda x: hl.sum(x[1].gt_counts.raw[1:]) > 0  # Like compute_phase.explode_phase_info, pops without carriers are removed
+        ).map(
+            lambda x: hl.struct(
+                pop=hl.literal(pops).index(x[0]),
+                raw=x[1].gt_counts.raw,
+                adj=x[1].gt_counts.adj,
+                hap_counts_raw=x[1].em.raw.hap_counts,
+                hap_counts_adj=x[1].em.adj.hap_counts,
+                p_chet_raw=x[1].em.raw.p_chet,
+                p_chet_adj=x[1].em.adj.p_chet
+            )
+        )
+    )
+
+    def nan_if_missing(values, n=None):
+        if n is None:
+            return np.nan if values is None else values
+        return [np.nan] * n if values is None else [np.nan if v is None else v for v in values]
+
+    def get_records(rows) -> np.ndarray:
+        records = np.array(
+            [
+                (0, 0, p.pop, p.raw, p.adj,
+                 nan_if_missing(p.hap_counts_raw, 4), nan_if_missing(p.hap_counts_adj, 4),
+                 nan_if_missing(p.p_chet_raw), nan_if_missing(p.p_chet_adj))
+                for r in rows for p in r.phase
+            ],
+            dtype=RECORD_DTYPE
+        )
+        if len(records):
+            n_phase = [len(r.phase) for r in rows]
+            records['k0'], records['k1'] = encode_keys(
+                np.repeat([r.contig_idx for r in rows], n_phase),
+                np.repeat([r.pos1 for r in rows], n_phase),
+                np.repeat([r.pos2 for r in rows], n_phase),
+                np.repeat([alleles_hash(*r.alleles.split(':')) for r in rows], n_phase)
+            )
+        return records
+
+    source = get_table_source(source_path) if source_path is not None else None
+    with PhaseIndexWriter(path, pops, contigs, block_size, compression, source=source) as writer:
+        _write_partitions(ht, writer, get_records, ['k0', 'k1', 'pop'])
+
+
+def _write_partitions(ht, writer: PhaseIndexWriter, get_records, sort_fields: List[str]) -> None:
+    # Partitions are collected one at a time. The table is sorted by locus (of the first variant),
+    # so only records sharing the last k0 can continue in the next partition and they are kept pending.
+    pending = np.empty(0, dtype=RECORD_DTYPES[writer.record_type])
+    for i in range(ht.n_partitions()):
+        records = np.concatenate([pending, get_records(ht._filter_partitions([i]).collect())])
+        if not len(records):
+            continue
+        records = records[np.lexsort([records[f] for f in reversed(sort_fields)])]
+        is_pending = records['k0'] == records['k0'][-1]
+        writer.add(records[~is_pending])
+        pending = records[is_pending]
+        logger.info(f"Exported partition {i} ({writer.n_records} records written)")
+    writer.add(pending)
+
+
+def export_single_variant_index(single_variant_ht, path: str, block_size: int = DEFAULT_BLOCK_SIZE, compression: str = None, source_path: str = None) -> None:
+    """
+    Exports the slim single-variant table (output of `compute_phase.create_single_variant_ht`) to a single-variant index file.
+    Only the `MAX_GENES` genes with the most severe consequences are kept for each variant.
+
+    :param Table single_variant_ht: Single-variant table
+    :param str path: Output path (local)
+    :param int block_size: Number of records per block
+    :param str compression: One of 'zstd', 'zlib' or 'none'. Defaults to zstd if available.
+    :param str source_path: Path `single_variant_ht` was read from, recorded in the footer (see `get_table_source`)
+    :return: Nothing
+    :rtype: None
+    """
+    import hail as hl
+
+    contigs = single_variant_ht.locus.dtype.reference_genome.contigs
+    ht = single_variant_ht.filter(single_variant_ht.gene_csq_ranks.key_set().any(lambda g: g.startswith('ENSG')))
+    ht = ht.select(
+        contig_idx=hl.literal({c: i for i, c in enumerate(contigs)})[ht.locus.contig],
+        pos=ht.locus.position,
+        ref=ht.alleles[0],
+        alt=ht.alleles[1],
+        adj_freq=ht.adj_freq,
+        raw_freq=ht.raw_freq,
+        genes=hl.sorted(
+            hl.array(ht.gene_csq_ranks).filter(lambda x: x[0].startswith('ENSG')),
+            key=lambda x: x[1]
+        )[:MAX_GENES].map(lambda x: hl.tuple([hl.int64(x[0][4:]), x[1]]))
+    )
+
+    def get_records(rows) -> np.ndarray:
+        records = np.zeros(len(rows), dtype=VARIANT_RECORD_DTYPE)
+        if not len(rows):
+            return records
+        records['k0'], records['k1'] = encode_keys(
+            [r.contig_idx for r in rows], [r.pos for r in rows], 0, [alleles_hash(r.ref, r.alt) for r in rows]
+        )
+        for freq in ['adj', 'raw']:
+            for f in ['AC', 'AN', 'homozygote_count', 'AF']:
+                values = [r[f'{freq}_freq'][f] if r[f'{freq}_freq'] is not None else None for r in rows]
+                records[f'{freq}_{f}'] = [np.nan if v is None and f == 'AF' else (-1 if v is None else v) for v in values]
+        records['csq_ranks'] = -1
+        for i, r in enumerate(rows):
+            for j, (gene_id, rank) in enumerate(r.genes):
+                records['gene_ids'][i, j] = gene_id
+                records['csq_ranks'][i, j] = rank
+        return records
+
+    source = get_table_source(source_path) if source_path is not None else None
+    with PhaseIndexWriter(path, [], contigs, block_size, compression, record_type='variant', source=source) as writer:
+        _write_partitions(ht, writer, get_records, ['k0', 'k1'])
+
+
+def main(args):
+    if args.export:
+        import hail as hl
+        from resources import phased_vp_count_ht_path
+        hl.init(log="/tmp/hail_phase_index.log")
+        export_phase_index(hl.read_table(phased_vp_count_ht_path('exomes')), args.path, args.block_size, args.compression, phased_vp_count_ht_path('exomes'))
+
+    if args.export_single_variants:
+        import hail as hl
+        from resources import single_variant_ht_path
+        hl.init(log="/tmp/hail_phase_index.log")
+        export_single_variant_index(hl.read_table(single_variant_ht_path()), args.path, args.block_size, args.compression, single_variant_ht_path())
+
+    if args.variants:
+        index = PhaseIndex(args.path)
+        v1, v2 = sorted([v.split(':') for v in args.variants.split(',')], key=lambda v: (GRCH37_CONTIGS.index(v[0]), int(v[1])))
+        for record in index.get(v1[0], int(v1[1]), v1[2], v1[3], int(v2[1]), v2[2], v2[3]):
+            print(json.dumps(record))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--path', help=f'Path of the phase index file (default: {DEFAULT_PHASE_INDEX_PATH})', default=DEFAULT_PHASE_INDEX_PATH)
+    parser.add_argument('--export', help='Exports the phased exomes VP table to the phase index file.', action='store_true')
+    parser.add_argument('--export_single_variants', help='Exports the slim single-variant table (see compute_phase.py --create_single_variant_ht) to a single-variant index file at --path.', action='store_true')
+    parser.add_argument('--block_size', help=f'Number of records per block (default: {DEFAULT_BLOCK_SIZE})', default=DEFAULT_BLOCK_SIZE, type=int)
+    parser.add_argument('--compression', help='Block compression (default: zstd if the zstandard package is installed, zlib otherwise)', choices=['zstd', 'zlib', 'none'])
+    parser.add_argument('--variants', help='Looks up a variant pair in the format chr:pos1:ref1:alt1,chr:pos2:ref2:alt2')
+
+    args = parser.parse_args()
+    main(args)
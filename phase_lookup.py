@@ -0,0 +1,332 @@
+import argparse
+import gzip
+import logging
+import os
+import sqlite3
+import numpy as np
+from typing import Dict, Iterator, List, Optional, Tuple
+import phasing_np
+from resources import LEAST_CONSEQUENCE, MAX_FREQ
+
+"""
+# Local variant-pair phase lookup
+
+A SQLite index of the phased gnomAD VP table and of single-variant frequencies, used to answer
+phase queries without starting Spark (see `phase_server.py`).
+
+The index is built in two steps:
+1. `--export` (needs Hail) exports the flattened phased VP table (same fields as `compute_phase.flatten_phased_ht`)
+   and the single-variant frequencies (see `compute_phase.create_single_variant_ht`) to TSVs.
+2. `--build` loads the TSVs into a SQLite database.
+
+Pairs that are not in the phased VP table are estimated from the single-variant frequencies,
+the same way as `compute_phase.annotate_unphased_pairs`.
+Only GRCh37 variants are supported, since liftover needs Hail.
+"""
+
+logger = logging.getLogger("phase_lookup")
+
+GT_COUNTS_FIELDS = ['ref_ref', 'ref_het', 'ref_hom', 'het_ref', 'het_het', 'het_hom', 'hom_ref', 'hom_het', 'hom_hom']
+PAIR_KEY_FIELDS = ['chrom', 'pos1', 'ref1', 'alt1', 'pos2', 'ref2', 'alt2']
+PAIR_FIELDS = (
+        PAIR_KEY_FIELDS + ['pop'] +
+        [f'raw.{f}' for f in GT_COUNTS_FIELDS] +
+        [f'adj.{f}' for f in GT_COUNTS_FIELDS] +
+        ['em_p_chet_raw', 'em_p_chet_adj']
+)
+VARIANT_FIELDS = [
+    'chrom', 'pos', 'ref', 'alt',
+    'adj_AC', 'adj_AF', 'adj_AN', 'adj_homozygote_count',
+    'raw_AC', 'raw_AF', 'raw_AN', 'raw_homozygote_count',
+    'genes'
+]
+GRCH37_CONTIGS = [str(c) for c in range(1, 23)] + ['X', 'Y', 'MT']
+N_EXOMES_ALLELES = 125748 * 2  # Same default AN as compute_phase.annotate_unphased_pairs for variants absent from gnomAD
+
+
+def _column(field: str) -> str:
+    return field.replace('.', '_')
+
+
+def _parse_value(value: str, field: str):
+    if value == 'NA' or value == '':
+        return None
+    if field in ['chrom', 'ref', 'alt', 'ref1', 'alt1', 'ref2', 'alt2', 'pop', 'genes']:
+        return value
+    if 'AF' in field or 'p_chet' in field:
+        return float(value)
+    return int(value)
+
+
+class VariantParseError(ValueError):
+    pass
+
+
+def parse_variant(variant: str) -> Tuple[str, int, str, str]:
+    """
+    Parses a variant in the chrom:pos:ref:alt (or chrom-pos-ref-alt) format.
+
+    :param str variant: Variant
+    :return: Tuple of chrom, pos, ref, alt
+    :rtype: tuple
+    """
+    parts = variant.strip().replace('-', ':').split(':')
+    if len(parts) != 4:
+        raise VariantParseError(f"Could not parse variant {variant}, expected format is chrom:pos:ref:alt.")
+    chrom, pos, ref, alt = parts
+    if chrom.startswith('chr'):
+        raise VariantParseError(f"Variant {variant} looks like a GRCh38 variant. Only GRCh37 variants are supported by the local lookup, use compute_phase.py to lift over GRCh38 variants.")
+    if chrom not in GRCH37_CONTIGS:
+        raise VariantParseError(f"Unknown GRCh37 contig {chrom} in variant {variant}.")
+    if not pos.isdigit():
+        raise VariantParseError(f"Invalid position in variant {variant}.")
+    return chrom, int(pos), ref.upper(), alt.upper()
+
+
+def sort_variant_pair(v1: Tuple[str, int, str, str], v2: Tuple[str, int, str, str]) -> Tuple[Tuple[str, int, str, str], Tuple[str, int, str, str]]:
+    """
+    Orders the variants of a pair by locus, like `compute_phase.get_sorted_variants_expr`.
+    """
+    def locus_key(v):
+        return GRCH37_CONTIGS.index(v[0]), v[1]
+
+    return (v2, v1) if locus_key(v2) < locus_key(v1) else (v1, v2)
+
+
+def _read_tsv(path: str) -> Iterator[Dict[str, str]]:
+    opener = gzip.open if path.endswith('.gz') or path.endswith('.bgz') else open
+    with opener(path, 'rt') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        for line in f:
+            yield dict(zip(header, line.rstrip('\n').split('\t')))
+
+
+def export_phase_lookup_tsvs(out_prefix: str, least_consequence: str = LEAST_CONSEQUENCE) -> None:
+    """
+    Exports the flattened phased VP table and the gnomAD exomes single-variant frequencies to `<out_prefix>.pairs.tsv.bgz`
+    and `<out_prefix>.variants.tsv.bgz`.
+
+    :param str out_prefix: Output prefix
+    :param str least_consequence: Least consequence used for the genes of each variant
+    :return: Nothing
+    :rtype: None
+    """
+    import hail as hl
+    from resources import phased_vp_count_ht_path, single_variant_ht_path
+    from compute_phase import explode_phase_info, flatten_phased_ht, create_single_variant_ht
+    from chet_utils import vep_genes_from_csq_ranks_expr
+
+    phased_ht = hl.read_table(phased_vp_count_ht_path('exomes'))
+    phased_ht = explode_phase_info(phased_ht)
+    phased_ht = phased_ht.transmute(phase_info=phased_ht.phase_info.select('gt_counts', 'em'))
+    flatten_phased_ht(phased_ht).select(*PAIR_FIELDS).export(f'{out_prefix}.pairs.tsv.bgz')
+
+    if hl.hadoop_exists(f'{single_variant_ht_path()}/_SUCCESS'):
+        gnomad_ht = hl.read_table(single_variant_ht_path())
+    else:
+        gnomad_ht = create_single_variant_ht()
+    gnomad_ht = gnomad_ht.select(
+        adj=gnomad_ht.adj_freq,
+        raw=gnomad_ht.raw_freq,
+        genes=vep_genes_from_csq_ranks_expr(gnomad_ht.gene_csq_ranks, least_consequence)
+    )
+    gnomad_ht = gnomad_ht.filter(hl.len(gnomad_ht.genes) > 0)
+    gnomad_ht = gnomad_ht.key_by()
+    gnomad_ht.select(
+        chrom=gnomad_ht.locus.contig,
+        pos=gnomad_ht.locus.position,
+        ref=gnomad_ht.alleles[0],
+        alt=gnomad_ht.alleles[1],
+        **{f'{freq}_{f}': gnomad_ht[freq][f] for freq in ['adj', 'raw'] for f in ['AC', 'AF', 'AN', 'homozygote_count']},
+        genes=hl.delimit(hl.sorted(hl.array(gnomad_ht.genes)), ',')
+    ).export(f'{out_prefix}.variants.tsv.bgz')
+
+
+def build_phase_lookup_db(pairs_tsv: str, variants_tsv: str, db_path: str, batch_size: int = 100000) -> None:
+    """
+    Builds the SQLite phase lookup index from the TSVs written by `export_phase_lookup_tsvs`.
+
+    :param str pairs_tsv: Flattened phased VP table TSV
+    :param str variants_tsv: Single-variant frequencies TSV
+    :param str db_path: Output database path
+    :param int batch_size: Number of rows inserted per transaction
+    :return: Nothing
+    :rtype: None
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    con = sqlite3.connect(db_path)
+    con.execute('PRAGMA journal_mode = OFF')
+    con.execute('PRAGMA synchronous = OFF')
+
+    def create_and_load(table: str, fields: List[str], key_fields: List[str], tsv: str):
+        columns = ", ".join(f"{_column(f)}" for f in fields)
+        con.execute(f"CREATE TABLE {table} ({columns}, PRIMARY KEY ({', '.join(_column(f) for f in key_fields)})) WITHOUT ROWID")
+        insert = f"INSERT OR REPLACE INTO {table} VALUES ({', '.join('?' * len(fields))})"
+        batch = []
+        n = 0
+        for row in _read_tsv(tsv):
+            batch.append([_parse_value(row[f], f) for f in fields])
+            if len(batch) == batch_size:
+                con.executemany(insert, batch)
+                con.commit()
+                n += len(batch)
+                batch = []
+        con.executemany(insert, batch)
+        con.commit()
+        n += len(batch)
+        logger.info(f"Loaded {n} rows in {table}.")
+
+    create_and_load('pairs', PAIR_FIELDS, PAIR_KEY_FIELDS + ['pop'], pairs_tsv)
+    create_and_load('variants', VARIANT_FIELDS, ['chrom', 'pos', 'ref', 'alt'], variants_tsv)
+    con.close()
+
+
+class PhaseLookup:
+    """
+    Phase lookups from a SQLite index built with `build_phase_lookup_db`.
+    """
+
+    def __init__(self, db_path: str):
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"Phase lookup index not found at {db_path}. Build it with phase_lookup.py --build.")
+        self.con = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True, check_same_thread=False)
+
+    def close(self) -> None:
+        self.con.close()
+
+    def _get_phased_records(self, v1: Tuple, v2: Tuple) -> List[Dict]:
+        rows = self.con.execute(
+            f"SELECT {', '.join(_column(f) for f in PAIR_FIELDS)} FROM pairs WHERE "
+            f"{' AND '.join(f'{_column(f)} = ?' for f in PAIR_KEY_FIELDS)}",
+            [v1[0], v1[1], v1[2], v1[3], v2[1], v2[2], v2[3]]
+        ).fetchall()
+        return [dict(zip(PAIR_FIELDS, row)) for row in rows]
+
+    def _get_variant(self, v: Tuple) -> Optional[Dict]:
+        row = self.con.execute(
+            f"SELECT {', '.join(VARIANT_FIELDS)} FROM variants WHERE chrom = ? AND pos = ? AND ref = ? AND alt = ?",
+            list(v)
+        ).fetchone()
+        return dict(zip(VARIANT_FIELDS, row)) if row is not None else None
+
+    def lookup(self, pairs: List[Tuple[str, str]], max_freq: float = MAX_FREQ) -> Dict[str, List[Dict]]:
+        """
+        Looks up the phase of variant pairs.
+        Pairs found in the phased VP table return one record per pop with carriers.
+        Other pairs are estimated from the single-variant frequencies (pop 'all') if both variants are in gnomAD,
+        share a gene and have an adj AF <= `max_freq`.
+
+        :param list of (str, str) pairs: Variant pairs in the chrom:pos:ref:alt format
+        :param float max_freq: Maximum adj AF for pairs estimated from single variants
+        :return: Dict with `results` (one record per pair and pop) and `not_found` (pairs that couldn't be phased, with the reason)
+        :rtype: dict
+        """
+        results = []
+        not_found = []
+        unphased = []
+        for pair in pairs:
+            try:
+                v1, v2 = sort_variant_pair(parse_variant(pair[0]), parse_variant(pair[1]))
+            except VariantParseError as e:
+                not_found.append(dict(pair=list(pair), reason=str(e)))
+                continue
+
+            records = self._get_phased_records(v1, v2)
+            if not records and v1[:2] == v2[:2]:
+                records = self._get_phased_records(v2, v1)  # Pairs at the same locus can be in either order
+            if records:
+                # Like compute_phase.explode_phase_info, pops without carriers are removed
+                results.extend(
+                    dict(r, source='gnomad_pairs') for r in records
+                    if sum(r[f'raw.{f}'] for f in GT_COUNTS_FIELDS[1:]) > 0
+                )
+            else:
+                unphased.append((pair, v1, v2))
+
+        if unphased:
+            res, failed = self._estimate_from_single_variants(unphased, max_freq)
+            results.extend(res)
+            not_found.extend(failed)
+
+        return dict(results=results, not_found=not_found)
+
+    def _estimate_from_single_variants(self, unphased: List[Tuple], max_freq: float) -> Tuple[List[Dict], List[Dict]]:
+        missing_freq = dict(AC=0, AF=0.0, AN=N_EXOMES_ALLELES, homozygote_count=0)
+
+        def get_freq(v: Optional[Dict], freq: str) -> Dict:
+            if v is None or v[f'{freq}_AC'] is None:
+                return missing_freq
+            return {f: v[f'{freq}_{f}'] for f in ['AC', 'AF', 'AN', 'homozygote_count']}
+
+        def get_gt_counts(f1: Dict, f2: Dict) -> List[int]:
+            # [AABB, AABb, AAbb, AaBB, AaBb, Aabb, aaBB, aaBb, aabb]
+            return [
+                min(f1['AN'], f2['AN']),
+                f2['AC'] - 2 * f2['homozygote_count'],
+                f2['homozygote_count'],
+                f1['AC'] - 2 * f1['homozygote_count'],
+                0,
+                0,
+                f1['homozygote_count'],
+                0,
+                0
+            ]
+
+        estimated = []
+        failed = []
+        for pair, v1, v2 in unphased:
+            var1, var2 = self._get_variant(v1), self._get_variant(v2)
+            if var1 is None or var2 is None:
+                failed.append(dict(pair=list(pair), reason="Pair not found in gnomAD and at least one of the variants is not a coding variant in gnomAD."))
+                continue
+            if not set(var1['genes'].split(',')).intersection(var2['genes'].split(',')):
+                failed.append(dict(pair=list(pair), reason="Variants are not found within the same gene."))
+                continue
+            if var1['adj_AF'] is not None and var1['adj_AF'] > max_freq or var2['adj_AF'] is not None and var2['adj_AF'] > max_freq:
+                failed.append(dict(pair=list(pair), reason=f"The AF of at least one variant is > {max_freq}."))
+                continue
+            estimated.append((v1, v2, {freq: get_gt_counts(get_freq(var1, freq), get_freq(var2, freq)) for freq in ['raw', 'adj']}))
+
+        if not estimated:
+            return [], failed
+
+        p_chet = {
+            freq: phasing_np.get_em(np.array([e[2][freq] for e in estimated], dtype=np.float64))[1]
+            for freq in ['raw', 'adj']
+        }
+        results = []
+        for i, (v1, v2, gt_counts) in enumerate(estimated):
+            record = dict(zip(PAIR_KEY_FIELDS, [v1[0], v1[1], v1[2], v1[3], v2[1], v2[2], v2[3]]))
+            record['pop'] = 'all'
+            for freq in ['raw', 'adj']:
+                record.update({f'{freq}.{f}': c for f, c in zip(GT_COUNTS_FIELDS, gt_counts[freq])})
+            for freq in ['raw', 'adj']:
+                record[f'em_p_chet_{freq}'] = None if np.isnan(p_chet[freq][i]) else float(p_chet[freq][i])
+            record['source'] = 'single_variants'
+            results.append(record)
+
+        return results, failed
+
+
+def main(args):
+    if args.export:
+        import hail as hl
+        hl.init(log="/tmp/hail_phase_lookup.log")
+        export_phase_lookup_tsvs(args.export, args.least_consequence)
+
+    if args.build:
+        build_phase_lookup_db(args.pairs_tsv, args.variants_tsv, args.db)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--export', help='Exports the flattened phased VP table and single-variant frequencies to TSVs with this prefix (needs Hail).')
+    parser.add_argument('--least_consequence', help=f'Least consequence used for the genes of each variant with --export. (default: {LEAST_CONSEQUENCE})', default=LEAST_CONSEQUENCE)
+    parser.add_argument('--build', help='Builds the SQLite phase lookup index from --pairs_tsv and --variants_tsv.', action='store_true')
+    parser.add_argument('--pairs_tsv', help='Flattened phased VP table TSV (<prefix>.pairs.tsv.bgz written by --export)')
+    parser.add_argument('--variants_tsv', help='Single-variant frequencies TSV (<prefix>.variants.tsv.bgz written by --export)')
+    parser.add_argument('--db', help='Path of the SQLite phase lookup index', default='phase_lookup.db')
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,154 @@
+import json
+import logging
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional
+
+"""
+# Phase result cache
+
+A local SQLite cache of `compute_phase` results, so that pairs that were already looked up aren't recomputed
+when overlapping pair lists are resubmitted.
+
+Results are stored per variant pair, as the JSON-encoded list of its output rows (one per pop), and are keyed by
+(pair, fingerprint, least_consequence, max_freq). The fingerprint identifies the version of the tables used to compute
+the results (see `compute_phase.get_phase_tables_fingerprint`). When the fingerprint for a reference genome changes,
+all results computed with the previous tables are dropped.
+
+The cache holds at most `max_pairs` pairs. The least recently used pairs are evicted first.
+"""
+
+logger = logging.getLogger("phase_result_cache")
+logger.setLevel(logging.INFO)
+
+DEFAULT_PHASE_RESULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'compound_hets', 'phase_results.db')
+DEFAULT_MAX_PAIRS = 1000000
+DEFAULT_MAX_QUERY_PAIRS = 100000  # Larger queries bypass the cache, since cached and computed rows go through the driver
+
+
+class PhaseResultCache:
+
+    def __init__(self, db_path: str = DEFAULT_PHASE_RESULT_CACHE_PATH, max_pairs: int = DEFAULT_MAX_PAIRS):
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self.db_path = db_path
+        self.max_pairs = max_pairs
+        self.con = sqlite3.connect(db_path)
+        with self.con:
+            self.con.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "pair TEXT, fingerprint TEXT, least_consequence TEXT, max_freq REAL, rows TEXT, last_used REAL, "
+                "PRIMARY KEY (pair, fingerprint, least_consequence, max_freq)) WITHOUT ROWID"
+            )
+            self.con.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+            self.con.execute("CREATE TABLE IF NOT EXISTS fingerprints (reference_genome TEXT PRIMARY KEY, fingerprint TEXT, row_type TEXT)")
+
+    def close(self) -> None:
+        self.con.close()
+
+    def __enter__(self) -> 'PhaseResultCache':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def set_fingerprint(self, reference_genome: str, fingerprint: str) -> None:
+        """
+        Sets the current fingerprint of the tables for a reference genome.
+        If it changed, all results computed with the previous tables are dropped.
+
+        :param str reference_genome: Reference genome of the tables
+        :param str fingerprint: Fingerprint of the tables
+        :return: Nothing
+        :rtype: None
+        """
+        res = self.con.execute("SELECT fingerprint FROM fingerprints WHERE reference_genome = ?", (reference_genome,)).fetchone()
+        if res is not None and res[0] == fingerprint:
+            return
+
+        with self.con:
+            if res is not None:
+                n = self.con.execute("DELETE FROM results WHERE fingerprint = ?", (res[0],)).rowcount
+                logger.info(f"{reference_genome} phase tables changed: dropped {n} cached pair(s).")
+            self.con.execute("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, NULL)", (reference_genome, fingerprint))
+
+    def get_row_type(self, reference_genome: str) -> Optional[str]:
+        res = self.con.execute("SELECT row_type FROM fingerprints WHERE reference_genome = ?", (reference_genome,)).fetchone()
+        return None if res is None else res[0]
+
+    def set_row_type(self, reference_genome: str, row_type: str) -> None:
+        """
+        Sets the type of the cached rows for a reference genome.
+        If it changed (e.g. because `compute_phase` output changed), all cached results for that reference genome are dropped.
+
+        :param str reference_genome: Reference genome
+        :param str row_type: Row type, as a Hail type string
+        :return: Nothing
+        :rtype: None
+        """
+        previous_row_type = self.get_row_type(reference_genome)
+        if previous_row_type == row_type:
+            return
+
+        with self.con:
+            if previous_row_type is not None:
+                fingerprint = self.con.execute("SELECT fingerprint FROM fingerprints WHERE reference_genome = ?", (reference_genome,)).fetchone()[0]
+                n = self.con.execute("DELETE FROM results WHERE fingerprint = ?", (fingerprint,)).rowcount
+                logger.info(f"Row type of {reference_genome} results changed: dropped {n} cached pair(s).")
+            self.con.execute("UPDATE fingerprints SET row_type = ? WHERE reference_genome = ?", (row_type, reference_genome))
+
+    def get(self, pairs: Iterable[str], fingerprint: str, least_consequence: str, max_freq: float) -> Dict[str, List]:
+        """
+        Returns the cached results for the given pairs and marks them as used.
+
+        :param iterable of str pairs: Pair keys
+        :param str fingerprint: Fingerprint of the tables
+        :param str least_consequence: Least consequence used to compute the results
+        :param float max_freq: Maximum frequency used to compute the results
+        :return: Dict of pair key -> list of JSON rows, for the pairs found in the cache
+        :rtype: dict
+        """
+        res = {}
+        pairs = list(pairs)
+        with self.con:
+            # Pairs are looked up in batches to stay below SQLite's limit on the number of host parameters
+            for i in range(0, len(pairs), 500):
+                batch = pairs[i:i + 500]
+                query = (
+                    f"SELECT pair, rows FROM results WHERE fingerprint = ? AND least_consequence = ? AND max_freq = ? "
+                    f"AND pair IN ({', '.join('?' * len(batch))})"
+                )
+                for pair, rows in self.con.execute(query, (fingerprint, least_consequence, max_freq, *batch)):
+                    res[pair] = json.loads(rows)
+                self.con.execute(
+                    f"UPDATE results SET last_used = ? WHERE fingerprint = ? AND least_consequence = ? AND max_freq = ? "
+                    f"AND pair IN ({', '.join('?' * len(batch))})",
+                    (time.time(), fingerprint, least_consequence, max_freq, *batch)
+                )
+        return res
+
+    def put(self, results: Dict[str, List], fingerprint: str, least_consequence: str, max_freq: float) -> None:
+        """
+        Adds results to the cache, then evicts the least recently used pairs if the cache holds more than `max_pairs` pairs.
+
+        :param dict results: Dict of pair key -> list of JSON rows
+        :param str fingerprint: Fingerprint of the tables
+        :param str least_consequence: Least consequence used to compute the results
+        :param float max_freq: Maximum frequency used to compute the results
+        :return: Nothing
+        :rtype: None
+        """
+        now = time.time()
+        with self.con:
+            self.con.executemany(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                ((pair, fingerprint, least_consequence, max_freq, json.dumps(rows), now) for pair, rows in results.items())
+            )
+            n_evict = self.con.execute("SELECT COUNT(*) FROM results").fetchone()[0] - self.max_pairs
+            if n_evict > 0:
+                self.con.execute(
+                    "DELETE FROM results WHERE (pair, fingerprint, least_consequence, max_freq) IN "
+                    "(SELECT pair, fingerprint, least_consequence, max_freq FROM results ORDER BY last_used LIMIT ?)",
+                    (n_evict,)
+                )
+                logger.info(f"Evicted {n_evict} least recently used pair(s) from the phase result cache.")
@@ -0,0 +1,157 @@
+import argparse
+import asyncio
+import json
+import logging
+from typing import List, Tuple
+from urllib.parse import parse_qs, urlparse
+from phase_lookup import PhaseLookup
+from resources import MAX_FREQ
+
+"""
+# Local phase lookup server
+
+Serves phase lookups from the index built with `phase_lookup.py` over HTTP on localhost.
+
+    GET  /phase?variants=1:123:A:T,1:456:G:C[&variants=...][&max_freq=0.01]
+    POST /phase  {"pairs": [["1:123:A:T", "1:456:G:C"], ...], "max_freq": 0.01}
+    GET  /health
+
+Responses are JSON objects with `results` (same fields as `compute_phase.flatten_phased_ht`, one record per pair and pop)
+and `not_found` (pairs that couldn't be phased, with the reason).
+"""
+
+logger = logging.getLogger("phase_server")
+logger.setLevel(logging.INFO)
+
+MAX_BODY_SIZE = 10 * 1024 * 1024
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _parse_pair(pair) -> Tuple[str, str]:
+    if isinstance(pair, str):
+        pair = pair.split(',')
+    if len(pair) != 2:
+        raise BadRequest(f"Invalid variant pair {pair}, expected two variants.")
+    return pair[0], pair[1]
+
+
+def _parse_max_freq(max_freq) -> float:
+    try:
+        return float(max_freq)
+    except (TypeError, ValueError):
+        raise BadRequest(f"Invalid max_freq {max_freq}.")
+
+
+def _parse_get(query: str) -> Tuple[List[Tuple[str, str]], float]:
+    params = parse_qs(query)
+    if 'variants' not in params:
+        raise BadRequest("Missing variants parameter.")
+    return [_parse_pair(p) for p in params['variants']], _parse_max_freq(params.get('max_freq', [MAX_FREQ])[0])
+
+
+def _parse_post(body: bytes) -> Tuple[List[Tuple[str, str]], float]:
+    try:
+        request = json.loads(body)
+    except ValueError:
+        raise BadRequest("Request body is not valid JSON.")
+    if not isinstance(request, dict) or 'pairs' not in request:
+        raise BadRequest("Request body needs a pairs field.")
+    return [_parse_pair(p) for p in request['pairs']], _parse_max_freq(request.get('max_freq', MAX_FREQ))
+
+
+class PhaseServer:
+
+    def __init__(self, lookup: PhaseLookup):
+        self.lookup = lookup
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, target, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    k, v = line.decode('latin-1').split(':', 1)
+                    headers[k.strip().lower()] = v.strip()
+
+                content_length = int(headers.get('content-length', 0))
+                if content_length > MAX_BODY_SIZE:
+                    await self._respond(writer, 413, dict(error="Request body too large."))
+                    break
+                body = await reader.readexactly(content_length) if content_length else b''
+
+                status, response = self._dispatch(method, target, body)
+                await self._respond(writer, status, response, keep_alive=headers.get('connection', '').lower() != 'close')
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _dispatch(self, method: str, target: str, body: bytes) -> Tuple[int, dict]:
+        url = urlparse(target)
+        if url.path == '/health':
+            return 200, dict(status='ok')
+        if url.path != '/phase':
+            return 404, dict(error=f"Unknown path {url.path}.")
+
+        try:
+            if method == 'GET':
+                pairs, max_freq = _parse_get(url.query)
+            elif method == 'POST':
+                pairs, max_freq = _parse_post(body)
+            else:
+                return 405, dict(error=f"Method {method} not allowed.")
+        except BadRequest as e:
+            return 400, dict(error=str(e))
+
+        try:
+            return 200, self.lookup.lookup(pairs, max_freq)
+        except Exception as e:
+            logger.exception("Phase lookup failed")
+            return 500, dict(error=str(e))
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, status: int, response: dict, keep_alive: bool = False) -> None:
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+        body = json.dumps(response).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {reasons[status]}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+
+
+async def serve(db_path: str, host: str, port: int) -> None:
+    server = PhaseServer(PhaseLookup(db_path))
+    async_server = await asyncio.start_server(server.handle, host, port)
+    logger.info(f"Serving phase lookups from {db_path} on http://{host}:{port}/phase")
+    async with async_server:
+        await async_server.serve_forever()
+
+
+def main(args):
+    logging.basicConfig(format="%(asctime)s (%(name)s %(lineno)s): %(message)s", datefmt='%m/%d/%Y %I:%M:%S %p')
+    asyncio.run(serve(args.db, args.host, args.port))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', help='Path of the SQLite phase lookup index (see phase_lookup.py --build)', default='phase_lookup.db')
+    parser.add_argument('--host', help='Host to listen on (default: 127.0.0.1)', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on (default: 8765)', default=8765, type=int)
+
+    args = parser.parse_args()
+    main(args)
@@ -1,4 +1,12 @@
 import hail as hl
+from hail.utils import frozenlist
+from functools import partial
+import numpy as np
+import phasing_np
+from typing import Optional
+import logging
+
+logger = logging.getLogger("phasing")
 
 """
 # Phasing models
@@ -137,8 +145,26 @@ def same_hap_likelihood_expr(gt_counts, e: float = 1e-6, distance: int = None):
     return hl.bind(compute_same_hap_log_like, n, p, q, x)
 
 
-def get_em_expr(gt_counts):
-    hap_counts = hl.experimental.haplotype_freq_em(gt_counts)
+EM_BACKENDS = ['hail', 'numpy']
+# EM p_chet thresholds above / below which variant-pairs are called as chet / on the same haplotype
+CHET_THRESHOLD = 0.505
+SAME_HAP_THRESHOLD = 0.0164
+PHASE_MODEL_VERSION = 1  # Needs to be incremented whenever a model changes, so that phase caches get rebuilt
+EM_PLUS_ONE_GT_COUNTS = [0, 0, 0, 0, 1, 0, 0, 0, 0]
+
+
+def get_em_expr(gt_counts, em_lookup: hl.expr.DictExpression = None):
+    """
+    Computes haplotype counts and the probability of the variants being in trans using the EM.
+
+    :param gt_counts: Array of GT counts
+    :param em_lookup: Optional dict of precomputed GT counts -> haplotype counts (see `get_numpy_em_lookup`). If not given, the EM is computed in Hail.
+    :return: Struct with hap_counts and p_chet
+    """
+    if em_lookup is None:
+        hap_counts = hl.experimental.haplotype_freq_em(gt_counts)
+    else:
+        hap_counts = em_lookup.get(gt_counts.map(lambda x: hl.int32(x)))
     return hl.bind(
         lambda x: hl.struct(
             hap_counts=x,
@@ -148,58 +174,496 @@ def get_em_expr(gt_counts):
     )
 
 
-def get_em_expressions(gt_counts):
+def get_em_expressions(gt_counts, em_lookup: hl.expr.DictExpression = None):
     return dict(
         em=hl.struct(
-            raw=get_em_expr(gt_counts.raw),
-            adj=get_em_expr(gt_counts.adj),
+            raw=get_em_expr(gt_counts.raw, em_lookup),
+            adj=get_em_expr(gt_counts.adj, em_lookup),
         ),
         em_plus_one=hl.struct(
-            raw=get_em_expr(gt_counts.raw + [0, 0, 0, 0, 1, 0, 0, 0, 0]),
-            adj=get_em_expr(gt_counts.adj + [0, 0, 0, 0, 1, 0, 0, 0, 0]),
+            raw=get_em_expr(gt_counts.raw + EM_PLUS_ONE_GT_COUNTS, em_lookup),
+            adj=get_em_expr(gt_counts.adj + EM_PLUS_ONE_GT_COUNTS, em_lookup),
         )
     )
 
 
+def get_numpy_em_lookup(ht: hl.Table, max_broadcast_size: int = 1000000) -> Optional[hl.expr.DictExpression]:
+    """
+    Runs the EM for all distinct GT counts in `ht` at once using the batched NumPy implementation
+    and returns the results as a dict literal that can be passed to `get_em_expr`.
+
+    The lookup contains both the raw / adj GT counts and their em_plus_one counterparts.
+    Since the hom ref / hom ref count varies with AN, the number of distinct GT counts can be close to the number of variant-pairs.
+    If there are more than `max_broadcast_size` distinct GT counts, no lookup is returned and the EM is computed in Hail.
+
+    :param Table ht: Table with a `gt_counts` field, either a dict of pop -> struct(raw, adj), a struct(raw, adj) or a GT counts array
+    :param int max_broadcast_size: Maximum number of distinct GT counts to collect and broadcast
+    :return: Dict of GT counts -> haplotype counts, or None if there are too many distinct GT counts
+    :rtype: DictExpression
+    """
+    distinct_gt_counts_ht = get_distinct_gt_counts_ht(ht).persist()
+    n_distinct = distinct_gt_counts_ht.count()
+    if n_distinct > max_broadcast_size:
+        logger.warning(f"{n_distinct} distinct GT counts is more than {max_broadcast_size}: computing the EM in Hail instead of NumPy.")
+        return None
+
+    distinct_gt_counts = distinct_gt_counts_ht.gt_counts.collect()
+    gt_counts = np.array([list(x) for x in distinct_gt_counts], dtype=np.int64).reshape(-1, 9)
+    gt_counts = np.unique(np.concatenate([gt_counts, gt_counts + EM_PLUS_ONE_GT_COUNTS]), axis=0)
+    hap_counts = phasing_np.haplotype_freq_em(gt_counts)
+
+    return hl.literal(
+        {frozenlist(x.tolist()): y.tolist() for x, y in zip(gt_counts, hap_counts)},
+        dtype=hl.tdict(hl.tarray(hl.tint32), hl.tarray(hl.tfloat64))
+    )
+
+
+def get_lr_expr(gt_counts):
+    same_hap_likelihood = same_hap_likelihood_expr(gt_counts)
+    chet_likelihood = chet_likelihood_expr(gt_counts)
+    return hl.bind(
+        lambda x, y: hl.struct(
+            same_hap_like=x,
+            chet_like=y,
+            lr_chet=y - x
+        ),
+        same_hap_likelihood,
+        chet_likelihood
+    )
+
+
 def get_lr_expressions(gt_counts):
-    def get_lr_annotation(gt_counts):
-        same_hap_likelihood = same_hap_likelihood_expr(gt_counts)
-        chet_likelihood = chet_likelihood_expr(gt_counts)
-        return hl.bind(
+    return dict(
+        likelihood_model=hl.struct(
+            raw=get_lr_expr(gt_counts.raw),
+            adj=get_lr_expr(gt_counts.adj)
+        )
+    )
+
+
+def get_single_het_expr(gt_counts):
+    return hl.bind(
+        lambda x:
+        hl.cond(x[1] > x[3],
+                (x[1] + x[2]) / hl.sum(hl.range(1, 9).filter(lambda x: x % 3 > 0).map(lambda y: x[y])),
+                (x[3] + x[6]) / hl.sum(x[3:])
+                ),
+        gt_counts
+    )
+
+
+def get_single_het_expressions(gt_counts):
+    return dict(
+        singlet_het_ratio=hl.struct(
+            raw=get_single_het_expr(gt_counts.raw),
+            adj=get_single_het_expr(gt_counts.adj)
+        )
+    )
+
+
+def get_phase_expr(gt_counts, em_lookup: hl.expr.DictExpression = None) -> hl.expr.StructExpression:
+    """
+    Computes all phase models for a single GT counts array.
+    This is the value stored for each GT counts in the phase cache.
+
+    :param gt_counts: Array of GT counts
+    :param em_lookup: Optional dict of precomputed GT counts -> haplotype counts (see `get_numpy_em_lookup`)
+    :return: Struct with the phase from all models
+    """
+    return hl.struct(
+        em=get_em_expr(gt_counts, em_lookup),
+        em_plus_one=get_em_expr(gt_counts + EM_PLUS_ONE_GT_COUNTS, em_lookup),
+        likelihood_model=get_lr_expr(gt_counts),
+        singlet_het_ratio=get_single_het_expr(gt_counts)
+    )
+
+
+def haplotype_freq_em_expr(
+        gt_counts: hl.expr.ArrayNumericExpression,
+        init_hap_freqs: hl.expr.ArrayNumericExpression = None,
+        tol: float = phasing_np.EM_TOLERANCE
+) -> hl.expr.ArrayNumericExpression:
+    """
+    Hail-expression implementation of the same EM as `hl.experimental.haplotype_freq_em`, with the possibility
+    to start from given haplotype frequencies (e.g. to warm-start the EM from a nearby solution).
+
+    :param gt_counts: Array of GT counts
+    :param init_hap_freqs: Optional haplotype frequencies [AB, aB, Ab, ab] to start the EM from. If missing or NaN, the default start is used.
+    :param tol: Convergence threshold on the L2 norm of the haplotype frequencies update
+    :return: Haplotype counts [AB, aB, Ab, ab]
+    """
+    def _em(g, n_samples):
+        n_haplotypes = 2.0 * n_samples
+        const_counts = hl.array([
+            2.0 * g[0] + g[1] + g[3],  # AB
+            2.0 * g[6] + g[3] + g[7],  # aB
+            2.0 * g[2] + g[1] + g[5],  # Ab
+            2.0 * g[8] + g[5] + g[7]  # ab
+        ])
+        # Initial estimate with AaBb contributing equally to each haplotype
+        p_start = (const_counts + g[4] / 2.0) / n_haplotypes
+        if init_hap_freqs is not None:
+            p_start = hl.if_else(
+                hl.is_defined(init_hap_freqs) & ~init_hap_freqs.any(lambda x: hl.is_nan(x)),
+                init_hap_freqs.map(lambda x: hl.float64(x)),
+                p_start
+            )
+
+        def em_step(p):
+            return hl.rbind(
+                p[0] * p[3],
+                p[1] * p[2],
+                lambda cis, trans: (const_counts + hl.array([cis, trans, trans, cis]) * (g[4] / (cis + trans))) / n_haplotypes
+            )
+
+        hap_freqs = hl.experimental.loop(
+            lambda recur, p_cur, p_next: hl.if_else(
+                hl.sqrt(hl.sum((p_next - p_cur).map(lambda x: x ** 2))) > tol,
+                recur(p_next, em_step(p_next)),
+                p_next
+            ),
+            hl.tarray(hl.tfloat64),
+            p_start + 1.0,
+            p_start
+        )
+
+        # Needs some non-ref samples to compute
+        return hl.if_else(
+            g[0] >= n_samples,
+            hl.array([n_samples, 0.0, 0.0, 0.0]),
+            hap_freqs * n_haplotypes
+        )
+
+    return hl.rbind(
+        gt_counts.map(lambda x: hl.float64(x)),
+        lambda g: hl.rbind(hl.sum(g), lambda n_samples: _em(g, n_samples))
+    )
+
+
+def get_fused_phase_expr(
+        gt_counts: hl.expr.ArrayNumericExpression,
+        em: bool = True,
+        lr: bool = True,
+        shr: bool = True,
+        em_lookup: hl.expr.DictExpression = None,
+        e: float = 1e-6
+) -> hl.expr.StructExpression:
+    """
+    Computes the requested phase models for a single GT counts array in a single expression.
+    The statistics shared by the models (number of samples, haplotype frequency estimates, EM solution)
+    are computed once and the em_plus_one EM is warm-started from the EM solution.
+    The results are the same as `get_phase_expr` (up to the EM convergence tolerance for em_plus_one).
+
+    :param gt_counts: Array of GT counts
+    :param em: Whether to compute the EM phase
+    :param lr: Whether to compute the likelihood-ratio phase
+    :param shr: Whether to compute the single het ratio phase
+    :param em_lookup: Optional dict of precomputed GT counts -> haplotype counts (see `get_numpy_em_lookup`)
+    :param e: Error rate used in the likelihood-ratio models
+    :return: Struct with the phase from the requested models
+    """
+    def _get_em_plus_one_expr(n_samples, em_expr):
+        if em_lookup is not None:
+            return get_em_expr(gt_counts + EM_PLUS_ONE_GT_COUNTS, em_lookup)
+        init_hap_freqs = hl.or_missing(
+            gt_counts[0] < n_samples,  # The EM isn't run on all-ref GT counts
+            (em_expr.hap_counts + 0.5) / (2 * n_samples + 2)
+        )
+        return hl.rbind(
+            haplotype_freq_em_expr(gt_counts + EM_PLUS_ONE_GT_COUNTS, init_hap_freqs),
+            lambda x: hl.struct(
+                hap_counts=x,
+                p_chet=(x[1] * x[2]) / (x[0] * x[3] + x[1] * x[2])
+            )
+        )
+
+    def _get_lr_expr(n):
+        def log_like_expr(terms):
+            return hl.fold(lambda i, j: i + j[0] * j[1], 0.0, hl.zip(gt_counts, terms))
+
+        # Chet model, see chet_likelihood_expr
+        chet_like = hl.rbind(
+            (gt_counts[3] + gt_counts[4] + gt_counts[7] + 2 * gt_counts[6]) / n,
+            (gt_counts[1] + gt_counts[4] + gt_counts[5] + 2 * gt_counts[2]) / n,
+            lambda p, q: hl.rbind(
+                1 - p - q - e,
+                lambda x: hl.if_else(
+                    (p > 0) & (q > 0),
+                    log_like_expr([hl.log10(x) * 2, hl.log10(2 * x * q), hl.log10(q) * 2,
+                                   hl.log10(2 * x * p), hl.log10(2 * (p * q + x * e)), hl.log10(2 * q * e),
+                                   hl.log10(p) * 2, hl.log10(2 * p * e), hl.log10(e) * 2]),
+                    -1e-31
+                )
+            )
+        )
+
+        # Same haplotype model, see same_hap_likelihood_expr (f1 is computed exactly as it is there)
+        same_hap_like = hl.rbind(
+            (gt_counts[3] + gt_counts[4] + gt_counts[5] + 6 * (gt_counts[6] + gt_counts[7] + gt_counts[8])) / n,
+            (gt_counts[1] + gt_counts[4] + gt_counts[7] + 2 * (gt_counts[2] + gt_counts[5] + gt_counts[8])) / n,
+            (gt_counts[4] + gt_counts[5] + gt_counts[7] + 2 * gt_counts[8]) / n,
+            lambda f1, f2, q: hl.rbind(
+                hl.if_else(f1 > f2, f1, f2),
+                lambda p: hl.rbind(
+                    1 - p - q - e,
+                    lambda x: hl.if_else(
+                        q > 0,
+                        log_like_expr([hl.log10(x) * 2, hl.log10(2 * x * e), hl.log10(e) * 2,
+                                       hl.log10(2 * x * p), hl.log10(2 * (p * e + x * q)), hl.log10(2 * q * e),
+                                       hl.log10(p) * 2, hl.log10(2 * p * q), hl.log10(q) * 2]),
+                        -1e31
+                    )
+                )
+            )
+        )
+
+        return hl.rbind(
+            same_hap_like,
+            chet_like,
             lambda x, y: hl.struct(
                 same_hap_like=x,
                 chet_like=y,
                 lr_chet=y - x
-            ),
-            same_hap_likelihood,
-            chet_likelihood
+            )
         )
 
-    return dict(
-        likelihood_model=hl.struct(
-            raw=get_lr_annotation(gt_counts.raw),
-            adj=get_lr_annotation(gt_counts.adj)
+    def _get_phase_expr(n_samples):
+        fields = {}
+        if lr:
+            fields['likelihood_model'] = _get_lr_expr(2 * n_samples)
+        if shr:
+            fields['singlet_het_ratio'] = get_single_het_expr(gt_counts)
+
+        if not em:
+            return hl.struct(**fields)
+
+        return hl.rbind(
+            get_em_expr(gt_counts, em_lookup),
+            lambda em_expr: hl.struct(
+                em=em_expr,
+                em_plus_one=_get_em_plus_one_expr(n_samples, em_expr),
+                **fields
+            )
+        )
+
+    return hl.rbind(hl.sum(gt_counts), _get_phase_expr)
+
+
+def get_fused_phase_expressions(gt_counts, em: bool = True, lr: bool = True, shr: bool = True, em_lookup: hl.expr.DictExpression = None) -> hl.expr.StructExpression:
+    """
+    Fused equivalent of the combination of `get_em_expressions`, `get_lr_expressions` and `get_single_het_expressions`.
+
+    :param gt_counts: Struct with raw and adj GT counts
+    :param em: Whether to compute the EM phase
+    :param lr: Whether to compute the likelihood-ratio phase
+    :param shr: Whether to compute the single het ratio phase
+    :param em_lookup: Optional dict of precomputed GT counts -> haplotype counts (see `get_numpy_em_lookup`)
+    :return: Struct with the gt_counts and the raw and adj phase for each of the requested models
+    """
+    return hl.rbind(
+        get_fused_phase_expr(gt_counts.raw, em, lr, shr, em_lookup),
+        get_fused_phase_expr(gt_counts.adj, em, lr, shr, em_lookup),
+        lambda raw, adj: hl.struct(
+            gt_counts=gt_counts,
+            **{model: hl.struct(raw=raw[model], adj=adj[model]) for model in raw.dtype.fields}
         )
     )
 
 
-def get_single_het_expressions(gt_counts):
-    def get_single_het_expr(gt_counts):
-        return hl.bind(
-            lambda x:
-            hl.cond(x[1] > x[3],
-                    (x[1] + x[2]) / hl.sum(hl.range(1, 9).filter(lambda x: x % 3 > 0).map(lambda y: x[y])),
-                    (x[3] + x[6]) / hl.sum(x[3:])
-                    ),
-            gt_counts
+def _get_all_gt_counts_expr(gt_counts) -> hl.expr.ArrayExpression:
+    """
+    Returns all GT counts arrays in `gt_counts` as int32 arrays.
+
+    :param gt_counts: Either a dict of pop -> struct(raw, adj), a struct(raw, adj) or a single GT counts array
+    :return: Array of GT counts arrays
+    """
+    if isinstance(gt_counts, hl.expr.DictExpression):
+        gt_counts_expr = gt_counts.values().flatmap(lambda x: [x.raw, x.adj])
+    elif isinstance(gt_counts, hl.expr.StructExpression):
+        gt_counts_expr = hl.array([gt_counts.raw, gt_counts.adj])
+    else:
+        gt_counts_expr = hl.array([gt_counts])
+
+    return gt_counts_expr.map(lambda x: x.map(lambda y: hl.int32(y)))
+
+
+def get_distinct_gt_counts_ht(ht: hl.Table) -> hl.Table:
+    """
+    Deduplicates all GT counts arrays (all pops, raw and adj) of `ht` into a table keyed by `gt_counts`,
+    with the number of times each GT counts array appears in `n`.
+
+    :param Table ht: Table with a `gt_counts` field, either a dict of pop -> struct(raw, adj) or a struct(raw, adj)
+    :return: Distinct GT counts table
+    :rtype: Table
+    """
+    ht = ht.select(gt_counts=_get_all_gt_counts_expr(ht.gt_counts)).key_by()
+    ht = ht.explode('gt_counts')
+    return ht.group_by('gt_counts').aggregate(n=hl.agg.count())
+
+
+def get_phase_cache_ht(
+        ht: hl.Table,
+        cache_path: str = None,
+        em_backend: str = 'hail',
+        tmp_path: str = 'gs://gnomad-tmp/compound_hets/phase_cache.tmp.ht'
+) -> hl.Table:
+    """
+    Returns a table keyed by `gt_counts` containing the phase of every distinct GT counts array found in `ht`.
+    Each distinct GT counts array is only phased once.
+
+    If `cache_path` is given, the cache stored there is used and updated with the GT counts that weren't in it yet,
+    so the phase of a given GT counts is only ever computed once across runs.
+    The cache is rebuilt if it was computed with a different `PHASE_MODEL_VERSION`.
+
+    :param Table ht: Table with a `gt_counts` field, either a dict of pop -> struct(raw, adj) or a struct(raw, adj)
+    :param str cache_path: Optional path of the persistent phase cache
+    :param str em_backend: One of `EM_BACKENDS`, used to compute the EM for GT counts missing from the cache
+    :param str tmp_path: Temporary path used when updating an existing cache
+    :return: Phase cache table
+    :rtype: Table
+    """
+    gt_counts_ht = get_distinct_gt_counts_ht(ht).persist()
+
+    cache_ht = None
+    if cache_path is not None and hl.hadoop_exists(f'{cache_path}/_SUCCESS'):
+        cache_ht = hl.read_table(cache_path)
+        cache_version = hl.eval(cache_ht.phase_model_version)
+        if cache_version != PHASE_MODEL_VERSION:
+            logger.warning(f"Phase cache at {cache_path} was computed with phase model version {cache_version} (current: {PHASE_MODEL_VERSION}). Rebuilding it.")
+            cache_ht = None
+
+    gt_counts_ht = gt_counts_ht.annotate(
+        cached=False if cache_ht is None else hl.is_defined(cache_ht[gt_counts_ht.key])
+    )
+    stats = gt_counts_ht.aggregate(
+        hl.struct(
+            n_distinct=hl.agg.count(),
+            n_total=hl.agg.sum(gt_counts_ht.n),
+            n_hits=hl.agg.count_where(gt_counts_ht.cached)
         )
+    )
+    logger.info(
+        f"Phase cache: {stats.n_total} GT counts reduced to {stats.n_distinct} distinct GT counts. "
+        f"{stats.n_hits} cache hits ({stats.n_hits / max(stats.n_distinct, 1):.1%} hit rate), "
+        f"{stats.n_distinct - stats.n_hits} GT counts to phase."
+    )
 
-    return dict(
-        singlet_het_ratio=hl.struct(
-            raw=get_single_het_expr(gt_counts.raw),
-            adj=get_single_het_expr(gt_counts.adj)
+    new_ht = gt_counts_ht.filter(~gt_counts_ht.cached)
+    em_lookup = get_numpy_em_lookup(new_ht) if em_backend == 'numpy' else None
+    new_ht = new_ht.select(phase=get_phase_expr(new_ht.gt_counts, em_lookup))
+    new_ht = new_ht.select_globals(phase_model_version=PHASE_MODEL_VERSION)
+
+    if cache_path is None:
+        return new_ht.persist()
+
+    if cache_ht is None:
+        new_ht.write(cache_path, overwrite=True)
+    else:
+        cache_ht = cache_ht.union(new_ht).checkpoint(tmp_path, overwrite=True)
+        cache_ht.write(cache_path, overwrite=True)
+
+    return hl.read_table(cache_path)
+
+
+def _get_phase_from_cache_expr(gt_counts, cache_lookup, models) -> hl.expr.StructExpression:
+    raw = cache_lookup(gt_counts.raw)
+    adj = cache_lookup(gt_counts.adj)
+    return hl.struct(
+        gt_counts=gt_counts,
+        **{model: hl.struct(raw=raw[model], adj=adj[model]) for model in models}
+    )
+
+
+def get_phased_gnomad_ht_from_cache(
+        ht: hl.Table,
+        cache_ht: hl.Table,
+        em: bool = True,
+        lr: bool = True,
+        shr: bool = True,
+        max_broadcast_size: int = 1000000
+) -> hl.Table:
+    """
+    Annotates the phase of each variant-pair by looking up each GT counts array in the phase cache.
+    The output has the same schema as `get_phased_gnomad_ht`.
+
+    When the number of distinct GT counts in `ht` is at most `max_broadcast_size`, the relevant cache entries
+    are broadcast. Otherwise, the cache is joined to the exploded GT counts.
+
+    :param Table ht: Table with GT counts, either as a dict of pop -> struct(raw, adj) or as a struct(raw, adj)
+    :param Table cache_ht: Phase cache, as returned by `get_phase_cache_ht`
+    :param bool em: Whether to annotate the EM phase
+    :param bool lr: Whether to annotate the likelihood-ratio phase
+    :param bool shr: Whether to annotate the single het ratio phase
+    :param int max_broadcast_size: Maximum number of cache entries to broadcast
+    :return: Phased table
+    :rtype: Table
+    """
+    models = (['em', 'em_plus_one'] if em else []) + (['likelihood_model'] if lr else []) + (['singlet_het_ratio'] if shr else [])
+    if not models:
+        raise (Exception("No expressions to annotate"))
+
+    cache_ht = cache_ht.select(phase=cache_ht.phase.select(*models))
+    cache_ht = cache_ht.semi_join(get_distinct_gt_counts_ht(ht))
+    n_cache = cache_ht.count()
+
+    is_dict = isinstance(ht.gt_counts, hl.expr.DictExpression)
+    if is_dict:
+        gt_counts_expr = ht.gt_counts.map_values(
+            lambda pop_count: hl.struct(
+                raw=pop_count.raw.map(lambda y: hl.int32(y)),
+                adj=pop_count.adj.map(lambda z: hl.int32(z))
+            )
+        )
+    else:
+        gt_counts_expr = ht.gt_counts
+
+    if n_cache <= max_broadcast_size:
+        cache = cache_ht.aggregate(hl.agg.collect(hl.tuple([cache_ht.gt_counts, cache_ht.phase])))
+        cache = hl.literal(
+            {frozenlist(k): v for k, v in cache},
+            dtype=hl.tdict(cache_ht.gt_counts.dtype, cache_ht.phase.dtype)
+        )
+
+        def cache_lookup(x):
+            return cache[x.map(lambda y: hl.int32(y))]
+
+        if is_dict:
+            return ht.select(
+                phase_info=gt_counts_expr.map_values(lambda x: _get_phase_from_cache_expr(x, cache_lookup, models))
+            )
+        else:
+            return ht.annotate(**_get_phase_from_cache_expr(ht.gt_counts, cache_lookup, models).drop('gt_counts'))
+
+    if not is_dict:
+        ht = ht.annotate(
+            _raw_phase=cache_ht[ht.gt_counts.raw.map(lambda y: hl.int32(y))].phase,
+            _adj_phase=cache_ht[ht.gt_counts.adj.map(lambda y: hl.int32(y))].phase
+        )
+        return ht.transmute(
+            **{model: hl.struct(raw=ht._raw_phase[model], adj=ht._adj_phase[model]) for model in models}
+        )
+
+    # Explode by pop, join the cache and group back by variant-pair
+    pop_ht = ht.select(pop_gt_counts=hl.array(gt_counts_expr)).explode('pop_gt_counts')
+    pop_ht = pop_ht.transmute(pop=pop_ht.pop_gt_counts[0], gt_counts=pop_ht.pop_gt_counts[1])
+    pop_ht = pop_ht.annotate(
+        raw_phase=cache_ht[pop_ht.gt_counts.raw].phase,
+        adj_phase=cache_ht[pop_ht.gt_counts.adj].phase
+    )
+    pop_ht = pop_ht.group_by(*pop_ht.key).aggregate(
+        phase_info=hl.dict(
+            hl.agg.collect(
+                hl.tuple([
+                    pop_ht.pop,
+                    hl.struct(
+                        gt_counts=pop_ht.gt_counts,
+                        **{model: hl.struct(raw=pop_ht.raw_phase[model], adj=pop_ht.adj_phase[model]) for model in models}
+                    )
+                ])
+            )
         )
     )
+    return pop_ht
 
 
 def flatten_gt_counts(gt_counts: hl.expr.ArrayExpression) -> hl.expr.StructExpression:
@@ -236,12 +700,61 @@ def get_phased_gnomad_ht(
         ht: hl.Table,
         em: bool = True,
         lr: bool = True,
-        shr: bool = True
+        shr: bool = True,
+        em_backend: str = 'hail',
+        phase_cache: bool = False,
+        phase_cache_path: str = None,
+        fused: bool = False
 ) -> hl.Table:
+    """
+    Annotates the phase of each variant-pair using the requested models.
+
+    :param Table ht: Table with GT counts, either as a dict of pop -> struct(raw, adj) or as a struct(raw, adj)
+    :param bool em: Whether to compute the EM phase
+    :param bool lr: Whether to compute the likelihood-ratio phase
+    :param bool shr: Whether to compute the single het ratio phase
+    :param str em_backend: One of `EM_BACKENDS`. With 'numpy', the EM is computed on the driver for all distinct GT counts at once and broadcast.
+    :param bool phase_cache: If set, each distinct GT counts is only phased once and the results are joined back (see `get_phase_cache_ht`)
+    :param str phase_cache_path: Path of the persistent phase cache to use and update. Only used if `phase_cache` is set.
+    :param bool fused: If set, all models are computed from a single expression per GT counts (see `get_fused_phase_expressions`)
+    :return: Phased table
+    :rtype: Table
+    """
+    if em_backend not in EM_BACKENDS:
+        raise ValueError(f"em_backend must be one of {EM_BACKENDS}, found {em_backend}")
+
+    if phase_cache:
+        cache_ht = get_phase_cache_ht(ht, phase_cache_path, em_backend)
+        return get_phased_gnomad_ht_from_cache(ht, cache_ht, em, lr, shr)
+
+    if fused:
+        if not (em or lr or shr):
+            raise (Exception("No expressions to annotate"))
+
+        em_lookup = get_numpy_em_lookup(ht) if em and em_backend == 'numpy' else None
+        if isinstance(ht.gt_counts, hl.expr.DictExpression):
+            return ht.select(
+                phase_info=ht.gt_counts.map_values(
+                    lambda pop_count: get_fused_phase_expressions(
+                        hl.struct(
+                            raw=pop_count.raw.map(lambda y: hl.int32(y)),
+                            adj=pop_count.adj.map(lambda z: hl.int32(z))
+                        ),
+                        em, lr, shr, em_lookup
+                    )
+                )
+            )
+        else:
+            ht = ht.annotate(_phase=get_fused_phase_expressions(ht.gt_counts, em, lr, shr, em_lookup).drop('gt_counts'))
+            return ht.transmute(**ht._phase)
+
     expr_fun = []
 
     if em:
-        expr_fun.append(get_em_expressions)
+        if em_backend == 'numpy':
+            expr_fun.append(partial(get_em_expressions, em_lookup=get_numpy_em_lookup(ht)))
+        else:
+            expr_fun.append(get_em_expressions)
 
     if lr:
         expr_fun.append(get_lr_expressions)
@@ -279,4 +792,65 @@ def get_phased_gnomad_ht(
             }
         )
 
-    return ht
\ No newline at end of file
+    return ht
+
+
+def update_phased_gnomad_ht(
+        ht: hl.Table,
+        phased_ht: hl.Table,
+        em: bool = True,
+        lr: bool = True,
+        shr: bool = True,
+        em_backend: str = 'hail',
+        phase_cache: bool = False,
+        phase_cache_path: str = None,
+        fused: bool = False
+) -> hl.Table:
+    """
+    Updates a phased table (output of `get_phased_gnomad_ht` with dict GT counts) after its GT counts were updated
+    (e.g. using `create_vp_matrix.update_vp_summary`).
+    Only the populations whose GT counts changed (or that aren't in `phased_ht`) are re-phased, the others are kept from `phased_ht`.
+
+    :param Table ht: Table with updated GT counts, as a dict of pop -> struct(raw, adj)
+    :param Table phased_ht: Previously phased table
+    :param bool em: Whether to compute the EM phase
+    :param bool lr: Whether to compute the likelihood-ratio phase
+    :param bool shr: Whether to compute the single het ratio phase
+    :param str em_backend: One of `EM_BACKENDS`
+    :param bool phase_cache: If set, each distinct GT counts is only phased once (see `get_phase_cache_ht`)
+    :param str phase_cache_path: Path of the persistent phase cache to use and update. Only used if `phase_cache` is set.
+    :param bool fused: If set, all models are computed from a single expression per GT counts
+    :return: Updated phased table
+    :rtype: Table
+    """
+    # Pairs not yet in `phased_ht` have no previous phase
+    old_phase_info = phased_ht[ht.key].phase_info
+    ht = ht.annotate(_old_phase_info=hl.or_else(old_phase_info, hl.empty_dict(old_phase_info.dtype.key_type, old_phase_info.dtype.value_type)))
+
+    def is_changed(pop, pop_count):
+        old = ht._old_phase_info.get(pop)
+        return hl.or_else(
+            (old.gt_counts.raw != pop_count.raw.map(lambda y: hl.int32(y))) |
+            (old.gt_counts.adj != pop_count.adj.map(lambda z: hl.int32(z))),
+            True
+        )
+
+    ht = ht.annotate(
+        gt_counts=hl.dict(ht.gt_counts.items().filter(lambda x: is_changed(x[0], x[1])))
+    )
+    ht = ht.checkpoint('gs://gnomad-tmp/compound_hets/phase_update_gt_counts.ht', overwrite=True)
+    n_changed = ht.aggregate(hl.agg.sum(hl.len(ht.gt_counts)))
+    logger.info(f"Re-phasing {n_changed} population GT counts.")
+
+    new_ht = get_phased_gnomad_ht(
+        ht.select('gt_counts'), em, lr, shr, em_backend, phase_cache, phase_cache_path, fused
+    )
+    new_phase_info = new_ht[ht.key].phase_info
+    ht = ht.select(
+        phase_info=hl.dict(
+            hl.array(new_phase_info.key_set().union(ht._old_phase_info.key_set())).map(
+                lambda pop: (pop, hl.or_else(new_phase_info.get(pop), ht._old_phase_info.get(pop)))
+            )
+        )
+    )
+    return ht
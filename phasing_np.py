@@ -0,0 +1,234 @@
+import numpy as np
+from typing import Tuple
+
+"""
+# NumPy phasing models
+
+Batched versions of the models in phasing.py, operating on (N, 9) arrays of GT counts
+rather than on one row at a time inside a Hail expression.
+The GT counts ordering is the same as in phasing.py:
+
+| v0/v1 | BB    | Bb    | bb    |
+|-------|-------|-------|-------|
+| AA    | 0     | 1     | 2     |
+| Aa    | 3     | 4     | 5     |
+| aa    | 6     | 7     | 8     |
+"""
+
+EM_TOLERANCE = 1e-7
+EM_MAX_ITERATIONS = 10000
+
+
+def _as_gt_counts_array(gt_counts) -> np.ndarray:
+    gt_counts = np.asarray(gt_counts, dtype=np.float64)
+    if gt_counts.ndim == 1:
+        gt_counts = gt_counts[np.newaxis, :]
+    if gt_counts.ndim != 2 or gt_counts.shape[1] != 9:
+        raise ValueError(f"Expected an (N, 9) array of GT counts, found shape {gt_counts.shape}")
+    return gt_counts
+
+
+def haplotype_freq_em(
+        gt_counts: np.ndarray,
+        init_hap_freqs: np.ndarray = None,
+        tol: float = EM_TOLERANCE,
+        max_iter: int = EM_MAX_ITERATIONS
+) -> np.ndarray:
+    """
+    Vectorized equivalent of `hl.experimental.haplotype_freq_em`.
+    All N rows are iterated together; rows stop being updated as soon as they converge,
+    so each row goes through exactly the same iterations as the scalar Hail implementation.
+
+    Note that like the Hail implementation, the haplotypes are returned in the [AB, aB, Ab, ab] order
+    and rows for which the EM is undefined (e.g. no carriers of one of the variants) return NaN.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :param ndarray init_hap_freqs: Optional (N, 4) array of haplotype frequencies to start the EM from. Rows containing NaN use the default start.
+    :param float tol: Convergence threshold on the L2 norm of the haplotype frequencies update
+    :param int max_iter: Maximum number of iterations
+    :return: (N, 4) array of haplotype counts [AB, aB, Ab, ab]
+    :rtype: ndarray
+    """
+    gt_counts = _as_gt_counts_array(gt_counts)
+    n_samples = gt_counts.sum(axis=1)
+    n_haplotypes = 2.0 * n_samples
+    n_het_het = gt_counts[:, 4]
+
+    # Constant quantities for each of the different haplotypes
+    const_counts = np.stack([
+        2.0 * gt_counts[:, 0] + gt_counts[:, 1] + gt_counts[:, 3],  # AB
+        2.0 * gt_counts[:, 6] + gt_counts[:, 3] + gt_counts[:, 7],  # aB
+        2.0 * gt_counts[:, 2] + gt_counts[:, 1] + gt_counts[:, 5],  # Ab
+        2.0 * gt_counts[:, 8] + gt_counts[:, 5] + gt_counts[:, 7]   # ab
+    ], axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Initial estimate with AaBb contributing equally to each haplotype
+        p_next = (const_counts + (n_het_het / 2.0)[:, np.newaxis]) / n_haplotypes[:, np.newaxis]
+        if init_hap_freqs is not None:
+            init_hap_freqs = np.asarray(init_hap_freqs, dtype=np.float64)
+            use_init = ~np.isnan(init_hap_freqs).any(axis=1)
+            p_next[use_init] = init_hap_freqs[use_init]
+
+        # Only rows with some non-ref samples go through the EM
+        active = gt_counts[:, 0] < n_samples
+        p_cur = p_next + 1.0
+        for _ in range(max_iter):
+            if not active.any():
+                break
+            # Same stopping rule as the Hail implementation: NaN updates also stop the iterations.
+            active &= np.linalg.norm(p_next - p_cur, axis=1) > tol
+            idx = np.flatnonzero(active)
+            if idx.size == 0:
+                break
+            p = p_next[idx]
+            p_cur[idx] = p
+            cis = p[:, 0] * p[:, 3]
+            trans = p[:, 1] * p[:, 2]
+            het_het_weight = n_het_het[idx] / (cis + trans)
+            p_next[idx] = (
+                const_counts[idx] +
+                np.stack([cis, trans, trans, cis], axis=1) * het_het_weight[:, np.newaxis]
+            ) / n_haplotypes[idx, np.newaxis]
+
+        hap_counts = p_next * n_haplotypes[:, np.newaxis]
+
+    # Needs some non-ref samples to compute
+    all_ref = gt_counts[:, 0] >= n_samples
+    hap_counts[all_ref] = 0.0
+    hap_counts[all_ref, 0] = n_samples[all_ref]
+
+    return hap_counts
+
+
+def get_p_chet(hap_counts: np.ndarray) -> np.ndarray:
+    """
+    Computes the probability of the two variants being in trans from haplotype counts, as in `phasing.get_em_expr`.
+
+    :param ndarray hap_counts: (N, 4) array of haplotype counts [AB, aB, Ab, ab]
+    :return: Array of N probabilities
+    :rtype: ndarray
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trans = hap_counts[:, 1] * hap_counts[:, 2]
+        return trans / (hap_counts[:, 0] * hap_counts[:, 3] + trans)
+
+
+def get_em(gt_counts: np.ndarray, init_hap_freqs: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched equivalent of `phasing.get_em_expr`.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :param ndarray init_hap_freqs: Optional (N, 4) array of haplotype frequencies to start the EM from
+    :return: (N, 4) haplotype counts and N p_chet
+    :rtype: (ndarray, ndarray)
+    """
+    hap_counts = haplotype_freq_em(gt_counts, init_hap_freqs)
+    return hap_counts, get_p_chet(hap_counts)
+
+
+def _log_like(gt_counts: np.ndarray, terms: np.ndarray) -> np.ndarray:
+    # Summed in the same order as the hl.fold in phasing.py
+    res = np.zeros(gt_counts.shape[0])
+    for i in range(9):
+        res = res + gt_counts[:, i] * terms[:, i]
+    return res
+
+
+def chet_likelihood(gt_counts: np.ndarray, e: float = 1e-6, distance: np.ndarray = None) -> np.ndarray:
+    """
+    Batched equivalent of `phasing.chet_likelihood_expr`.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :param float e: Error rate
+    :param ndarray distance: Optional distance between the two variants (scalar or N distances)
+    :return: Array of N log-likelihoods
+    :rtype: ndarray
+    """
+    gt_counts = _as_gt_counts_array(gt_counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = 2 * gt_counts.sum(axis=1)
+        p = (gt_counts[:, 3] + gt_counts[:, 4] + gt_counts[:, 7] + 2 * gt_counts[:, 6]) / n
+        q = (gt_counts[:, 1] + gt_counts[:, 4] + gt_counts[:, 5] + 2 * gt_counts[:, 2]) / n
+        x = 1 - p - q - e
+        log_e = np.full_like(p, np.log10(e))
+
+        terms = np.stack([
+            np.log10(x) * 2, np.log10(2 * x * q), np.log10(q) * 2,
+            np.log10(2 * x * p), np.log10(2 * (p * q + x * e)), np.log10(2 * q * e),
+            np.log10(p) * 2, np.log10(2 * p * e), log_e * 2
+        ], axis=1)
+        res = np.where((p > 0) & (q > 0), _log_like(gt_counts, terms), -1e-31)
+
+        # If desired, add distance posterior based on value derived from regression
+        if distance is not None:
+            res = res + np.maximum(-6, np.log10(0.03 + 0.03 * np.log(np.asarray(distance, dtype=np.float64) - 1)))
+
+    return res
+
+
+def same_hap_likelihood(gt_counts: np.ndarray, e: float = 1e-6, distance: np.ndarray = None) -> np.ndarray:
+    """
+    Batched equivalent of `phasing.same_hap_likelihood_expr`.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :param float e: Error rate
+    :param ndarray distance: Optional distance between the two variants (scalar or N distances)
+    :return: Array of N log-likelihoods
+    :rtype: ndarray
+    """
+    gt_counts = _as_gt_counts_array(gt_counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = 2 * gt_counts.sum(axis=1)
+        # f1 is computed exactly as in same_hap_likelihood_expr
+        f1 = (gt_counts[:, 3:6] + 2 * gt_counts[:, 6:].sum(axis=1)[:, np.newaxis]).sum(axis=1) / n
+        f2 = (gt_counts[:, 1] + gt_counts[:, 4] + gt_counts[:, 7] + 2 * (gt_counts[:, 2] + gt_counts[:, 5] + gt_counts[:, 8])) / n
+        p = np.where(f1 > f2, f1, f2)
+        q = (gt_counts[:, 4] + gt_counts[:, 5] + gt_counts[:, 7] + 2 * gt_counts[:, 8]) / n
+        x = 1 - p - q - e
+        log_e = np.full_like(p, np.log10(e))
+
+        terms = np.stack([
+            np.log10(x) * 2, np.log10(2 * x * e), log_e * 2,
+            np.log10(2 * x * p), np.log10(2 * (p * e + x * q)), np.log10(2 * q * e),
+            np.log10(p) * 2, np.log10(2 * p * q), np.log10(q) * 2
+        ], axis=1)
+        res = np.where(q > 0, _log_like(gt_counts, terms), -1e31)  # Very large negative value if no q is present
+
+        # If desired, add distance posterior based on value derived from regression
+        if distance is not None:
+            res = res + np.maximum(-6, np.log10(0.97 - 0.03 * np.log(np.asarray(distance, dtype=np.float64) + 1)))
+
+    return res
+
+
+def get_lr(gt_counts: np.ndarray, e: float = 1e-6, distance: np.ndarray = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Batched equivalent of `phasing.get_lr_expr`.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :param float e: Error rate
+    :param ndarray distance: Optional distance between the two variants (scalar or N distances)
+    :return: Same haplotype log-likelihoods, chet log-likelihoods and lr_chet
+    :rtype: (ndarray, ndarray, ndarray)
+    """
+    same_hap_like = same_hap_likelihood(gt_counts, e, distance)
+    chet_like = chet_likelihood(gt_counts, e, distance)
+    return same_hap_like, chet_like, chet_like - same_hap_like
+
+
+def get_single_het_ratio(gt_counts: np.ndarray) -> np.ndarray:
+    """
+    Batched equivalent of `phasing.get_single_het_expr`.
+
+    :param ndarray gt_counts: (N, 9) array of GT counts
+    :return: Array of N single het ratios
+    :rtype: ndarray
+    """
+    gt_counts = _as_gt_counts_array(gt_counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(
+            gt_counts[:, 1] > gt_counts[:, 3],
+            (gt_counts[:, 1] + gt_counts[:, 2]) / gt_counts[:, [1, 2, 4, 5, 7, 8]].sum(axis=1),
+            (gt_counts[:, 3] + gt_counts[:, 6]) / gt_counts[:, 3:].sum(axis=1)
+        )
@@ -14,10 +14,34 @@ def vp_list_ht_path(data_type: str, pbt: bool = False, least_consequence: str =
     return _chets_out_path(data_type, 'ht', 'list', pbt, least_consequence, max_freq, chrom)
 
 
+def variant_dict_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
+    return _chets_out_path(data_type, 'ht', 'variant_dict', pbt, least_consequence, max_freq, chrom)
+
+
+def vp_id_list_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
+    return _chets_out_path(data_type, 'ht', 'id_list', pbt, least_consequence, max_freq, chrom)
+
+
+def sparse_gt_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
+    return _chets_out_path(data_type, 'ht', 'sparse_gt', pbt, least_consequence, max_freq, chrom)
+
+
+def vp_plan_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
+    return _chets_out_path(data_type, 'ht', 'plan', pbt, least_consequence, max_freq, chrom)
+
+
 def vp_ann_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
     return _chets_out_path(data_type, 'ht', 'ann', pbt, least_consequence, max_freq, chrom)
 
 
+def variant_ann_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
+    return _chets_out_path(data_type, 'ht', 'variant_ann', pbt, least_consequence, max_freq, chrom)
+
+
+def vp_bloom_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
+    return _chets_out_path(data_type, 'bloom', 'phased_counts', pbt, least_consequence, max_freq, chrom)
+
+
 def full_mt_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
     return _chets_out_path(data_type, 'mt', '', pbt, least_consequence, max_freq, chrom)
 
@@ -26,8 +50,9 @@ def vp_count_ht_path(data_type: str, pbt: bool = False, least_consequence: str =
     return _chets_out_path(data_type, 'ht', 'counts', pbt, least_consequence, max_freq, chrom)
 
 
-def phased_vp_count_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
-    return _chets_out_path(data_type, 'ht', 'phased_counts', pbt, least_consequence, max_freq, chrom)
+def phased_vp_count_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None, reference_genome: str = 'GRCh37'):
+    # The GRCh38 copy is lifted over from the GRCh37 table (see liftover_phase_tables.py)
+    return _chets_out_path(data_type, 'ht', 'phased_counts' if reference_genome == 'GRCh37' else f'phased_counts_{reference_genome.lower()}', pbt, least_consequence, max_freq, chrom)
 
 
 def pbt_phase_count_ht_path(data_type: str, pbt: bool = False, least_consequence: str = LEAST_CONSEQUENCE, max_freq: float = MAX_FREQ, chrom: str = None):
@@ -61,6 +86,21 @@ def pbt_comparison_phased_vp_count_ht_path(data_type: str, least_consequence: st
     return _chets_out_path(data_type, 'ht', 'pbt_comparison_phased_counts', False, least_consequence, max_freq, chrom)
 
 
+def phase_cache_ht_path():
+    # The phase of a given GT counts doesn't depend on the data, so a single cache is shared by all datasets
+    return 'gs://gnomad/projects/compound_hets/phase_cache.ht'
+
+
+def single_variant_ht_path(data_type: str = 'exomes', reference_genome: str = 'GRCh37'):
+    # Slim per-variant freq / genes table used to estimate the phase of pairs absent from the phased VP table
+    return f'gs://gnomad/projects/compound_hets/{data_type}_single_variants{"" if reference_genome == "GRCh37" else "_" + reference_genome.lower()}.ht'
+
+
+def liftover_cache_ht_path():
+    # GRCh38 -> GRCh37 liftover of every variant queried so far, shared by all runs
+    return 'gs://gnomad/projects/compound_hets/liftover_cache_grch38_to_grch37.ht'
+
+
 def get_adj_missing_mt(data_type: str, pbt: bool) -> hl.MatrixTable:
     mt = get_gnomad_data(data_type).select_cols() if not pbt else hl.read_matrix_table(pbt_phased_trios_mt_path(data_type))
     mt = mt.select_rows()
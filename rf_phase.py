@@ -2,6 +2,7 @@ import hail as hl
 from resources import *
 import logging
 import argparse
+from chet_utils import FilterFunnel
 from gnomad.utils.slack import try_slack
 
 logger = logging.getLogger("rf_phase")
@@ -17,17 +18,18 @@ def main(args):
         autosomes = hl.parse_locus_interval('1-22')
         pbt = pbt.filter(autosomes.contains(pbt.locus1))  # locus1 and locus2 are always on the same contig
 
+    # The remaining filters are applied at once, and the rows remaining after each are only counted if debug logging is enabled
+    funnel = FilterFunnel()
     if not args.keep_filtered:
-        pbt = pbt.filter((hl.len(pbt.filters1) == 0) & (hl.len(pbt.filters2) == 0))
-        logger.debug(f'Rows remaining after keeping non-filtered variants: {pbt.count()}')
+        pbt = funnel.add(pbt, 'keeping non-filtered variants', (hl.len(pbt.filters1) == 0) & (hl.len(pbt.filters2) == 0))
 
     if not args.keep_raw:
-        pbt = pbt.filter(pbt.adj1 & pbt.adj2)
-        logger.debug(f'Rows remaining after keeping adj-only: {pbt.count()}')
+        pbt = funnel.add(pbt, 'keeping adj-only', pbt.adj1 & pbt.adj2)
 
     if not args.keep_other_pop:
-        pbt = pbt.filter(pbt.is_defined(pbt.pop) & (pbt.pop != 'oth'))
-        logger.debug(f'Rows remaining after removing oth samples: {pbt.count()}')
+        pbt = funnel.add(pbt, 'removing oth samples', hl.is_defined(pbt.pop) & (pbt.pop != 'oth'))
+
+    pbt = funnel.apply(pbt, logger, logging.DEBUG)
 
 
 
@@ -0,0 +1,201 @@
+import argparse
+import json
+import logging
+import math
+import numpy as np
+from typing import Tuple
+from phase_index import alleles_hash, encode_keys
+
+"""
+# Variant-pair Bloom filter
+
+A Bloom filter over all keys of the phased VP table, used by `compute_phase` to route query pairs:
+pairs that are not in the filter are definitely not in the phased VP table and go straight to the
+single-variant estimate, so only likely hits need to be joined with the table.
+
+Pairs are encoded with the same (k0, k1) keys as the phase index (see `phase_index.encode_keys`), mixed with
+splitmix64 and mapped to `n_hashes` bits using double hashing (h1 + i * h2).
+The filter is persisted as a small JSON header line followed by the raw bit array, using `hl.hadoop_open`.
+"""
+
+logger = logging.getLogger("vp_bloom")
+
+MAGIC = b'VPBLOOM1'
+DEFAULT_FP_RATE = 0.01
+
+_SPLITMIX_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+_SPLITMIX_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_SPLITMIX_M2 = np.uint64(0x94D049BB133111EB)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    with np.errstate(over='ignore'):
+        z = np.asarray(x, dtype=np.uint64) + _SPLITMIX_GAMMA
+        z = (z ^ (z >> np.uint64(30))) * _SPLITMIX_M1
+        z = (z ^ (z >> np.uint64(27))) * _SPLITMIX_M2
+        return z ^ (z >> np.uint64(31))
+
+
+def get_bloom_params(n_items: int, fp_rate: float) -> Tuple[int, int]:
+    """
+    Returns the optimal number of bits and hash functions for a Bloom filter.
+
+    :param int n_items: Expected number of items
+    :param float fp_rate: Target false-positive rate
+    :return: Number of bits and number of hash functions
+    :rtype: (int, int)
+    """
+    n_bits = max(64, int(math.ceil(-max(n_items, 1) * math.log(fp_rate) / math.log(2) ** 2)))
+    n_hashes = max(1, int(round(n_bits / max(n_items, 1) * math.log(2))))
+    return n_bits, n_hashes
+
+
+class VPBloomFilter:
+
+    def __init__(self, n_bits: int, n_hashes: int, contigs: list, words: np.ndarray = None):
+        self.n_bits = n_bits
+        self.n_hashes = n_hashes
+        self.contigs = {c: i for i, c in enumerate(contigs)}
+        self.words = words if words is not None else np.zeros((n_bits + 63) // 64, dtype=np.uint64)
+
+    def _bit_positions(self, k0: np.ndarray, k1: np.ndarray) -> np.ndarray:
+        with np.errstate(over='ignore'):
+            h1 = splitmix64(np.asarray(k0, dtype=np.uint64) ^ splitmix64(k1))
+            h2 = splitmix64(h1) | np.uint64(1)
+            i = np.arange(self.n_hashes, dtype=np.uint64)
+            return (h1[:, None] + i[None, :] * h2[:, None]) % np.uint64(self.n_bits)
+
+    def add_keys(self, k0: np.ndarray, k1: np.ndarray) -> None:
+        pos = self._bit_positions(k0, k1).ravel()
+        np.bitwise_or.at(self.words, pos >> np.uint64(6), np.uint64(1) << (pos & np.uint64(63)))
+
+    def contains_keys(self, k0: np.ndarray, k1: np.ndarray) -> np.ndarray:
+        """
+        Returns whether each key might be in the filter. False means that the key is definitely not in the filter.
+
+        :param ndarray k0: k0 keys (see `phase_index.encode_keys`)
+        :param ndarray k1: k1 keys
+        :return: Boolean array
+        :rtype: ndarray
+        """
+        if not len(k0):
+            return np.zeros(0, dtype=bool)
+        pos = self._bit_positions(k0, k1)
+        return (((self.words[pos >> np.uint64(6)] >> (pos & np.uint64(63))) & np.uint64(1)) == 1).all(axis=1)
+
+    def encode_pairs(self, pairs: list) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Encodes variant pairs (rows with locus1, alleles1, locus2, alleles2) into (k0, k1) keys.
+        Pairs on unknown contigs are encoded with a contig index past the known contigs, so they are never found.
+
+        :param list pairs: Variant pairs
+        :return: k0 and k1 arrays
+        :rtype: (ndarray, ndarray)
+        """
+        return encode_keys(
+            np.array([self.contigs.get(p.locus1.contig, len(self.contigs)) for p in pairs], dtype=np.uint64),
+            np.array([p.locus1.position for p in pairs], dtype=np.uint64),
+            np.array([p.locus2.position for p in pairs], dtype=np.uint64),
+            np.array([alleles_hash(p.alleles1[0], p.alleles1[1], p.alleles2[0], p.alleles2[1]) for p in pairs], dtype=np.uint64)
+        )
+
+    def contains_pairs(self, pairs: list) -> np.ndarray:
+        """
+        Returns whether each variant pair (row with locus1, alleles1, locus2, alleles2) might be in the filter.
+        Pairs with a missing locus (e.g. failed liftover) are never in the filter.
+
+        :param list pairs: Variant pairs
+        :return: Boolean array
+        :rtype: ndarray
+        """
+        is_defined = np.array([p.locus1 is not None and p.locus2 is not None for p in pairs], dtype=bool)
+        res = np.zeros(len(pairs), dtype=bool)
+        res[is_defined] = self.contains_keys(*self.encode_pairs([p for p, d in zip(pairs, is_defined) if d]))
+        return res
+
+    def write(self, path: str) -> None:
+        import hail as hl
+
+        header = json.dumps(dict(n_bits=self.n_bits, n_hashes=self.n_hashes, contigs=list(self.contigs))).encode()
+        with hl.hadoop_open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(len(header).to_bytes(8, 'little'))
+            f.write(header)
+            f.write(self.words.tobytes())
+
+    @staticmethod
+    def read(path: str) -> 'VPBloomFilter':
+        import hail as hl
+
+        with hl.hadoop_open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"{path} is not a variant-pair Bloom filter.")
+            header = json.loads(f.read(int.from_bytes(f.read(8), 'little')))
+            words = np.frombuffer(f.read(), dtype=np.uint64).copy()
+        return VPBloomFilter(header['n_bits'], header['n_hashes'], header['contigs'], words)
+
+
+def build_vp_bloom(vp_ht, fp_rate: float = DEFAULT_FP_RATE, partitions_per_batch: int = 100) -> VPBloomFilter:
+    """
+    Builds a Bloom filter over the keys of a VP table.
+    The keys are streamed to the driver `partitions_per_batch` partitions at a time.
+
+    :param Table vp_ht: VP table keyed by locus1, alleles1, locus2, alleles2
+    :param float fp_rate: Target false-positive rate
+    :param int partitions_per_batch: Number of partitions collected at once
+    :return: Bloom filter
+    :rtype: VPBloomFilter
+    """
+    vp_ht = vp_ht.select()
+    n_pairs = vp_ht.count()
+    n_bits, n_hashes = get_bloom_params(n_pairs, fp_rate)
+    logger.info(f"Building a Bloom filter for {n_pairs} variant pairs with {n_bits} bits and {n_hashes} hash functions.")
+    bloom = VPBloomFilter(n_bits, n_hashes, vp_ht.locus1.dtype.reference_genome.contigs)
+
+    n_partitions = vp_ht.n_partitions()
+    for start in range(0, n_partitions, partitions_per_batch):
+        pairs = vp_ht._filter_partitions(list(range(start, min(start + partitions_per_batch, n_partitions)))).collect()
+        bloom.add_keys(*bloom.encode_pairs(pairs))
+        logger.info(f"Added partitions {start} to {min(start + partitions_per_batch, n_partitions)} / {n_partitions}")
+
+    return bloom
+
+
+def filter_with_vp_bloom(variants_ht, bloom: VPBloomFilter):
+    """
+    Filters query pairs to those that might be in the VP table the Bloom filter was built from.
+
+    :param Table variants_ht: Query pairs, keyed by locus1, alleles1, locus2, alleles2
+    :param VPBloomFilter bloom: Bloom filter
+    :return: Query pairs that might be in the VP table
+    :rtype: Table
+    """
+    import hail as hl
+
+    pairs = variants_ht.key.collect()
+    hits = bloom.contains_pairs(pairs)
+    hits_ht = hl.Table.parallelize(
+        [p for p, hit in zip(pairs, hits) if hit],
+        schema=variants_ht.key.dtype,
+        key=list(variants_ht.key.dtype)
+    )
+    return variants_ht.semi_join(hits_ht)
+
+
+def main(args):
+    import hail as hl
+    from resources import phased_vp_count_ht_path, vp_bloom_path
+
+    hl.init(log="/tmp/hail_vp_bloom.log")
+    bloom = build_vp_bloom(hl.read_table(phased_vp_count_ht_path('exomes')), args.fp_rate, args.partitions_per_batch)
+    bloom.write(args.out if args.out else vp_bloom_path('exomes'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fp_rate', help=f'Target false-positive rate (default: {DEFAULT_FP_RATE})', default=DEFAULT_FP_RATE, type=float)
+    parser.add_argument('--partitions_per_batch', help='Number of partitions collected to the driver at once (default: 100)', default=100, type=int)
+    parser.add_argument('--out', help='Output path (default: resources.vp_bloom_path for exomes)')
+
+    args = parser.parse_args()
+    main(args)